@@ -1,23 +1,25 @@
 from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException, Depends, status, Body
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, FileResponse, StreamingResponse, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-import sqlite3, os, uuid, shutil, zipfile, json, base64
-from urllib.parse import unquote
+import sqlite3, os, uuid, shutil, zipfile, json, threading, time, contextvars, asyncio, functools, multiprocessing, random, hashlib, unicodedata, re, itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import unquote, quote
 from datetime import datetime, date, timedelta
 from typing import Optional, List
+from collections import OrderedDict
+from array import array
 from pydantic import BaseModel
-from PIL import Image
-import pillow_heif
-from pdf2image import convert_from_path, pdfinfo_from_path
+from markupsafe import Markup, escape
+from PIL import Image, UnidentifiedImageError
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+import media_worker
 
 APP_VERSION = "v3.0.6"
 
 app = FastAPI(title=f'深度学习 {APP_VERSION}', version=APP_VERSION)
-pillow_heif.register_heif_opener()
 
 # Security & Auth
 SECRET_KEY = "66Lennoxwyr_Pro_Secret" # In production, this should be an env var
@@ -39,10 +41,1068 @@ templates = Jinja2Templates(directory='/app/templates')
 templates.env.globals['APP_VERSION'] = APP_VERSION
 templates.env.globals['unquote'] = unquote
 
+# ==============================================================================
+# V3.1: Pooled SQLite connection layer (WAL, busy_timeout, per-request sharing)
+# ==============================================================================
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 128 * 1024 * 1024))
+
+class ConnectionPool:
+    """Bounded pool of reusable sqlite3 connections.
+
+    Connections are opened lazily up to `size`; callers beyond that wait for a
+    release (up to `timeout` seconds) instead of opening yet another handle.
+    """
+    def __init__(self, path: str, size: int, timeout: float):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._opened = 0
+        self._cond = threading.Condition()
+        self.stats = {"opened": 0, "acquired": 0, "released": 0, "waits": 0, "wait_ms": 0.0, "timeouts": 0, "rollbacks": 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def acquire(self):
+        with self._cond:
+            if not self._idle and self._opened >= self.size:
+                self.stats["waits"] += 1
+                started = time.perf_counter()
+                if not self._cond.wait_for(lambda: self._idle or self._opened < self.size, timeout=self.timeout):
+                    self.stats["timeouts"] += 1
+                    raise sqlite3.OperationalError("database connection pool exhausted")
+                self.stats["wait_ms"] += (time.perf_counter() - started) * 1000
+            self.stats["acquired"] += 1
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+            self.stats["opened"] += 1
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+                self.stats["rollbacks"] += 1
+            healthy = True
+        except sqlite3.Error:
+            healthy = False
+        with self._cond:
+            self.stats["released"] += 1
+            if healthy:
+                self._idle.append(conn)
+            else:
+                self._opened -= 1
+            self._cond.notify()
+        if not healthy:
+            try: conn.close()
+            except sqlite3.Error: pass
+
+    def metrics(self):
+        with self._cond:
+            return {**self.stats, "size": self.size, "open": self._opened, "idle": len(self._idle), "in_use": self._opened - len(self._idle)}
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
+class _RequestDB:
+    """Holds the single pooled connection shared by everything in one request."""
+    def __init__(self):
+        self.conn = None
+        self.depth = 0
+        self.closed = False
+
+_request_db = contextvars.ContextVar('request_db', default=None)
+
+class PooledConnection:
+    """sqlite3.Connection proxy returned by get_db(); close() hands it back.
+
+    Inside a request all handles share one connection, so close() only rolls
+    back uncommitted work once the outermost handle is closed, matching the old
+    one-connection-per-get_db() semantics.
+    """
+    def __init__(self, conn, holder=None):
+        self._conn = conn
+        self._holder = holder
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None: return
+        if self._holder is None:
+            db_pool.release(conn)
+            return
+        self._holder.depth -= 1
+        if self._holder.depth <= 0 and conn.in_transaction:
+            conn.rollback()
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    holder = _request_db.get()
+    if holder is None or holder.closed:
+        # Outside a request (startup, background work, streamed bodies)
+        return PooledConnection(db_pool.acquire())
+    if holder.conn is None:
+        holder.conn = db_pool.acquire()
+    holder.depth += 1
+    return PooledConnection(holder.conn, holder)
+
+# V3.2: Image-upload request bodies are capped while they are received (IMAGE_MAX_REQUEST_MB).
+_IMAGE_UPLOAD_PATH_RE = re.compile(r'^/(subject/\d+/add|question/\d+/edit|api/slice-save(-batch)?)$')
+
+class ImageBodyLimit:
+    """ASGI middleware: 413 for image-upload requests over IMAGE_MAX_REQUEST_MB.
+
+    A declared Content-Length is refused before any of the body is read; otherwise
+    (chunked bodies, lying clients) the count stops the read as soon as it passes
+    the cap, while the form is still being parsed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or not _IMAGE_UPLOAD_PATH_RE.match(scope['path']):
+            return await self.app(scope, receive, send)
+        limit = int(IMAGE_MAX_REQUEST_MB * (1 << 20))
+        detail = f"Upload exceeds {IMAGE_MAX_REQUEST_MB:g} MB"
+        length = dict(scope['headers']).get(b'content-length', b'')
+        if length.isdigit() and int(length) > limit:
+            return await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+        received = 0
+
+        async def _receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit: raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, _receive, send)
+
+# Registered before request_db_scope so it runs inside it: an exception raised from
+# receive() outside a BaseHTTPMiddleware reaches the route wrapped in an ExceptionGroup.
+app.add_middleware(ImageBodyLimit)
+
+@app.middleware("http")
+async def request_db_scope(request: Request, call_next):
+    holder = _RequestDB()
+    token = _request_db.set(holder)
+    try:
+        return await call_next(request)
+    finally:
+        _request_db.reset(token)
+        holder.closed = True
+        if holder.conn is not None:
+            db_pool.release(holder.conn)
+            holder.conn = None
+
+# ==============================================================================
+# V3.1: Execution layer - keep blocking work off the asyncio event loop
+# ==============================================================================
+DB_THREADS = int(os.environ.get('DB_THREADS', DB_POOL_SIZE))
+MEDIA_PROCESSES = int(os.environ.get('MEDIA_PROCESSES', max(1, min(4, os.cpu_count() or 1))))
+# Decoded rasters held at once across all media workers; larger decodes queue for it
+MEDIA_DECODE_BUDGET_MB = float(os.environ.get('MEDIA_DECODE_BUDGET_MB', 512))
+
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='db')
+# spawn: workers import only media_worker, never this module (no init_db / app side effects)
+_media_mp = multiprocessing.get_context('spawn')
+media_executor = ProcessPoolExecutor(max_workers=MEDIA_PROCESSES, mp_context=_media_mp, initializer=media_worker.init_worker,
+                                     initargs=(_media_mp.Condition(), _media_mp.Value('q', 0, lock=False), int(MEDIA_DECODE_BUDGET_MB * (1 << 20))))
+
+async def run_db(fn, *args, **kwargs):
+    """Run blocking sqlite / file work on the DB thread pool.
+
+    The current context is copied so the worker thread shares the request's
+    pooled connection.
+    """
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(db_executor, functools.partial(ctx.run, fn, *args, **kwargs))
+
+async def run_cpu(fn, *args, **kwargs):
+    """Run CPU-heavy media work (PIL, pdf2image) on the process pool."""
+    return await asyncio.get_running_loop().run_in_executor(media_executor, functools.partial(fn, *args, **kwargs))
+
+@app.on_event("shutdown")
+def shutdown_executors():
+    media_executor.shutdown(wait=False, cancel_futures=True)
+    db_executor.shutdown(wait=False, cancel_futures=True)
+
+# ==============================================================================
+# V3.2: Single-writer mutation queue with group commit
+# ==============================================================================
+WRITE_QUEUE_SIZE = int(os.environ.get('WRITE_QUEUE_SIZE', 1024))
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 64))
+WRITE_BATCH_WAIT_MS = float(os.environ.get('WRITE_BATCH_WAIT_MS', 2))
+# A batch that cannot get the write lock (a direct writer such as an import holds it
+# past busy_timeout) is rolled back and retried with backoff instead of failing its callers.
+WRITE_RETRY_ATTEMPTS = int(os.environ.get('WRITE_RETRY_ATTEMPTS', 8))
+WRITE_RETRY_BASE_MS = float(os.environ.get('WRITE_RETRY_BASE_MS', 50))
+
+def is_lock_error(e: BaseException) -> bool:
+    return isinstance(e, sqlite3.OperationalError) and any(w in str(e).lower() for w in ('locked', 'busy'))
+
+class WriteQueue:
+    """Funnels small mutations through one writer connection.
+
+    Handlers submit `fn(conn)`; the writer task drains up to WRITE_BATCH_SIZE
+    of them, runs each inside its own SAVEPOINT (a failing mutation only rolls
+    back itself) and commits the whole batch once; a batch that loses the write
+    lock is retried whole. Each caller is acknowledged
+    only after that commit. The bounded queue makes submitters wait when the
+    writer falls behind.
+    """
+    def __init__(self, maxsize: int, batch_size: int, batch_wait_ms: float):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._conn = None
+        self._queue = None
+        self._task = None
+        self._loop = None
+        self.stats = {"submitted": 0, "committed": 0, "failed": 0, "batches": 0, "max_batch": 0, "commit_ms": 0.0, "retries": 0}
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+            self._task = loop.create_task(self._run())
+
+    async def submit(self, fn, *args):
+        """Queue `fn(conn, *args)` and wait until its batch is committed."""
+        self._ensure_started()
+        fut = self._loop.create_future()
+        await self._queue.put(((lambda conn: fn(conn, *args)), fut))
+        self.stats["submitted"] += 1
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0: break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+            fns = [fn for fn, _ in batch]
+            for attempt in range(WRITE_RETRY_ATTEMPTS + 1):
+                try:
+                    results = await loop.run_in_executor(self._executor, self._apply_batch, fns)
+                    break
+                except Exception as e:
+                    if attempt < WRITE_RETRY_ATTEMPTS and is_lock_error(e):
+                        # the batch was rolled back as a whole, so re-running every fn is safe
+                        self.stats["retries"] += 1
+                        await asyncio.sleep(min(2.0, WRITE_RETRY_BASE_MS / 1000 * 2 ** attempt) * (0.5 + random.random()))
+                        continue
+                    results = [(False, e)] * len(batch)
+                    break
+            for (_, fut), (ok, value) in zip(batch, results):
+                if fut.done(): continue
+                if ok: fut.set_result(value)
+                else: fut.set_exception(value)
+
+    def _apply_batch(self, fns):
+        if self._conn is None:
+            self._conn = db_pool._connect()
+        conn = self._conn
+        started = time.perf_counter()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn in fns:
+                conn.execute("SAVEPOINT write_item")
+                try:
+                    results.append((True, fn(conn)))
+                    conn.execute("RELEASE write_item")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_item")
+                    conn.execute("RELEASE write_item")
+                    results.append((False, e))
+            conn.commit()
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        self.stats["batches"] += 1
+        self.stats["committed"] += sum(1 for ok, _ in results if ok)
+        self.stats["failed"] += sum(1 for ok, _ in results if not ok)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(fns))
+        self.stats["commit_ms"] += (time.perf_counter() - started) * 1000
+        return results
+
+    def metrics(self):
+        return {**self.stats, "queued": self._queue.qsize() if self._queue else 0, "maxsize": self.maxsize}
+
+    def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._executor.shutdown(wait=True)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+write_queue = WriteQueue(WRITE_QUEUE_SIZE, WRITE_BATCH_SIZE, WRITE_BATCH_WAIT_MS)
+
+async def submit_write(fn, *args):
+    """Run `fn(conn, *args)` on the writer connection; returns its result once committed."""
+    return await write_queue.submit(fn, *args)
+
+async def write_execute(sql: str, params=()):
+    await submit_write(lambda conn: conn.execute(sql, params).rowcount)
+
+@app.on_event("startup")
+async def start_write_queue():
+    write_queue._ensure_started()
+
+@app.on_event("shutdown")
+def shutdown_write_queue():
+    write_queue.shutdown()
+
+# ==============================================================================
+# V3.2: Background jobs (backup / export / import / restore / distribute)
+# ==============================================================================
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_RETENTION_HOURS = float(os.environ.get('JOB_RETENTION_HOURS', 24))
+JOB_DIR = os.path.join(os.path.dirname(DB_PATH), 'jobs')
+os.makedirs(JOB_DIR, exist_ok=True)
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+
+class JobError(Exception):
+    """Expected job failure; the message is shown to the user as-is."""
+
+class JobContext:
+    """Handed to job functions for progress reporting and artifact placement."""
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.dir = os.path.join(JOB_DIR, job_id)
+        self.artifact_name = None
+        self._last = 0.0
+
+    def progress(self, done: int, total: Optional[int] = None, message: Optional[str] = None, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last < self.PROGRESS_INTERVAL: return
+        self._last = now
+        # Kept in memory: the job may itself hold the write lock (bulk import),
+        # so the row is only written on status transitions.
+        live = _job_live.setdefault(self.id, {})
+        live["progress_done"] = done
+        if total is not None: live["progress_total"] = total
+        if message is not None: live["message"] = message
+
+    def artifact_path(self, filename: str) -> str:
+        """Where the job should write its downloadable result."""
+        os.makedirs(self.dir, exist_ok=True)
+        self.artifact_name = filename
+        return os.path.join(self.dir, filename)
+
+def _now_str() -> str:
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+_job_live: dict = {}
+
+def _job_update(job_id: str, **fields):
+    if fields.get('status') in ('done', 'failed'):
+        fields = {**_job_live.pop(job_id, {}), **fields}
+    conn = get_db()
+    try:
+        conn.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?", list(fields.values()) + [job_id])
+        conn.commit()
+    finally:
+        conn.close()
+
+def _run_job(job_id: str, fn, args):
+    job = JobContext(job_id)
+    _job_update(job_id, status='running', started_at=_now_str())
+    try:
+        result = fn(job, *args)
+        _job_update(job_id, status='done', result=json.dumps(result, ensure_ascii=False, default=str),
+                    artifact=job.artifact_name, finished_at=_now_str())
+    except Exception as e:
+        if not isinstance(e, JobError):
+            print(f"Job {job_id} failed: {e}")
+        _job_update(job_id, status='failed', message=str(e), finished_at=_now_str())
+    finally:
+        purge_expired_jobs()
+
+def purge_expired_jobs():
+    # Same format as _now_str() so the string comparison with finished_at is chronological
+    cutoff = (datetime.now() - timedelta(hours=JOB_RETENTION_HOURS)).strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db()
+    try:
+        expired = [r['id'] for r in conn.execute("SELECT id FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (cutoff,))]
+        for job_id in expired:
+            shutil.rmtree(os.path.join(JOB_DIR, job_id), ignore_errors=True)
+        for chunk in chunked(expired):
+            conn.execute(f"DELETE FROM jobs WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+        conn.commit()
+    finally:
+        conn.close()
+
+async def submit_job(user, kind: str, fn, *args) -> JSONResponse:
+    """Persist a job row, hand `fn(job, *args)` to the job pool and answer 202 with its id."""
+    job_id = uuid.uuid4().hex
+    await submit_write(lambda conn: conn.execute("INSERT INTO jobs (id, user_id, kind, status) VALUES (?, ?, ?, 'queued')", (job_id, user['id'], kind)))
+    job_executor.submit(_run_job, job_id, fn, args)
+    return JSONResponse({"job_id": job_id, "status": "queued", "status_url": f"/api/jobs/{job_id}",
+                         "events_url": f"/api/jobs/{job_id}/events"}, status_code=202)
+
+def job_view(row) -> dict:
+    row = {**dict(row), **_job_live.get(row['id'], {})}
+    d = {k: row[k] for k in ('id', 'kind', 'status', 'message', 'created_at', 'started_at', 'finished_at')}
+    d["progress"] = {"done": row['progress_done'], "total": row['progress_total']}
+    d["result"] = json.loads(row['result']) if row['result'] else None
+    d["download_url"] = f"/api/jobs/{row['id']}/download" if row['artifact'] and row['status'] == 'done' else None
+    return d
+
+@app.on_event("shutdown")
+def shutdown_jobs():
+    job_executor.shutdown(wait=False, cancel_futures=True)
+
+# ==============================================================================
+# V3.2: Streaming ZIP archives (export / backup)
+# ==============================================================================
+# Media is already compressed; deflating it again only burns CPU.
+ZIP_STORED_EXTS = {'.webp', '.jpg', '.jpeg', '.png', '.gif', '.heic', '.mp4', '.webm', '.mov', '.m4v', '.zip'}
+ZIP_CHUNK = 256 * 1024
+
+class _ZipSink:
+    """Write-only, unseekable target for ZipFile; iter_zip drains it as it fills.
+
+    Without seek() ZipFile writes each entry's sizes in a trailing data
+    descriptor, so nothing ever has to be rewritten in place.
+    """
+    def __init__(self):
+        self._parts = []; self._pos = 0; self.pending = 0
+
+    def write(self, b) -> int:
+        self._parts.append(bytes(b)); n = len(b); self._pos += n; self.pending += n
+        return n
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        out = b''.join(self._parts); self._parts = []; self.pending = 0
+        return out
+
+def json_chunks(data):
+    """Encode `data` as UTF-8 JSON in ~ZIP_CHUNK pieces instead of one big string."""
+    buf = []; n = 0
+    for part in json.JSONEncoder(ensure_ascii=False).iterencode(data):
+        buf.append(part); n += len(part)
+        if n >= ZIP_CHUNK:
+            yield ''.join(buf).encode('utf-8'); buf = []; n = 0
+    if buf: yield ''.join(buf).encode('utf-8')
+
+def _zip_source(src):
+    if isinstance(src, bytes):
+        yield src
+    elif isinstance(src, str):
+        with open(src, 'rb') as f:
+            while True:
+                chunk = f.read(ZIP_CHUNK)
+                if not chunk: return
+                yield chunk
+    else:
+        yield from src
+
+def iter_zip(entries):
+    """Yield a ZIP archive chunk by chunk from (arcname, source) pairs.
+
+    A source is bytes, a file path (skipped if missing) or an iterable of byte
+    chunks. Media extensions are STORED, everything else DEFLATED; repeated
+    arcnames are written once. Memory stays around ZIP_CHUNK whatever the size.
+    """
+    sink = _ZipSink(); seen = set()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for arcname, src in entries:
+            if arcname in seen: continue
+            if isinstance(src, str):
+                try: st = os.stat(src)
+                except OSError: continue
+                zi = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6]); size = st.st_size
+            else:
+                zi = zipfile.ZipInfo(arcname, time.localtime()[:6]); size = 0
+            seen.add(arcname)
+            zi.compress_type = zipfile.ZIP_STORED if os.path.splitext(arcname)[1].lower() in ZIP_STORED_EXTS else zipfile.ZIP_DEFLATED
+            with zf.open(zi, 'w', force_zip64=size > zipfile.ZIP64_LIMIT) as w:
+                for chunk in _zip_source(src):
+                    w.write(chunk)
+                    if sink.pending >= ZIP_CHUNK: yield sink.drain()
+            if sink.pending >= ZIP_CHUNK: yield sink.drain()
+    yield sink.drain()
+
+def write_zip(path: str, entries):
+    with open(path, 'wb') as f:
+        for chunk in iter_zip(entries): f.write(chunk)
+
+def zip_response(entries, filename: str) -> StreamingResponse:
+    quoted = quote(filename)
+    disposition = f'attachment; filename="{filename}"' if quoted == filename else f"attachment; filename*=utf-8''{quoted}"
+    return StreamingResponse(iter_zip(entries), media_type="application/zip", headers={"Content-Disposition": disposition})
+
+def image_entries(questions):
+    for q in questions:
+        for img in q['images']:
+            yield f"uploads/{img['path']}", os.path.join(UPLOAD_DIR, img['path'])
+
+# ==============================================================================
+# V3.2: Whole-server snapshots (SQLite online backup + hard-linked uploads)
+# ==============================================================================
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(os.path.dirname(DB_PATH), 'snapshots'))
+SNAPSHOT_PAGES = int(os.environ.get('SNAPSHOT_PAGES', 1024))
+SNAPSHOT_KEEP = int(os.environ.get('SNAPSHOT_KEEP', 7))
+SNAPSHOT_INTERVAL_HOURS = float(os.environ.get('SNAPSHOT_INTERVAL_HOURS', 0))
+_snapshot_lock = threading.Lock()
+_snapshot_task = None
+
+def take_snapshot(progress=None) -> dict:
+    """Copy the live database and UPLOAD_DIR into SNAPSHOT_DIR/<timestamp>/.
+
+    The database goes through the online backup API in SNAPSHOT_PAGES steps while
+    a read transaction pins one WAL snapshot: writers keep committing and the copy
+    is never restarted by them. Uploads are immutable once written, so they are
+    hard-linked (copied when SNAPSHOT_DIR is on another filesystem). To restore,
+    stop the app and copy study_pro.db and uploads/ back into place.
+    """
+    if not _snapshot_lock.acquire(blocking=False):
+        raise JobError("A snapshot is already running")
+    name = datetime.now().strftime('%Y%m%d-%H%M%S')
+    final = os.path.join(SNAPSHOT_DIR, name); work = final + '.partial'
+    try:
+        if os.path.exists(final): raise JobError("Snapshot already exists")
+        os.makedirs(work, exist_ok=True)
+        t0 = time.perf_counter()
+        db_file = os.path.join(work, os.path.basename(DB_PATH))
+        src = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        dst = sqlite3.connect(db_file)
+        try:
+            src.execute("BEGIN")
+            src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            src.backup(dst, pages=SNAPSHOT_PAGES,
+                       progress=(lambda status, remaining, total: progress(total - remaining, total)) if progress else None)
+            src.execute("COMMIT")
+            check = dst.execute("PRAGMA quick_check").fetchone()[0]
+        finally:
+            dst.close(); src.close()
+        if check != 'ok': raise JobError(f"Snapshot integrity check failed: {check}")
+        db_ms = (time.perf_counter() - t0) * 1000
+
+        files = {}; linked = copied = 0
+        for root, _dirs, names in os.walk(UPLOAD_DIR):
+            rel_root = os.path.relpath(root, UPLOAD_DIR)
+            os.makedirs(os.path.join(work, 'uploads', rel_root), exist_ok=True)
+            for fn in names:
+                rel = os.path.normpath(os.path.join(rel_root, fn)); src_path = os.path.join(root, fn); dst_path = os.path.join(work, 'uploads', rel)
+                try:
+                    st = os.stat(src_path)
+                    try:
+                        os.link(src_path, dst_path); linked += 1
+                    except OSError:
+                        shutil.copy2(src_path, dst_path); copied += 1
+                except FileNotFoundError:
+                    continue  # deleted while we were walking
+                files[rel] = [st.st_size, int(st.st_mtime)]
+
+        summary = {"name": name, "created_at": _now_str(), "db_bytes": os.path.getsize(db_file), "db_ms": round(db_ms, 1),
+                   "files": len(files), "upload_bytes": sum(f[0] for f in files.values()), "linked": linked, "copied": copied}
+        with open(os.path.join(work, 'manifest.json'), 'w') as f:
+            json.dump({**summary, "uploads": files}, f)
+        os.rename(work, final)
+        summary["removed"] = rotate_snapshots()
+        return summary
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+    finally:
+        _snapshot_lock.release()
+
+def list_snapshots() -> List[dict]:
+    """Completed snapshots, newest first."""
+    out = []
+    if not os.path.isdir(SNAPSHOT_DIR): return out
+    for name in sorted(os.listdir(SNAPSHOT_DIR), reverse=True):
+        path = os.path.join(SNAPSHOT_DIR, name, 'manifest.json')
+        if name.endswith('.partial') or not os.path.exists(path): continue
+        with open(path) as f: m = json.load(f)
+        m.pop('uploads', None); m['name'] = name
+        out.append(m)
+    return out
+
+def rotate_snapshots() -> List[str]:
+    """Drop completed snapshots beyond SNAPSHOT_KEEP and leftovers of interrupted runs.
+
+    Only called by take_snapshot() after its own rename, under _snapshot_lock, so
+    any remaining .partial directory is stale.
+    """
+    removed = [s['name'] for s in list_snapshots()[SNAPSHOT_KEEP:]]
+    removed += [n for n in os.listdir(SNAPSHOT_DIR) if n.endswith('.partial')]
+    for name in removed:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, name), ignore_errors=True)
+    return removed
+
+async def _snapshot_scheduler():
+    interval = SNAPSHOT_INTERVAL_HOURS * 3600
+    while True:
+        latest = list_snapshots()[:1]
+        last = os.path.getmtime(os.path.join(SNAPSHOT_DIR, latest[0]['name'])) if latest else 0
+        await asyncio.sleep(max(0.0, last + interval - time.time()))
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(job_executor, take_snapshot)
+            print(f"Scheduled snapshot {result['name']}: {result['db_bytes']} bytes, {result['files']} files")
+        except Exception as e:
+            print(f"Scheduled snapshot failed: {e}")
+            await asyncio.sleep(min(interval, 600))
+
+@app.on_event("startup")
+async def start_snapshot_scheduler():
+    global _snapshot_task
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    if SNAPSHOT_INTERVAL_HOURS > 0 and _snapshot_task is None:
+        _snapshot_task = asyncio.create_task(_snapshot_scheduler())
+
+@app.on_event("shutdown")
+async def stop_snapshot_scheduler():
+    global _snapshot_task
+    if _snapshot_task is not None:
+        _snapshot_task.cancel(); _snapshot_task = None
+
+# V3.1: Per-(user, subject, grade) dashboard counters, kept exact by triggers so every
+# write path (add, slice, import, clone, delete, /api/record) updates them inside
+# its own transaction.
+COUNTER_BUCKET = "user_id IS {r}.user_id AND subject_id IS {r}.subject_id AND grade IS {r}.grade"
+COUNTER_STATUS = "EXISTS (SELECT 1 FROM user_question_status WHERE user_id = {r}.user_id AND question_id = {r}.id AND {cond})"
+COUNTER_ROW = '''(SELECT sc.rowid FROM questions q JOIN subject_counters sc
+                 ON sc.user_id IS q.user_id AND sc.subject_id IS q.subject_id AND sc.grade IS q.grade
+                 WHERE q.id = {r}.question_id AND q.user_id = {r}.user_id)'''
+
+def _counter_ensure(r):
+    return f"INSERT INTO subject_counters (user_id, subject_id, grade) SELECT {r}.user_id, {r}.subject_id, {r}.grade WHERE NOT EXISTS (SELECT 1 FROM subject_counters WHERE {COUNTER_BUCKET.format(r=r)});"
+
+def _counter_add(r, sign):
+    wrong = COUNTER_STATUS.format(r=r, cond="wrong_count > 0")
+    difficult = COUNTER_STATUS.format(r=r, cond="is_difficult = 1")
+    return f"UPDATE subject_counters SET total = total {sign} 1, wrong = wrong {sign} {wrong}, difficult = difficult {sign} {difficult} WHERE {COUNTER_BUCKET.format(r=r)};"
+
+COUNTER_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_q_insert AFTER INSERT ON questions BEGIN
+        {_counter_ensure('NEW')}
+        {_counter_add('NEW', '+')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_q_delete AFTER DELETE ON questions BEGIN
+        {_counter_add('OLD', '-')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_q_move AFTER UPDATE OF user_id, subject_id, grade ON questions
+    WHEN OLD.user_id IS NOT NEW.user_id OR OLD.subject_id IS NOT NEW.subject_id OR OLD.grade IS NOT NEW.grade BEGIN
+        {_counter_add('OLD', '-')}
+        {_counter_ensure('NEW')}
+        {_counter_add('NEW', '+')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_uqs_insert AFTER INSERT ON user_question_status BEGIN
+        UPDATE subject_counters SET wrong = wrong + (IFNULL(NEW.wrong_count, 0) > 0), difficult = difficult + (IFNULL(NEW.is_difficult, 0) = 1)
+        WHERE rowid = {COUNTER_ROW.format(r='NEW')};
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_uqs_update AFTER UPDATE OF wrong_count, is_difficult ON user_question_status BEGIN
+        UPDATE subject_counters
+        SET wrong = wrong + (IFNULL(NEW.wrong_count, 0) > 0) - (IFNULL(OLD.wrong_count, 0) > 0),
+            difficult = difficult + (IFNULL(NEW.is_difficult, 0) = 1) - (IFNULL(OLD.is_difficult, 0) = 1)
+        WHERE rowid = {COUNTER_ROW.format(r='NEW')};
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_uqs_delete AFTER DELETE ON user_question_status BEGIN
+        UPDATE subject_counters SET wrong = wrong - (IFNULL(OLD.wrong_count, 0) > 0), difficult = difficult - (IFNULL(OLD.is_difficult, 0) = 1)
+        WHERE rowid = {COUNTER_ROW.format(r='OLD')};
+    END''',
+]
+
+# V3.2: External-content FTS index over the searchable question columns
+FTS_COLUMNS = ['question_text', 'option_a', 'option_b', 'option_c', 'option_d', 'analysis', 'source']
+FTS_WEIGHTS = [10.0, 2.0, 2.0, 2.0, 2.0, 1.0, 1.0]
+FTS_ENABLED = False
+
+def _fts_row(r, delete=False):
+    cols = ', '.join(FTS_COLUMNS)
+    vals = ', '.join(f"{r}.{col}" for col in FTS_COLUMNS)
+    if delete:
+        return f"INSERT INTO questions_fts (questions_fts, rowid, {cols}) VALUES ('delete', {r}.id, {vals});"
+    return f"INSERT INTO questions_fts (rowid, {cols}) VALUES ({r}.id, {vals});"
+
+FTS_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS trg_fts_q_insert AFTER INSERT ON questions BEGIN
+        {_fts_row('NEW')}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_fts_q_delete AFTER DELETE ON questions BEGIN
+        {_fts_row('OLD', delete=True)}
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_fts_q_update AFTER UPDATE OF {', '.join(FTS_COLUMNS)} ON questions BEGIN
+        {_fts_row('OLD', delete=True)}
+        {_fts_row('NEW')}
+    END''',
+]
+
+SQLITE_MAX_VARS = 900
+
+def chunked(seq, size=SQLITE_MAX_VARS):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+# V3.2: Content-addressed media store. Question images are stored in UPLOAD_DIR as
+# <sha1 of bytes><ext>, so identical files exist once and clone / distribute /
+# import only add question_images rows. `media` counts the rows pointing at each
+# file (kept exact by triggers); gc_media() unlinks a file only after it has been
+# unreferenced for MEDIA_GC_GRACE_MINUTES. Anything that stores or reuses a file
+# first pins it with pin_media(), which restarts that grace period, so uploads
+# and imports that are between storing the file and committing their row are safe.
+MEDIA_GC_GRACE_MINUTES = float(os.environ.get('MEDIA_GC_GRACE_MINUTES', 60))
+MEDIA_GC_INTERVAL_MINUTES = float(os.environ.get('MEDIA_GC_INTERVAL_MINUTES', 30))
+_MEDIA_NAME_RE = re.compile(r'^([0-9a-f]{40})\.[a-z0-9]+$')
+_media_gc_task = None
+
+MEDIA_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS trg_media_qi_insert AFTER INSERT ON question_images BEGIN
+        INSERT INTO media (name, refcount) VALUES (NEW.path, 1)
+        ON CONFLICT(name) DO UPDATE SET refcount = refcount + 1, released_at = NULL;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_media_qi_delete AFTER DELETE ON question_images BEGIN
+        UPDATE media SET refcount = refcount - 1,
+            released_at = CASE WHEN refcount <= 1 THEN datetime('now', 'localtime') ELSE released_at END
+        WHERE name = OLD.path;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_media_qi_update AFTER UPDATE OF path ON question_images
+        WHEN OLD.path IS NOT NEW.path BEGIN
+        UPDATE media SET refcount = refcount - 1,
+            released_at = CASE WHEN refcount <= 1 THEN datetime('now', 'localtime') ELSE released_at END
+        WHERE name = OLD.path;
+        INSERT INTO media (name, refcount) VALUES (NEW.path, 1)
+        ON CONFLICT(name) DO UPDATE SET refcount = refcount + 1, released_at = NULL;
+    END''',
+    # foreign_keys is off, so ON DELETE CASCADE never fired and image rows outlived their question
+    '''CREATE TRIGGER IF NOT EXISTS trg_media_q_delete AFTER DELETE ON questions BEGIN
+        DELETE FROM question_images WHERE question_id = OLD.id;
+    END''',
+]
+
+def file_sha1(full_path: str) -> str:
+    h = hashlib.sha1()
+    try:
+        with open(full_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    except OSError:
+        return ''
+    return h.hexdigest()
+
+def media_tmp_path(ext: str = '.webp') -> str:
+    """Scratch path inside UPLOAD_DIR, so store_media() can rename it into place atomically."""
+    return os.path.join(UPLOAD_DIR, f".tmp-{uuid.uuid4().hex}{ext}")
+
+def pin_media(names, conn=None):
+    """Protect `names` from gc_media() for a full grace period before they are (re)used.
+
+    Unreferenced rows get a fresh released_at (a missing row is created that way),
+    so a file whose row is never committed is still collected later. gc_media()
+    checks and unlinks under the write lock, so once this has run the files seen
+    on disk stay there. Without `conn` the pins are committed on their own
+    connection, one executemany per IMPORT_CHUNK_SIZE names.
+    """
+    names = list(names)
+    if not names: return
+    own = conn is None
+    conn = conn or get_db()
+    try:
+        for chunk in chunked(names, IMPORT_CHUNK_SIZE):
+            conn.executemany("""INSERT INTO media (name, refcount, released_at) VALUES (?, 0, datetime('now', 'localtime'))
+                                ON CONFLICT(name) DO UPDATE SET released_at = CASE WHEN refcount <= 0 THEN excluded.released_at ELSE released_at END""",
+                             [(n,) for n in chunk])
+            if own: conn.commit()
+    finally:
+        if own: conn.close()
+
+def store_media(tmp_path: str, ext: str = '.webp', digest: Optional[str] = None, conn=None) -> str:
+    """Move a finished file into the store under its content hash and return the stored name.
+
+    The name is pinned (on `conn` when given) before the rename, so an existing
+    copy that gc_media() was about to collect is kept and simply replaced with
+    the same bytes.
+    """
+    digest = digest or file_sha1(tmp_path)
+    name = f"{digest}{ext}"
+    pin_media([name], conn)
+    os.replace(tmp_path, os.path.join(UPLOAD_DIR, name))
+    return name
+
+def rebuild_media_refs(conn):
+    """Recompute media refcounts from question_images (drift repair / first migration)."""
+    conn.execute('''INSERT INTO media (name, refcount) SELECT path, COUNT(*) FROM question_images WHERE true GROUP BY path
+                    ON CONFLICT(name) DO UPDATE SET refcount = excluded.refcount, released_at = NULL''')
+    conn.execute('''UPDATE media SET refcount = 0, released_at = COALESCE(released_at, datetime('now', 'localtime'))
+                    WHERE name NOT IN (SELECT path FROM question_images)''')
+
+def migrate_media_store(conn):
+    """Rename legacy uuid-named images to their content hash, merging identical files."""
+    conn.execute("DELETE FROM question_images WHERE question_id NOT IN (SELECT id FROM questions)")
+    paths = [r[0] for r in conn.execute("SELECT DISTINCT path FROM question_images")]
+    renamed = 0
+    for path in paths:
+        if _MEDIA_NAME_RE.match(path): continue
+        full = os.path.join(UPLOAD_DIR, os.path.basename(path))
+        digest = file_sha1(full)
+        if not digest: continue
+        name = store_media(full, os.path.splitext(path)[1].lower() or '.webp', digest, conn)
+        conn.execute("UPDATE question_images SET path = ? WHERE path = ?", (name, path))
+        renamed += 1
+    return renamed
+
+def gc_media() -> dict:
+    """Unlink files unreferenced for longer than the grace period, plus stale scratch files.
+
+    Candidates are re-checked and unlinked inside one BEGIN IMMEDIATE per batch,
+    so a concurrent pin_media() or new reference either lands first (and the file
+    is kept) or waits until the file and its row are gone. Files modified within
+    the grace period are left alone whatever their row says.
+    """
+    cutoff = time.time() - MEDIA_GC_GRACE_MINUTES * 60
+    removed, freed, after = 0, 0, ''
+
+    def _unlink(name):
+        size = 0
+        for full in [os.path.join(UPLOAD_DIR, name)] + [os.path.join(MEDIA_CACHE_DIR, str(w), name) for w in IMAGE_VARIANT_WIDTHS]:
+            try:
+                n = os.path.getsize(full); os.remove(full); size += n
+            except FileNotFoundError:
+                pass
+        return size
+
+    conn = get_db()
+    try:
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                names = [r['name'] for r in conn.execute("""SELECT name FROM media WHERE refcount <= 0 AND released_at < datetime('now', 'localtime', ?)
+                                                            AND name > ? ORDER BY name LIMIT ?""",
+                                                         (f"{-MEDIA_GC_GRACE_MINUTES:+} minutes", after, SQLITE_MAX_VARS))]
+                if not names:
+                    conn.commit()
+                    break
+                after = names[-1]
+                gone = []
+                for name in names:
+                    try:
+                        if os.path.getmtime(os.path.join(UPLOAD_DIR, os.path.basename(name))) >= cutoff: continue
+                    except OSError:
+                        pass
+                    freed += _unlink(os.path.basename(name)); gone.append(name)
+                if gone:
+                    conn.execute(f"DELETE FROM media WHERE refcount <= 0 AND name IN ({','.join('?' * len(gone))})", gone)
+                conn.commit()
+                removed += len(gone)
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        conn.close()
+    for name in os.listdir(UPLOAD_DIR):
+        if not name.startswith('.tmp-'): continue
+        try:
+            if os.path.getmtime(os.path.join(UPLOAD_DIR, name)) >= cutoff: continue
+        except OSError:
+            continue
+        freed += _unlink(name); removed += 1
+    return {"removed": removed, "bytes": freed}
+
+async def _media_gc_loop():
+    while True:
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(job_executor, gc_media)
+            if result['removed']: print(f"Media GC: removed {result['removed']} files, {result['bytes']} bytes")
+        except Exception as e:
+            print(f"Media GC failed: {e}")
+        await asyncio.sleep(MEDIA_GC_INTERVAL_MINUTES * 60)
+
+@app.on_event("startup")
+async def start_media_gc():
+    global _media_gc_task
+    if MEDIA_GC_INTERVAL_MINUTES > 0 and _media_gc_task is None:
+        _media_gc_task = asyncio.create_task(_media_gc_loop())
+
+@app.on_event("shutdown")
+async def stop_media_gc():
+    global _media_gc_task
+    if _media_gc_task is not None:
+        _media_gc_task.cancel(); _media_gc_task = None
+
+# V3.2: Content fingerprints for duplicate detection. Text is NFKC-normalized with
+# whitespace collapsed; images contribute the hash of their bytes, so image-only
+# questions deduplicate too.
+FINGERPRINT_FIELDS = ['question_text', 'option_a', 'option_b', 'option_c', 'option_d', 'correct_answer']
+_WS_RE = re.compile(r'\s+')
+
+def normalize_text(value) -> str:
+    return _WS_RE.sub(' ', unicodedata.normalize('NFKC', str(value or ''))).strip()
+
+def image_digest(path: str, data: Optional[bytes] = None) -> str:
+    """sha1 of an image's bytes (from `data`, else the file under UPLOAD_DIR); '' if unavailable.
+
+    Content-addressed names already are the digest, so no file is read for them.
+    """
+    if data is not None:
+        return hashlib.sha1(data).hexdigest()
+    m = _MEDIA_NAME_RE.match(os.path.basename(path))
+    if m: return m.group(1)
+    return file_sha1(os.path.join(UPLOAD_DIR, os.path.basename(path)))
+
+def question_fingerprint(q, images) -> str:
+    """`q` is a question row/dict, `images` a list of (image_type, digest) in display order."""
+    parts = [normalize_text(q.get(f) if isinstance(q, dict) else q[f]) for f in FINGERPRINT_FIELDS]
+    parts[-1] = parts[-1].upper()
+    parts += [f"{t}:{d}" for t, d in images]
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+def refresh_question_fingerprints(conn, q_ids):
+    """Recompute and store content_hash for the given questions from their rows and image files."""
+    for chunk in chunked(list(q_ids)):
+        ph = ','.join('?' * len(chunk))
+        rows = conn.execute(f"SELECT id, {', '.join(FINGERPRINT_FIELDS)} FROM questions WHERE id IN ({ph})", chunk).fetchall()
+        imgs = {}
+        for r in conn.execute(f"SELECT question_id, path, image_type FROM question_images WHERE question_id IN ({ph}) ORDER BY id", chunk):
+            imgs.setdefault(r['question_id'], []).append((r['image_type'], image_digest(r['path'])))
+        conn.executemany("UPDATE questions SET content_hash = ? WHERE id = ?",
+                         [(question_fingerprint(r, imgs.get(r['id'], [])), r['id']) for r in rows])
+        update_question_lsh(conn, [(r['id'], r['question_text']) for r in rows])
+
+def refresh_question_fingerprint(conn, qid):
+    refresh_question_fingerprints(conn, [qid])
+
+def find_duplicate(conn, user_id, subject_id, fingerprint):
+    row = conn.execute("SELECT id FROM questions WHERE user_id = ? AND subject_id = ? AND content_hash = ? LIMIT 1",
+                       (user_id, subject_id, fingerprint)).fetchone()
+    return row['id'] if row else None
+
+# V3.2: Near-duplicate detection - MinHash over character 3-shingles of the question
+# text (after stripping punctuation / LaTeX syntax), banded into an LSH table so
+# candidates are found by index lookups instead of pairwise comparison.
+LSH_BANDS = 8
+LSH_ROWS = 4
+NEAR_DUP_THRESHOLD = float(os.environ.get('NEAR_DUP_THRESHOLD', 0.8))
+NEAR_DUP_WARN = os.environ.get('NEAR_DUP_WARN', '1') == '1'
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(0x5eed)
+_MINHASH_PERMS = [(_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME)) for _ in range(LSH_BANDS * LSH_ROWS)]
+
+def text_shingles(text, k=3):
+    t = ''.join(ch for ch in normalize_text(text).lower() if unicodedata.category(ch)[0] in 'LN')
+    if len(t) < k: return set()
+    return {t[i:i + k] for i in range(len(t) - k + 1)}
+
+def lsh_buckets(shingles):
+    """[(band, bucket)] for a shingle set; empty when the text is too short to compare."""
+    if not shingles: return []
+    base = [int.from_bytes(hashlib.blake2b(sh.encode('utf-8'), digest_size=8).digest(), 'big') for sh in shingles]
+    sig = [min((a * x + b) % _MINHASH_PRIME for x in base) for a, b in _MINHASH_PERMS]
+    out = []
+    for band in range(LSH_BANDS):
+        key = ','.join(map(str, sig[band * LSH_ROWS:(band + 1) * LSH_ROWS])).encode()
+        out.append((band, int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big', signed=True)))
+    return out
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+def update_question_lsh(conn, rows):
+    """Re-index (id, question_text) pairs in question_lsh."""
+    rows = list(rows)
+    for chunk in chunked([r[0] for r in rows]):
+        conn.execute(f"DELETE FROM question_lsh WHERE question_id IN ({','.join('?' * len(chunk))})", chunk)
+    conn.executemany("INSERT OR IGNORE INTO question_lsh (band, bucket, question_id) VALUES (?, ?, ?)",
+                     [(band, bucket, qid) for qid, text in rows for band, bucket in lsh_buckets(text_shingles(text))])
+
+def find_near_duplicates(conn, user_id, subject_id, text, exclude_id=None, threshold=None):
+    """[(question_id, similarity)] of this user's questions in the subject that look like `text`."""
+    shingles = text_shingles(text)
+    buckets = lsh_buckets(shingles)
+    if not buckets: return []
+    cond = ' OR '.join(['(l.band = ? AND l.bucket = ?)'] * len(buckets))
+    params = [v for bb in buckets for v in bb] + [user_id, subject_id, exclude_id or 0]
+    cands = conn.execute(f'''
+        SELECT DISTINCT q.id, q.question_text FROM question_lsh l JOIN questions q ON q.id = l.question_id
+        WHERE ({cond}) AND q.user_id = ? AND q.subject_id = ? AND q.id != ?
+    ''', params).fetchall()
+    threshold = NEAR_DUP_THRESHOLD if threshold is None else threshold
+    hits = [(r['id'], round(jaccard(shingles, text_shingles(r['question_text'])), 3)) for r in cands]
+    return sorted([h for h in hits if h[1] >= threshold], key=lambda h: -h[1])
+
+LSH_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS trg_lsh_q_delete AFTER DELETE ON questions BEGIN
+        DELETE FROM question_lsh WHERE question_id = OLD.id;
+    END''',
+]
+
+def rebuild_subject_counters(conn, user_id: Optional[int] = None):
+    """Recompute subject_counters from scratch (drift repair / first migration)."""
+    cond, params = (" WHERE q.user_id = ?", [user_id]) if user_id is not None else ("", [])
+    conn.execute("DELETE FROM subject_counters" + (" WHERE user_id = ?" if user_id is not None else ""), params)
+    conn.execute(f'''
+        INSERT INTO subject_counters (user_id, subject_id, grade, total, wrong, difficult)
+        SELECT q.user_id, q.subject_id, q.grade, COUNT(*),
+               SUM(IFNULL(uqs.wrong_count, 0) > 0), SUM(IFNULL(uqs.is_difficult, 0) = 1)
+        FROM questions q
+        LEFT JOIN user_question_status uqs ON uqs.question_id = q.id AND uqs.user_id = q.user_id{cond}
+        GROUP BY q.user_id, q.subject_id, q.grade
+    ''', params)
+
+# V3.2: Daily study rollups (subject_id 0 = question no longer exists / unfiled)
+def rebuild_daily_stats(conn, user_id: Optional[int] = None):
+    """Recompute study_daily_stats from study_records."""
+    cond, params = (" WHERE r.user_id = ?", [user_id]) if user_id is not None else ("", [])
+    conn.execute("DELETE FROM study_daily_stats" + (" WHERE user_id = ?" if user_id is not None else ""), params)
+    conn.execute(f'''
+        INSERT INTO study_daily_stats (user_id, day, subject_id, attempts, correct)
+        SELECT r.user_id, date(r.studied_at), IFNULL(q.subject_id, 0), COUNT(*), SUM(r.is_correct = 1)
+        FROM study_records r LEFT JOIN questions q ON q.id = r.question_id{cond}
+        GROUP BY r.user_id, date(r.studied_at), IFNULL(q.subject_id, 0)
+    ''', params)
 
 def init_db():
     conn = get_db()
@@ -169,7 +1229,7 @@ def init_db():
     c.execute("CREATE INDEX IF NOT EXISTS idx_paper_assig_user_pid ON paper_assignments (user_id, paper_id)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_uqs_user_qid ON user_question_status (user_id, question_id)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_records_user_date ON study_records (user_id, studied_at)")
-    
+
     # Default Admin
     admin_hash = pwd_context.hash("admin123")
     c.execute("INSERT OR IGNORE INTO users (username, password_hash, role) VALUES (?, ?, ?)", ("admin", admin_hash, "admin"))
@@ -227,12 +1287,215 @@ def init_db():
 
     except Exception as e:
         print(f"Migration Global Error: {e}")
-        
+
+    # V3.1: Materialized dashboard counters
+    has_counters = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'subject_counters'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS subject_counters (
+        user_id INTEGER,
+        subject_id INTEGER,
+        grade TEXT,
+        total INTEGER NOT NULL DEFAULT 0,
+        wrong INTEGER NOT NULL DEFAULT 0,
+        difficult INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_subject_counters_key ON subject_counters (user_id, subject_id, grade)")
+    for ddl in COUNTER_TRIGGERS:
+        c.execute(ddl)
+    if not has_counters:
+        print("Migrating: Building subject_counters...")
+        rebuild_subject_counters(conn)
+
+    # V3.2: Daily study rollups
+    has_daily = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'study_daily_stats'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS study_daily_stats (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        subject_id INTEGER NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        correct INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day, subject_id)
+    )''')
+    if not has_daily:
+        print("Migrating: Building study_daily_stats...")
+        rebuild_daily_stats(conn)
+    
+    # V3.2: Persistent study sessions (seeded deal + cursor per user/subject/mode/qtype/grade)
+    c.execute('''CREATE TABLE IF NOT EXISTS study_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        subject_id INTEGER NOT NULL,
+        mode TEXT NOT NULL,
+        qtype TEXT NOT NULL,
+        grade TEXT NOT NULL DEFAULT '',
+        seed INTEGER NOT NULL,
+        deck BLOB NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        cursor INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (user_id, subject_id, mode, qtype, grade)
+    )''')
+
+    # V3.2: Background jobs; anything unfinished at startup died with the old process
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        progress_done INTEGER NOT NULL DEFAULT 0,
+        progress_total INTEGER NOT NULL DEFAULT 0,
+        message TEXT,
+        result TEXT,
+        artifact TEXT,
+        created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id, created_at)")
+    c.execute("UPDATE jobs SET status = 'failed', message = 'Interrupted by restart', finished_at = datetime('now', 'localtime') WHERE status IN ('queued', 'running')")
+
+    # V3.2: Backup manifests, the base for incremental backups
+    c.execute('''CREATE TABLE IF NOT EXISTS backup_manifests (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        base_id TEXT,
+        questions INTEGER NOT NULL DEFAULT 0,
+        images INTEGER NOT NULL DEFAULT 0,
+        data TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_backup_manifests_user ON backup_manifests (user_id, created_at)")
+
+    # V3.2: Near-duplicate LSH index + dismissed pairs (the admin review queue)
+    has_lsh = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'question_lsh'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS question_lsh (
+        band INTEGER NOT NULL,
+        bucket INTEGER NOT NULL,
+        question_id INTEGER NOT NULL,
+        PRIMARY KEY (band, bucket, question_id)
+    ) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_question_lsh_qid ON question_lsh (question_id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS near_duplicate_dismissals (
+        question_id_a INTEGER NOT NULL,
+        question_id_b INTEGER NOT NULL,
+        dismissed_by INTEGER,
+        dismissed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (question_id_a, question_id_b)
+    )''')
+    for ddl in LSH_TRIGGERS:
+        c.execute(ddl)
+    if not has_lsh:
+        print("Migrating: Building question_lsh...")
+        update_question_lsh(conn, c.execute("SELECT id, question_text FROM questions").fetchall())
+
+    # V3.2: Content fingerprints
+    q_cols = [col[1] for col in c.execute("PRAGMA table_info(questions)").fetchall()]
+    if 'content_hash' not in q_cols:
+        print("Migrating: Adding content_hash column to questions...")
+        c.execute("ALTER TABLE questions ADD COLUMN content_hash TEXT")
+        refresh_question_fingerprints(conn, [r[0] for r in c.execute("SELECT id FROM questions").fetchall()])
+    # Not UNIQUE: existing banks already contain duplicates that must keep loading
+    c.execute("CREATE INDEX IF NOT EXISTS idx_questions_fingerprint ON questions (user_id, subject_id, content_hash)")
+
+    # V3.2: Full-text search (trigram handles CJK + LaTeX substrings without a segmenter)
+    global FTS_ENABLED
+    has_fts = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'questions_fts'").fetchone()
+    try:
+        c.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+            {', '.join(FTS_COLUMNS)}, content='questions', content_rowid='id', tokenize='trigram'
+        )''')
+        for ddl in FTS_TRIGGERS:
+            c.execute(ddl)
+        if not has_fts:
+            print("Migrating: Building questions_fts...")
+            c.execute("INSERT INTO questions_fts (questions_fts) VALUES ('rebuild')")
+        FTS_ENABLED = True
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 trigram unavailable, search falls back to LIKE: {e}")
+        FTS_ENABLED = False
+
+    # V3.2: Content-addressed media store + reference counts
+    has_media = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'media'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS media (
+        name TEXT PRIMARY KEY,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+        released_at TIMESTAMP
+    ) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_media_released ON media (released_at) WHERE refcount <= 0")
+    if not has_media:
+        print("Migrating: Moving images into the content-addressed store...")
+        migrate_media_store(conn)
+    for ddl in MEDIA_TRIGGERS:
+        c.execute(ddl)
+    if not has_media:
+        rebuild_media_refs(conn)
+
     conn.commit()
     conn.close()
 
 init_db()
 
+# ==============================================================================
+# V3.1: In-process caches
+# ==============================================================================
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))
+
+class TTLCache:
+    """Thread-safe LRU cache with a bounded size and per-entry expiry."""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None: del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop_where(self, pred):
+        with self._lock:
+            for key in [k for k, (_, v) in self._data.items() if pred(k, v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def metrics(self):
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+# Authenticated users keyed by token subject (username)
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def invalidate_user(uid: Optional[int] = None, username: Optional[str] = None):
+    if username is not None:
+        user_cache.pop(username)
+    if uid is not None:
+        user_cache.pop_where(lambda k, v: v['id'] == uid)
+
 # Auth Helpers
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -247,12 +1510,21 @@ async def get_current_user(request: Request):
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None: return None
-        conn = get_db()
-        user = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
-        conn.close()
-        return dict(user) if user else None
+        user = user_cache.get(username)
+        if user is None:
+            user = await run_db(load_user, username)
+            if user is None: return None
+            user_cache.set(username, user)
+        # Handlers get their own copy so they can never mutate the cached entry
+        return dict(user)
     except JWTError: return None
 
+def load_user(username: str):
+    conn = get_db()
+    user = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+    conn.close()
+    return dict(user) if user else None
+
 def auth_required(func):
     async def wrapper(*args, **kwargs):
         request = kwargs.get('request')
@@ -261,59 +1533,235 @@ def auth_required(func):
         kwargs['user'] = user
         return await func(*args, **kwargs)
     return wrapper
-def get_app_name():
+def db_fetchone(sql: str, params=()):
     conn = get_db()
-    res = conn.execute("SELECT value FROM config WHERE key='app_name'").fetchone()
-    conn.close()
+    try:
+        return conn.execute(sql, params).fetchone()
+    finally:
+        conn.close()
+
+def db_fetchall(sql: str, params=()):
+    conn = get_db()
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+# Reference data (app name, subject / paper lists, user list) rarely changes but is
+# read on nearly every page. Entries carry the version they were loaded under;
+# write routes bump the version so stale loads are never served.
+REF_CACHE_SIZE = int(os.environ.get('REF_CACHE_SIZE', 4096))
+REF_CACHE_TTL = float(os.environ.get('REF_CACHE_TTL', 600))
+ref_cache = TTLCache(REF_CACHE_SIZE, REF_CACHE_TTL)
+_ref_versions = {}
+_ref_versions_lock = threading.Lock()
+
+def ref_cached(key, loader):
+    with _ref_versions_lock:
+        version = _ref_versions.get(key, 0)
+    hit = ref_cache.get(key)
+    if hit is not None and hit[0] == version:
+        return hit[1]
+    value = loader()
+    ref_cache.set(key, (version, value))
+    return value
+
+def invalidate_ref(*keys):
+    with _ref_versions_lock:
+        for key in keys:
+            _ref_versions[key] = _ref_versions.get(key, 0) + 1
+    for key in keys:
+        ref_cache.pop(key)
+
+def _load_app_name():
+    res = db_fetchone("SELECT value FROM config WHERE key='app_name'")
     return res[0] if res else "深度学习 V3.0"
 
-def get_question_data(conn, q_id, user_id=None):
-    if user_id:
-        q = conn.execute('''
-            SELECT q.*, 
-                   COALESCE(uqs.wrong_count, 0) as user_wrong_count,
-                   COALESCE(uqs.history_wrong, 0) as user_history_wrong,
-                   COALESCE(uqs.is_difficult, 0) as user_is_difficult,
-                   uqs.user_id as uqs_user_id
-            FROM questions q 
-            LEFT JOIN paper_assignments pa ON q.paper_id = pa.paper_id AND pa.user_id = ?
-            LEFT JOIN user_question_status uqs ON q.id = uqs.question_id AND uqs.user_id = ?
-            WHERE q.id = ? AND (q.user_id = ? OR pa.user_id = ?)
-        ''', (user_id, user_id, q_id, user_id, user_id)).fetchone()
-    else:
-        q = conn.execute("SELECT *, NULL as user_wrong_count, NULL as user_history_wrong, NULL as user_is_difficult, NULL as uqs_user_id FROM questions WHERE id = ?", (q_id,)).fetchone()
-    
-    if not q: return None
-    d = dict(q)
-    # Overwrite with per-user stats if available
-    if 'user_wrong_count' in d:
-        d['wrong_count'] = d['user_wrong_count']
-        d['history_wrong'] = d['user_history_wrong']
-        d['is_difficult'] = d['user_is_difficult']
-        d['has_record'] = d['uqs_user_id'] is not None
-    
-    d['q_imgs'] = [f"/static/uploads/{os.path.basename(r['path'])}" for r in conn.execute('SELECT path FROM question_images WHERE question_id = ? AND image_type = "question"', (q_id,)).fetchall()]
-    d['a_imgs'] = [f"/static/uploads/{os.path.basename(r['path'])}" for r in conn.execute('SELECT path FROM question_images WHERE question_id = ? AND image_type = "answer"', (q_id,)).fetchall()]
-    
-    # Process Video URL
-    v = d.get('answer_video')
-    if v and not v.startswith('http'):
-        d['video_url'] = f"/static/uploads/videos/{v}"
-    else:
-        d['video_url'] = v
-        
-    return d
+def get_app_name():
+    return ref_cached(('app_name',), _load_app_name)
 
-@app.get("/login", response_class=HTMLResponse)
-async def login_page(request: Request):
-    return templates.TemplateResponse(request, "login.html", {"app_name": get_app_name()})
+def get_user_subjects(uid: int):
+    return ref_cached(('subjects', uid), lambda: [dict(r) for r in db_fetchall("SELECT * FROM subjects WHERE user_id = ? ORDER BY name", (uid,))])
 
-@app.post("/login")
-async def login(username: str = Form(...), password: str = Form(...)):
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
-    conn.close()
-    if not user or not pwd_context.verify(password, user['password_hash']):
+def get_user_papers(uid: int):
+    return ref_cached(('papers', uid), lambda: [dict(r) for r in db_fetchall("SELECT * FROM papers WHERE user_id = ? ORDER BY created_at DESC", (uid,))])
+
+def get_all_users():
+    """All accounts, newest first (no password hashes)."""
+    return ref_cached(('users',), lambda: [dict(r) for r in db_fetchall("SELECT id, username, role, display_name, created_at FROM users ORDER BY created_at DESC")])
+
+def get_questions_data(conn, q_ids, user_id=None):
+    """Hydrate many questions in a constant number of queries (per 900 ids).
+
+    Returns dicts in the order of `q_ids`; ids the user cannot access are dropped.
+    """
+    q_ids = list(dict.fromkeys(q_ids))
+    rows = {}
+    imgs = {}
+    for chunk in chunked(q_ids):
+        ph = ','.join('?' * len(chunk))
+        if user_id:
+            found = conn.execute(f'''
+                SELECT q.*, 
+                       COALESCE(uqs.wrong_count, 0) as user_wrong_count,
+                       COALESCE(uqs.history_wrong, 0) as user_history_wrong,
+                       COALESCE(uqs.is_difficult, 0) as user_is_difficult,
+                       uqs.user_id as uqs_user_id
+                FROM questions q 
+                LEFT JOIN paper_assignments pa ON q.paper_id = pa.paper_id AND pa.user_id = ?
+                LEFT JOIN user_question_status uqs ON q.id = uqs.question_id AND uqs.user_id = ?
+                WHERE q.id IN ({ph}) AND (q.user_id = ? OR pa.user_id = ?)
+            ''', [user_id, user_id] + chunk + [user_id, user_id]).fetchall()
+        else:
+            found = conn.execute(f"SELECT *, NULL as user_wrong_count, NULL as user_history_wrong, NULL as user_is_difficult, NULL as uqs_user_id FROM questions WHERE id IN ({ph})", chunk).fetchall()
+        for r in found:
+            rows[r['id']] = r
+        # Question and answer images for the whole chunk in one pass
+        for r in conn.execute(f"SELECT question_id, path, image_type FROM question_images WHERE question_id IN ({ph}) ORDER BY id", chunk).fetchall():
+            imgs.setdefault((r['question_id'], r['image_type']), []).append(r['path'])
+
+    result = []
+    for q_id in q_ids:
+        q = rows.get(q_id)
+        if not q: continue
+        d = dict(q)
+        # Overwrite with per-user stats if available
+        if 'user_wrong_count' in d:
+            d['wrong_count'] = d['user_wrong_count']
+            d['history_wrong'] = d['user_history_wrong']
+            d['is_difficult'] = d['user_is_difficult']
+            d['has_record'] = d['uqs_user_id'] is not None
+        
+        for kind, key in (('question', 'q'), ('answer', 'a')):
+            paths = imgs.get((q_id, kind), [])
+            d[f'{key}_imgs'] = [media_url(p) for p in paths]
+            d[f'{key}_img_variants'] = [media_variants(p) for p in paths]
+        
+        # Process Video URL
+        v = d.get('answer_video')
+        if v and not v.startswith('http'):
+            d['video_url'] = f"/static/uploads/videos/{v}"
+        else:
+            d['video_url'] = v
+        result.append(d)
+    return result
+
+# V3.2: Responsive image variants. Narrower renditions of stored images are made on
+# first request by /media/{width}/{name} and cached under MEDIA_CACHE_DIR (outside
+# UPLOAD_DIR, so snapshots skip them). Stored names are content hashes, so a cached
+# variant never goes stale and is served as immutable.
+IMAGE_VARIANT_WIDTHS = sorted(int(w) for w in os.environ.get('IMAGE_VARIANT_WIDTHS', '320,800').split(',') if w.strip())
+MEDIA_CACHE_DIR = os.environ.get('MEDIA_CACHE_DIR', os.path.join(os.path.dirname(DB_PATH), 'cache', 'variants'))
+IMAGE_SIZES_CONTENT = "(max-width: 820px) 100vw, 800px"
+for _w in IMAGE_VARIANT_WIDTHS:
+    os.makedirs(os.path.join(MEDIA_CACHE_DIR, str(_w)), exist_ok=True)
+_render_inflight = {}
+
+async def render_once(dst: str, fn, *args):
+    """Run `fn(*args)` on the media pool to produce `dst` unless it exists; concurrent callers share one render.
+
+    Returns True only for the caller that actually started the render.
+    """
+    if os.path.exists(dst): return False
+    fut = _render_inflight.get(dst)
+    started = fut is None
+    if started:
+        fut = asyncio.ensure_future(run_cpu(fn, *args))
+        _render_inflight[dst] = fut
+        fut.add_done_callback(lambda _f: _render_inflight.pop(dst, None))
+    await asyncio.shield(fut)
+    return started
+
+def media_url(path: str, width: Optional[int] = None) -> str:
+    name = os.path.basename(path)
+    return f"/media/{width}/{name}" if width else f"/static/uploads/{name}"
+
+@functools.lru_cache(maxsize=8192)
+def _media_width_cached(name: str) -> int:
+    # Raises for missing / unreadable files, which lru_cache does not remember
+    with Image.open(os.path.join(UPLOAD_DIR, name)) as img:
+        return img.width
+
+def media_width(name: str) -> Optional[int]:
+    """Pixel width of a stored image, read from its header (names are content hashes, so it never goes stale).
+
+    None while the file is missing or unreadable; only successful reads are cached.
+    """
+    try:
+        return _media_width_cached(os.path.basename(name))
+    except OSError:
+        return None
+
+def media_srcset(path: str) -> str:
+    """Variant candidates narrower than the original, plus the original at its real width."""
+    width = media_width(os.path.basename(path)) or IMAGE_MAX_SIDE
+    return ", ".join([f"{media_url(path, w)} {w}w" for w in IMAGE_VARIANT_WIDTHS if w < width] + [f"{media_url(path)} {width}w"])
+
+def media_img_attrs(path: str, sizes: str = IMAGE_SIZES_CONTENT) -> Markup:
+    """`src`, `srcset`, `sizes` and lazy loading for an <img>.
+
+    The src fallback is the smallest variant wider than the thumbnail width
+    (IMAGE_VARIANT_WIDTHS[0]), or the original when there is none or the image
+    is not wider than it.
+    """
+    fallback = next((w for w in IMAGE_VARIANT_WIDTHS if w > IMAGE_VARIANT_WIDTHS[0]), None)
+    if fallback and fallback >= (media_width(os.path.basename(path)) or IMAGE_MAX_SIDE): fallback = None
+    return Markup(f'src="{escape(media_url(path, fallback))}" srcset="{escape(media_srcset(path))}" sizes="{escape(sizes)}" loading="lazy" decoding="async"')
+
+def media_variants(path: str) -> dict:
+    return {"src": media_url(path), "srcset": media_srcset(path), "thumb": media_url(path, IMAGE_VARIANT_WIDTHS[0]) if IMAGE_VARIANT_WIDTHS else media_url(path)}
+
+templates.env.globals.update(media_url=media_url, media_srcset=media_srcset, media_img_attrs=media_img_attrs,
+                             image_sizes=IMAGE_SIZES_CONTENT)
+
+# V3.2: Study decks ship the full id order plus one hydrated window; the page pulls
+# further windows from /api/deck, so first paint does not scale with bank size.
+DECK_WINDOW = int(os.environ.get('DECK_WINDOW', 20))
+DECK_MAX_WINDOW = 200
+
+def deck_context(conn, ids, user_id, start=0):
+    return {"deck_ids": ids, "deck_window": DECK_WINDOW, "deck_start": start,
+            "questions": get_questions_data(conn, ids[start:start + DECK_WINDOW], user_id)}
+
+# Decks are stored as packed uint32 ids; the seed makes a deal reproducible.
+def pack_deck(ids):
+    return array('I', ids).tobytes()
+
+def unpack_deck(blob):
+    deck = array('I'); deck.frombytes(blob)
+    return deck.tolist()
+
+def deal_deck(ids, seed):
+    """Fisher-Yates shuffle in Python - O(n) on the id list, no ORDER BY RANDOM() sort."""
+    ids = list(ids)
+    random.Random(seed).shuffle(ids)
+    return ids
+
+def get_question_data(conn, q_id, user_id=None):
+    found = get_questions_data(conn, [q_id], user_id)
+    return found[0] if found else None
+
+@app.get("/media/{width}/{name}")
+async def media_variant(width: int, name: str):
+    name = os.path.basename(name); src = os.path.join(UPLOAD_DIR, name)
+    if width not in IMAGE_VARIANT_WIDTHS or not os.path.isfile(src):
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    dst = os.path.join(MEDIA_CACHE_DIR, str(width), name)
+    await render_once(dst, media_worker.make_variant, src, dst, width, IMAGE_WEBP_QUALITY, IMAGE_WEBP_METHOD)
+    cache = "public, max-age=31536000, immutable" if _MEDIA_NAME_RE.match(name) else "public, max-age=3600"
+    return FileResponse(dst, media_type="image/webp", headers={"Cache-Control": cache})
+
+@app.get("/login", response_class=HTMLResponse)
+async def login_page(request: Request):
+    return templates.TemplateResponse(request, "login.html", {"app_name": await run_db(get_app_name)})
+
+@app.post("/login")
+async def login(username: str = Form(...), password: str = Form(...)):
+    def _check():
+        user = load_user(username)
+        # pbkdf2 is deliberately slow; run it in the worker thread too
+        return bool(user) and pwd_context.verify(password, user['password_hash'])
+    if not await run_db(_check):
         return RedirectResponse("/login?error=invalid", status_code=303)
     token = create_access_token(data={"sub": username})
     response = RedirectResponse("/", status_code=303)
@@ -326,6 +1774,177 @@ async def logout():
     response.delete_cookie("access_token")
     return response
 
+# ==============================================================================
+# V3.2: Bulk import pipeline (question bundles and paper bundles)
+# ==============================================================================
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 500))
+IMPORT_IO_THREADS = int(os.environ.get('IMPORT_IO_THREADS', 8))
+# Gap between chunk transactions. SQLite's busy handler sleeps up to 100ms between
+# lock attempts, so a shorter gap lets back-to-back chunks starve waiting writers.
+IMPORT_CHUNK_PAUSE_MS = float(os.environ.get('IMPORT_CHUNK_PAUSE_MS', 120))
+IMPORT_MAX_ERRORS = 50
+
+def extract_bundle_image(zf, path) -> Optional[tuple]:
+    """Copy one bundle image to a scratch file in UPLOAD_DIR; returns (scratch path, stored name).
+
+    None when the member is missing or unreadable.
+    """
+    ext = os.path.splitext(os.path.basename(path))[1].lower() or '.webp'
+    tmp = media_tmp_path(ext); h = hashlib.sha1()
+    try:
+        with zf.open(f"uploads/{path}") as zsrc, open(tmp, 'wb') as zdst:
+            for block in iter(lambda: zsrc.read(1 << 20), b''):
+                h.update(block); zdst.write(block)
+        return tmp, f"{h.hexdigest()}{ext}"
+    except KeyError:
+        pass
+    except Exception as e:
+        print(f"Import image error ({path}): {e}")
+    if os.path.exists(tmp): os.remove(tmp)
+    return None
+
+def extract_bundle_images(zf, paths, stats=None):
+    """Store bundle images; returns {bundle path: stored name or None}.
+
+    Content-addressed names are pinned in one batch and reused when already on
+    disk. The rest are extracted and hashed in parallel, pinned in a second
+    batch and only then renamed into place. With `stats`, reused files count as
+    images_skipped and extracted ones as images_written.
+    """
+    pin_media(sorted({os.path.basename(p) for p in paths if _MEDIA_NAME_RE.match(os.path.basename(p))}))
+    stored = {p: os.path.basename(p) for p in paths
+              if _MEDIA_NAME_RE.match(os.path.basename(p)) and os.path.exists(os.path.join(UPLOAD_DIR, os.path.basename(p)))}
+    todo = [p for p in paths if p not in stored]
+    with ThreadPoolExecutor(max_workers=IMPORT_IO_THREADS, thread_name_prefix='import-io') as pool:
+        spooled = dict(zip(todo, pool.map(lambda p: extract_bundle_image(zf, p), todo)))
+    try:
+        pin_media(sorted({r[1] for r in spooled.values() if r}))
+        for path, r in spooled.items():
+            if r: os.replace(r[0], os.path.join(UPLOAD_DIR, r[1]))
+    finally:
+        for r in spooled.values():
+            if r and os.path.exists(r[0]): os.remove(r[0])
+    if stats is not None:
+        stats['images_skipped'] += len(stored)
+        stats['images_written'] += sum(1 for r in spooled.values() if r)
+    stored.update({path: r[1] if r else None for path, r in spooled.items()})
+    return stored
+
+def resolve_tag_ids(conn, subject_id, names):
+    """{name: tag id} for a subject, creating missing tags in one executemany."""
+    tag_map = {r['name']: r['id'] for r in conn.execute("SELECT id, name FROM tags WHERE subject_id = ?", (subject_id,))}
+    missing = sorted({n for n in names if n and n not in tag_map})
+    if missing:
+        conn.executemany("INSERT INTO tags (name, subject_id) VALUES (?, ?)", [(n, subject_id) for n in missing])
+        tag_map = {r['name']: r['id'] for r in conn.execute("SELECT id, name FROM tags WHERE subject_id = ?", (subject_id,))}
+    return tag_map
+
+def bulk_import_questions(conn, zf, questions, user_id, subject_id, paper_id=None, keep_video=False, progress=None):
+    """Insert exported question dicts in chunks; returns import stats.
+
+    Everything that only reads (image extraction, fingerprints, the duplicate and
+    near-duplicate checks, row building) happens before any write lock is taken.
+    Each chunk then gets its own short BEGIN IMMEDIATE: fingerprints are re-checked
+    against rows committed meanwhile, ids are allocated and the rows go in with
+    executemany and are committed, so other writers only ever wait for one chunk
+    (the pause between chunks gives them their turn).
+    A failing chunk is retried row by row so one bad row only costs itself.
+    `progress(done, total)` is called after every chunk.
+    """
+    total = len(questions)
+    stats = {"total": total, "success": 0, "duplicate": 0, "near_duplicate": 0, "failed": 0, "errors": []}
+    stored = extract_bundle_images(zf, list(dict.fromkeys(img['path'] for q in questions for img in q.get('images', []))))
+
+    def _fail(index, e):
+        stats["failed"] += 1
+        if len(stats["errors"]) < IMPORT_MAX_ERRORS:
+            stats["errors"].append({"index": index, "error": str(e)})
+
+    if conn.in_transaction:
+        conn.commit()
+    seen = {r[0] for r in conn.execute("SELECT content_hash FROM questions WHERE user_id = ? AND subject_id = ? AND content_hash IS NOT NULL", (user_id, subject_id))}
+
+    # Build rows without ids (validation errors are per-row failures)
+    prepared = []
+    for index, q in enumerate(questions):
+        try:
+            images = [(stored.get(img['path']), img['path'], img['image_type']) for img in q.get('images', [])]
+            fp = question_fingerprint(q, [(t, image_digest(name) if name else '') for name, _, t in images])
+            if fp in seen:
+                stats["duplicate"] += 1
+                continue
+            seen.add(fp)
+            if NEAR_DUP_WARN and find_near_duplicates(conn, user_id, subject_id, q.get('question_text')):
+                stats["near_duplicate"] += 1
+            prepared.append((index, {
+                "question": (subject_id, paper_id, user_id, q['question_text'], q['question_type'], q['correct_answer'],
+                             q.get('option_a'), q.get('option_b'), q.get('option_c'), q.get('option_d'), q.get('source'),
+                             q.get('answer_video') if keep_video else None, q.get('grade'), q.get('analysis'), fp),
+                "images": [(name or path, t) for name, path, t in images],
+                "tags": list(dict.fromkeys(t for t in q.get('tags', []) if t)),
+                "text": q['question_text'],
+            }))
+        except Exception as e:
+            _fail(index, e)
+
+    if prepared:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tag_map = resolve_tag_ids(conn, subject_id, {t for _, r in prepared for t in r["tags"]})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _write(rows):
+        # Called under the chunk's write lock, so MAX(id) cannot move underneath us
+        next_id = conn.execute("SELECT MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'questions'), 0), IFNULL((SELECT MAX(id) FROM questions), 0))").fetchone()[0] + 1
+        ids = range(next_id, next_id + len(rows))
+        conn.executemany('''INSERT INTO questions (id, subject_id, paper_id, user_id, question_text, question_type, correct_answer,
+                              option_a, option_b, option_c, option_d, source, answer_video, grade, analysis, content_hash)
+                              VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', [(qid, *r["question"]) for qid, r in zip(ids, rows)])
+        conn.executemany("INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)",
+                         [(qid, path, t) for qid, r in zip(ids, rows) for path, t in r["images"]])
+        conn.executemany("INSERT OR IGNORE INTO question_tags (question_id, tag_id) VALUES (?, ?)",
+                         [(qid, tag_map[t]) for qid, r in zip(ids, rows) for t in r["tags"] if t in tag_map])
+        update_question_lsh(conn, [(qid, r["text"]) for qid, r in zip(ids, rows)])
+
+    done = total - len(prepared)
+    for chunk in chunked(prepared, IMPORT_CHUNK_SIZE):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another writer may have added the same content since the rows were built
+            hashes = [r["question"][-1] for _, r in chunk]
+            taken = {row[0] for row in conn.execute(f"SELECT content_hash FROM questions WHERE user_id = ? AND subject_id = ? AND content_hash IN ({','.join('?' * len(hashes))})",
+                                                    (user_id, subject_id, *hashes))}
+            stats["duplicate"] += sum(h in taken for h in hashes)
+            rows = [(index, r) for index, r in chunk if r["question"][-1] not in taken]
+            conn.execute("SAVEPOINT import_chunk")
+            try:
+                _write([r for _, r in rows])
+                conn.execute("RELEASE import_chunk")
+                stats["success"] += len(rows)
+            except Exception:
+                conn.execute("ROLLBACK TO import_chunk"); conn.execute("RELEASE import_chunk")
+                for index, r in rows:
+                    conn.execute("SAVEPOINT import_row")
+                    try:
+                        _write([r])
+                        conn.execute("RELEASE import_row")
+                        stats["success"] += 1
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO import_row"); conn.execute("RELEASE import_row")
+                        _fail(index, e)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        done += len(chunk)
+        if progress: progress(done, total)
+        if done < total: time.sleep(IMPORT_CHUNK_PAUSE_MS / 1000)
+    if progress and not prepared: progress(total, total)
+    return stats
+
 def process_question_tags(conn, qid: int, subject_id: int, tags_str: Optional[str]):
     # V2.5.0: Tagging System Helper
     conn.execute("DELETE FROM question_tags WHERE question_id = ?", (qid,))
@@ -347,171 +1966,287 @@ def process_question_tags(conn, qid: int, subject_id: int, tags_str: Optional[st
 async def index(request: Request):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db(); c = conn.cursor()
     active_grade = unquote(request.cookies.get('active_grade', ''))
+
+    def _load():
+        conn = get_db(); c = conn.cursor()
+
+        # Base conditions
+        q_cond = " AND (q.grade = ? OR q.grade IS NULL)" if active_grade else ""
+        p_cond = " AND (p.grade = ? OR p.grade IS NULL)" if active_grade else ""
+        p_params = [active_grade] if active_grade else []
     
-    # Base conditions
-    q_cond = " AND (q.grade = ? OR q.grade IS NULL)" if active_grade else ""
-    p_cond = " AND (p.grade = ? OR p.grade IS NULL)" if active_grade else ""
-    p_params = [active_grade] if active_grade else []
-    
-    # Total count: owned + assigned
-    total_q = c.execute(f'''
-        SELECT COUNT(DISTINCT q.id) FROM questions q 
-        LEFT JOIN paper_assignments pa ON q.paper_id = pa.paper_id AND pa.user_id = ?
-        WHERE (q.user_id = ? OR pa.user_id = ?){q_cond}
-    ''', [user['id'], user['id'], user['id']] + p_params).fetchone()[0]
+        # V3.1: Owned counts come from subject_counters; only the assigned part is counted live
+        g_cond = " AND (grade = ? OR grade IS NULL)" if active_grade else ""
+        counters = {r['subject_id']: r for r in c.execute(f'''
+            SELECT subject_id, SUM(total) as total, SUM(wrong) as wrong
+            FROM subject_counters WHERE user_id = ?{g_cond}
+            GROUP BY subject_id
+        ''', [user['id']] + p_params)}
+        assigned_q = c.execute(f'''
+            SELECT COUNT(DISTINCT q.id) FROM paper_assignments pa
+            JOIN questions q ON q.paper_id = pa.paper_id
+            WHERE pa.user_id = ? AND q.user_id IS NOT ?{q_cond}
+        ''', [user['id'], user['id']] + p_params).fetchone()[0]
+        total_q = sum(r['total'] for r in counters.values()) + assigned_q
     
-    today_q = c.execute("SELECT COUNT(*) FROM study_records WHERE user_id = ? AND date(studied_at) = date('now', 'localtime')", (user['id'],)).fetchone()[0]
-    recs = c.execute("SELECT COUNT(*) as total, SUM(CASE WHEN is_correct=1 THEN 1 ELSE 0 END) as ok FROM study_records WHERE user_id = ?", (user['id'],)).fetchone()
-    acc = round(recs['ok'] / recs['total'] * 100, 1) if recs['total'] and recs['total'] > 0 else 0
+        # V3.2: Today / accuracy from the daily rollup instead of scanning study_records
+        today_q = c.execute("SELECT IFNULL(SUM(attempts), 0) FROM study_daily_stats WHERE user_id = ? AND day = date('now', 'localtime')", (user['id'],)).fetchone()[0]
+        recs = c.execute("SELECT SUM(attempts) as total, SUM(correct) as ok FROM study_daily_stats WHERE user_id = ?", (user['id'],)).fetchone()
+        acc = round(recs['ok'] / recs['total'] * 100, 1) if recs['total'] and recs['total'] > 0 else 0
     
-    # Subjects list: owned subjects (Optimized Query)
-    # Use LEFT JOINs and GROUP BY instead of correlated subqueries for much better performance
-    subs_query = f'''
-        SELECT 
-            s.id, s.name, s.user_id, s.created_at,
-            COUNT(DISTINCT q.id) as q_count,
-            COUNT(DISTINCT CASE WHEN uqs.wrong_count > 0 THEN uqs.question_id END) as wrong_count
-        FROM subjects s 
-        LEFT JOIN questions q ON s.id = q.subject_id AND q.user_id = ?{q_cond}
-        LEFT JOIN user_question_status uqs ON q.id = uqs.question_id AND uqs.user_id = ?
-        WHERE s.user_id = ?
-        GROUP BY s.id
-        ORDER BY s.name
-    '''
-    subs = c.execute(subs_query, [user['id']] + p_params + [user['id'], user['id']]).fetchall()
+        # Subjects list: cached owned subjects + counters
+        subs = []
+        for sub in get_user_subjects(user['id']):
+            cnt = counters.get(sub['id'])
+            subs.append({**sub, "q_count": cnt['total'] if cnt else 0, "wrong_count": cnt['wrong'] if cnt else 0})
     
-    distributed = c.execute(f'''SELECT p.*, s.name as s_name FROM paper_assignments pa 
-                                JOIN papers p ON pa.paper_id = p.id 
-                                JOIN subjects s ON p.subject_id = s.id
-                                WHERE pa.user_id = ?{p_cond}''', [user['id']] + p_params).fetchall()
-    conn.close()
-    return templates.TemplateResponse(request, "index.html", {"app_name": get_app_name(), "user": user, "subjects": [dict(s) for s in subs], "distributed": [dict(p) for p in distributed], "stats": {"total": total_q, "today": today_q, "accuracy": acc}})
+        distributed = c.execute(f'''SELECT p.*, s.name as s_name FROM paper_assignments pa 
+                                    JOIN papers p ON pa.paper_id = p.id 
+                                    JOIN subjects s ON p.subject_id = s.id
+                                    WHERE pa.user_id = ?{p_cond}''', [user['id']] + p_params).fetchall()
+        conn.close()
+        return {"app_name": get_app_name(), "user": user, "subjects": subs, "distributed": [dict(p) for p in distributed], "stats": {"total": total_q, "today": today_q, "accuracy": acc}}
+
+    return templates.TemplateResponse(request, "index.html", await run_db(_load))
 
 @app.post("/subject/add")
 async def add_subject(request: Request, name: str = Form(...)):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db(); conn.execute("INSERT OR IGNORE INTO subjects (name, user_id) VALUES (?, ?)", (name.strip(), user['id'])); conn.commit(); conn.close()
+    await write_execute("INSERT OR IGNORE INTO subjects (name, user_id) VALUES (?, ?)", (name.strip(), user['id']))
+    invalidate_ref(('subjects', user['id']))
     return RedirectResponse("/", status_code=303)
 
 @app.post("/subject/delete/{sid}")
 async def delete_subject(request: Request, sid: int):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db(); conn.execute("DELETE FROM subjects WHERE id = ? AND user_id = ?", (sid, user['id']))
-    conn.commit(); conn.close()
+    await write_execute("DELETE FROM subjects WHERE id = ? AND user_id = ?", (sid, user['id']))
+    invalidate_ref(('subjects', user['id']))
     return RedirectResponse("/settings", status_code=303)
 
 @app.get("/subject/{sid}", response_class=HTMLResponse)
 async def subject(request: Request, sid: int, sort: Optional[str] = None):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db()
-    s = conn.execute("SELECT * FROM subjects WHERE id = ? AND user_id = ?", (sid, user['id'])).fetchone()
-    if not s: conn.close(); raise HTTPException(404)
-    active_grade = unquote(request.cookies.get('active_grade', ''))
-    q_cond = " AND (q.grade = ? OR q.grade IS NULL)" if active_grade else ""
-    
-    # Base parameters for the query
-    query_params = [user['id'], sid]
-    if active_grade:
-        query_params.append(active_grade)
-    query_params.append(user['id'])
+
+    def _load():
+        conn = get_db()
+        s = conn.execute("SELECT * FROM subjects WHERE id = ? AND user_id = ?", (sid, user['id'])).fetchone()
+        if not s: conn.close(); raise HTTPException(404)
+        active_grade = unquote(request.cookies.get('active_grade', ''))
+        q_cond = " AND (q.grade = ? OR q.grade IS NULL)" if active_grade else ""
     
-    query = f'''
-        SELECT q.*, 
-               uqs.wrong_count as user_wrong_count, 
-               uqs.is_difficult as user_is_difficult, 
-               uqs.history_wrong as user_history_wrong,
-               uqs.user_id as uqs_uid
-        FROM questions q
-        LEFT JOIN user_question_status uqs ON q.id = uqs.question_id AND uqs.user_id = ?
-        WHERE q.subject_id = ? 
-        AND q.paper_id IS NULL{q_cond}
-        AND (
-            q.user_id = ? 
-            OR 
-            (uqs.wrong_count > 0 OR uqs.is_difficult = 1 OR uqs.history_wrong = 1)
-        )
-    '''
+        # Base parameters for the query
+        query_params = [user['id'], sid]
+        if active_grade:
+            query_params.append(active_grade)
+        query_params.append(user['id'])
     
-    if sort == 'type':
-        query += " ORDER BY q.question_type ASC, q.created_at DESC"
-    elif sort == 'status':
-        # Status Priority: 1. Wrong (wrong_count > 0, ordered by count) -> 2. Difficult (is_difficult=1) -> 3. Others
-        query += '''
-            ORDER BY 
-                CASE 
-                    WHEN COALESCE(uqs.wrong_count, 0) > 0 THEN 1 
-                    WHEN COALESCE(uqs.is_difficult, 0) = 1 THEN 2 
-                    ELSE 3 
-                END ASC,
-                COALESCE(uqs.wrong_count, 0) DESC,
-                q.created_at DESC
+        query = f'''
+            SELECT q.*, 
+                   uqs.wrong_count as user_wrong_count, 
+                   uqs.is_difficult as user_is_difficult, 
+                   uqs.history_wrong as user_history_wrong,
+                   uqs.user_id as uqs_uid
+            FROM questions q
+            LEFT JOIN user_question_status uqs ON q.id = uqs.question_id AND uqs.user_id = ?
+            WHERE q.subject_id = ? 
+            AND q.paper_id IS NULL{q_cond}
+            AND (
+                q.user_id = ? 
+                OR 
+                (uqs.wrong_count > 0 OR uqs.is_difficult = 1 OR uqs.history_wrong = 1)
+            )
         '''
-    else:
-        query += " ORDER BY q.created_at DESC"
+    
+        if sort == 'type':
+            query += " ORDER BY q.question_type ASC, q.created_at DESC"
+        elif sort == 'status':
+            # Status Priority: 1. Wrong (wrong_count > 0, ordered by count) -> 2. Difficult (is_difficult=1) -> 3. Others
+            query += '''
+                ORDER BY 
+                    CASE 
+                        WHEN COALESCE(uqs.wrong_count, 0) > 0 THEN 1 
+                        WHEN COALESCE(uqs.is_difficult, 0) = 1 THEN 2 
+                        ELSE 3 
+                    END ASC,
+                    COALESCE(uqs.wrong_count, 0) DESC,
+                    q.created_at DESC
+            '''
+        else:
+            query += " ORDER BY q.created_at DESC"
         
-    qs = conn.execute(query, query_params).fetchall()
+        qs = conn.execute(query, query_params).fetchall()
     
-    # Process for template
-    questions = []
-    for r in qs:
-        d = dict(r)
-        if d['user_wrong_count'] is not None:
-            d['wrong_count'] = d['user_wrong_count']
-        if d['user_is_difficult'] is not None:
-             d['is_difficult'] = d['user_is_difficult']
-        if d['user_history_wrong'] is not None:
-            d['history_wrong'] = d['user_history_wrong']
+        # Process for template
+        questions = []
+        for r in qs:
+            d = dict(r)
+            if d['user_wrong_count'] is not None:
+                d['wrong_count'] = d['user_wrong_count']
+            if d['user_is_difficult'] is not None:
+                 d['is_difficult'] = d['user_is_difficult']
+            if d['user_history_wrong'] is not None:
+                d['history_wrong'] = d['user_history_wrong']
             
-        d['has_record'] = d['uqs_uid'] is not None
-        questions.append(d)
+            d['has_record'] = d['uqs_uid'] is not None
+            questions.append(d)
 
-    # V1.3.5: Calculate Stats
-    stats = {
-        "total": len(questions),
-        "wrong": sum(1 for q in questions if q.get('wrong_count', 0) > 0),
-        "difficult": sum(1 for q in questions if q.get('is_difficult') == 1)
-    }
+        # V1.3.5: Calculate Stats
+        stats = {
+            "total": len(questions),
+            "wrong": sum(1 for q in questions if q.get('wrong_count', 0) > 0),
+            "difficult": sum(1 for q in questions if q.get('is_difficult') == 1)
+        }
 
-    conn.close()
-    return templates.TemplateResponse(request, "subject.html", {"app_name": get_app_name(), "user": user, "subject": dict(s), "questions": questions, "stats": stats})
+        conn.close()
+        return {"app_name": get_app_name(), "user": user, "subject": dict(s), "questions": questions, "stats": stats}
 
-async def save_img(f: UploadFile) -> str:
-    ext = os.path.splitext(f.filename)[1].lower(); uid = uuid.uuid4().hex; img_name = f"{uid}.webp"; tmp = f"/tmp/{uid}{ext}"
-    with open(tmp, "wb") as out: shutil.copyfileobj(f.file, out)
-    img = Image.open(tmp)
+    return templates.TemplateResponse(request, "subject.html", await run_db(_load))
+
+UPLOAD_CHUNK = 1 << 20
+
+def spool_upload(f: UploadFile, dst: str, max_bytes: Optional[int] = None):
+    """Copy an already-received upload to `dst` in UPLOAD_CHUNK pieces.
+
+    Past `max_bytes` this raises 413 and leaves no partial file. By the time it
+    runs Starlette has buffered the whole part, so this bounds what is kept,
+    not what was received (see ImageBodyLimit for that).
+    """
+    written = 0
     try:
-        from PIL import ImageOps
-        img = ImageOps.exif_transpose(img)
-    except: pass
-    if max(img.size) > 1800:
-        ratio = 1800 / float(max(img.size))
-        new_size = tuple([int(x * ratio) for x in img.size])
-        img = img.resize(new_size, Image.LANCZOS)
-    img.convert('RGB').save(os.path.join(UPLOAD_DIR, img_name), "WEBP", quality=80)
-    os.remove(tmp)
-    return img_name
+        with open(dst, "wb") as out:
+            while True:
+                chunk = f.file.read(UPLOAD_CHUNK)
+                if not chunk: break
+                written += len(chunk)
+                if max_bytes is not None and written > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"{f.filename}: file exceeds {max_bytes // (1 << 20)} MB")
+                out.write(chunk)
+    except BaseException:
+        if os.path.exists(dst): os.remove(dst)
+        raise
+    return written
+
+# V3.2: Image ingestion. All images of a request are decoded, oriented, resized and
+# WebP-encoded concurrently on the media process pool, so a 10-photo submission
+# costs about one image of wall time (given MEDIA_PROCESSES cores).
+IMAGE_MAX_SIDE = int(os.environ.get('IMAGE_MAX_SIDE', 1800))
+IMAGE_WEBP_QUALITY = int(os.environ.get('IMAGE_WEBP_QUALITY', 80))
+IMAGE_WEBP_METHOD = int(os.environ.get('IMAGE_WEBP_METHOD', 4))  # libwebp effort 0 (fast) .. 6 (small)
+# Memory bounds: the body of an image-upload request is capped while it is received
+# (ImageBodyLimit), each spooled file is capped in bytes, and images are capped in
+# pixels from the header before anything is decoded. Starlette buffers each file
+# part in a temporary file, so the request cap is what bounds that disk use.
+# Decoded rasters share MEDIA_DECODE_BUDGET_MB across all workers, so a burst of
+# full-size decodes (HEIF has no scaled decode) runs one after another instead of
+# MEDIA_PROCESSES at a time; a single decode is bounded by IMAGE_MAX_PIXELS.
+IMAGE_MAX_UPLOAD_MB = float(os.environ.get('IMAGE_MAX_UPLOAD_MB', 40))
+IMAGE_MAX_REQUEST_MB = float(os.environ.get('IMAGE_MAX_REQUEST_MB', 200))
+IMAGE_MAX_PIXELS = int(float(os.environ.get('IMAGE_MAX_PIXELS_MP', 64)) * 1_000_000)
+
+class ImageMetrics:
+    """Counters for the ingestion pipeline, reported by /api/admin/db-stats."""
+    STAGES = ('decode_ms', 'resize_ms', 'encode_ms')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {"batches": 0, "images": 0, "failed": 0, "rejected": 0, "max_batch": 0, "bytes_in": 0, "bytes_out": 0,
+                      "max_decoded_mb": 0.0, "max_upload_rss_mb": 0.0, "decode_wait_ms": 0.0,
+                      "wall_ms": 0.0, "cpu_ms": 0.0, **{k: 0.0 for k in self.STAGES}}
+
+    def record(self, results, wall_ms: float, failed: int = 0, rejected: int = 0, bytes_in: int = 0):
+        with self._lock:
+            st = self.stats
+            st["batches"] += 1; st["images"] += len(results); st["failed"] += failed; st["rejected"] += rejected
+            st["max_batch"] = max(st["max_batch"], len(results) + failed)
+            st["wall_ms"] += wall_ms; st["bytes_in"] += bytes_in
+            for r in results:
+                st["bytes_out"] += r["bytes"]
+                st["max_decoded_mb"] = max(st["max_decoded_mb"], round(r["decoded_bytes"] / (1 << 20), 1))
+                st["decode_wait_ms"] += r.get("decode_wait_ms", 0.0)
+                if r.get("peak_rss_delta_kb") is not None:
+                    st["max_upload_rss_mb"] = max(st["max_upload_rss_mb"], round(r["peak_rss_delta_kb"] / 1024, 1))
+                for k in self.STAGES:
+                    st[k] += r[k]; st["cpu_ms"] += r[k]
+
+    def metrics(self) -> dict:
+        with self._lock:
+            st = dict(self.stats)
+        n = st["images"] or 1
+        return {**st, "avg_image_ms": round(st["cpu_ms"] / n, 1), "avg_batch_ms": round(st["wall_ms"] / (st["batches"] or 1), 1),
+                "quality": IMAGE_WEBP_QUALITY, "method": IMAGE_WEBP_METHOD, "max_side": IMAGE_MAX_SIDE,
+                "max_upload_mb": IMAGE_MAX_UPLOAD_MB, "max_request_mb": IMAGE_MAX_REQUEST_MB, "max_pixels": IMAGE_MAX_PIXELS}
+
+image_metrics = ImageMetrics()
+
+async def ingest_media(jobs, bytes_in: int = 0) -> List[str]:
+    """Run `(dst, fn, args)` media jobs in parallel and store their outputs; names in order.
+
+    Each fn writes WebP to its scratch `dst` and returns media_worker's result
+    dict. On any failure every scratch file is removed and the first error raised;
+    images refused by their header become 413, undecodable ones 400.
+    """
+    t0 = time.perf_counter()
+    dsts = [dst for dst, _, _ in jobs]
+    results = await asyncio.gather(*(run_cpu(fn, *args) for _, fn, args in jobs), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    try:
+        for e in errors:
+            if isinstance(e, media_worker.ImageRejected): raise HTTPException(status_code=413, detail=str(e))
+            if isinstance(e, UnidentifiedImageError): raise HTTPException(status_code=400, detail="Unsupported or corrupt image")
+        if errors:
+            raise errors[0]
+        names = await run_db(lambda: [store_media(r["path"], '.webp', r["sha1"]) for r in results])
+    finally:
+        for dst in dsts:
+            if os.path.exists(dst): os.remove(dst)
+        ok_results = [r for r in results if not isinstance(r, BaseException)]
+        image_metrics.record(ok_results, (time.perf_counter() - t0) * 1000, failed=len(errors), bytes_in=bytes_in,
+                             rejected=sum(isinstance(e, media_worker.ImageRejected) for e in errors))
+    return names
+
+def encode_job(src: str):
+    dst = media_tmp_path()
+    return dst, media_worker.encode_webp, (src, dst, IMAGE_MAX_SIDE, IMAGE_WEBP_QUALITY, IMAGE_WEBP_METHOD, IMAGE_MAX_PIXELS)
+
+def slice_job(raster_path: str, rect: dict, canvas_w: int, canvas_h: int):
+    dst = media_tmp_path()
+    return dst, media_worker.crop_raster, (raster_path, rect, canvas_w, canvas_h, dst, IMAGE_WEBP_QUALITY, IMAGE_WEBP_METHOD)
+
+async def save_imgs(files, leading=()) -> List[str]:
+    """Encode every uploaded image in parallel; returns stored names in upload order.
+
+    `leading` jobs (e.g. slice crops) run in the same batch and their names come first.
+    """
+    files = [f for f in files if f is not None and f.filename]
+    if not files and not leading: return []
+    tmps = [os.path.join(TEMP_DIR, f"{uuid.uuid4().hex}{os.path.splitext(f.filename)[1].lower()}") for f in files]
+    try:
+        sizes = await run_db(lambda: [spool_upload(f, tmp, int(IMAGE_MAX_UPLOAD_MB * (1 << 20))) for f, tmp in zip(files, tmps)])
+        return await ingest_media(list(leading) + [encode_job(tmp) for tmp in tmps], bytes_in=sum(sizes))
+    finally:
+        for tmp in tmps:
+            if os.path.exists(tmp): os.remove(tmp)
+
+async def save_img(f: UploadFile) -> str:
+    return (await save_imgs([f]))[0]
 
 async def save_video(f: UploadFile) -> str:
     ext = os.path.splitext(f.filename)[1].lower()
     vid_name = f"{uuid.uuid4().hex}{ext}"
-    with open(os.path.join(VIDEO_UPLOAD_DIR, vid_name), "wb") as out:
-        shutil.copyfileobj(f.file, out)
+    await run_db(spool_upload, f, os.path.join(VIDEO_UPLOAD_DIR, vid_name))
     return vid_name
 
 @app.get("/subject/{sid}/add", response_class=HTMLResponse)
 async def add_q_page(request: Request, sid: int):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db()
-    s = conn.execute("SELECT * FROM subjects WHERE id = ? AND user_id = ?", (sid, user['id'])).fetchone()
-    conn.close()
+    s, app_name = await run_db(lambda: (db_fetchone("SELECT * FROM subjects WHERE id = ? AND user_id = ?", (sid, user['id'])), get_app_name()))
     if not s: raise HTTPException(404)
-    return templates.TemplateResponse(request, "add.html", {"app_name": get_app_name(), "user": user, "subject": dict(s)})
+    return templates.TemplateResponse(request, "add.html", {"app_name": app_name, "user": user, "subject": dict(s)})
 
 @app.post("/subject/{sid}/add")
 async def add_q(request: Request, sid: int, q_text: str = Form(...), q_type: str = Form(...), ans: str = Form(...), a: Optional[str] = Form(None), b: Optional[str] = Form(None), c: Optional[str] = Form(None), d: Optional[str] = Form(None), source: Optional[str] = Form(None), grade: Optional[str] = Form(None), analysis: Optional[str] = Form(None), tags: Optional[str] = Form(None), q_images: List[UploadFile] = File([]), a_images: List[UploadFile] = File([]), paper_id_str: Optional[str] = Form(None, alias="paper_id"), v_url: Optional[str] = Form(None), v_file: Optional[UploadFile] = File(None)):
@@ -525,33 +2260,42 @@ async def add_q(request: Request, sid: int, q_text: str = Form(...), q_type: str
     if v_file and v_file.filename:
         final_v = await save_video(v_file)
 
-    conn = get_db(); cur = conn.cursor()
-    cur.execute('INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, correct_answer, option_a, option_b, option_c, option_d, source, answer_video, grade, analysis) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', (sid, paper_id, user['id'], q_text, q_type, ans, a, b, c, d, source, final_v, grade, analysis))
-    qid = cur.lastrowid
-    for f in q_images:
-        if f.filename:
-            p = await save_img(f)
+    # Encode images before touching the DB so no write transaction spans the media work
+    q_images = [f for f in q_images if f.filename]
+    paths = await save_imgs(q_images + [f for f in a_images if f.filename])
+    q_paths, a_paths = paths[:len(q_images)], paths[len(q_images):]
+
+    def _insert():
+        conn = get_db(); cur = conn.cursor()
+        cur.execute('INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, correct_answer, option_a, option_b, option_c, option_d, source, answer_video, grade, analysis) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', (sid, paper_id, user['id'], q_text, q_type, ans, a, b, c, d, source, final_v, grade, analysis))
+        qid = cur.lastrowid
+        for p in q_paths:
             cur.execute('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', (qid, p, 'question'))
-    for f in a_images:
-        if f.filename:
-            p = await save_img(f)
+        for p in a_paths:
             cur.execute('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', (qid, p, 'answer'))
+        refresh_question_fingerprint(conn, qid)
+        near = find_near_duplicates(conn, user['id'], sid, q_text, exclude_id=qid) if NEAR_DUP_WARN else []
             
-    # Process Tags
-    process_question_tags(conn, qid, sid, tags)
-    
-    conn.commit(); conn.close()
-    return RedirectResponse(f"/paper/{paper_id}" if paper_id else f"/subject/{sid}", status_code=303)
+        # Process Tags
+        process_question_tags(conn, qid, sid, tags)
+        
+        conn.commit(); conn.close()
+        return near
+
+    near = await run_db(_insert)
+    target = f"/paper/{paper_id}" if paper_id else f"/subject/{sid}"
+    if near:
+        target += f"?msg=near_duplicate&dup={near[0][0]}"
+    return RedirectResponse(target, status_code=303)
 
 @app.get("/subject/{sid}/study")
-async def study(request: Request, sid: int, mode: str = "normal", qtype: str = "all"):
+async def study(request: Request, sid: int, mode: str = "normal", qtype: str = "all", redeal: int = 0):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db()
     
     # Get subject name
-    s = conn.execute("SELECT * FROM subjects WHERE id = ?", (sid,)).fetchone()
-    if not s: conn.close(); raise HTTPException(404)
+    s = await run_db(db_fetchone, "SELECT * FROM subjects WHERE id = ?", (sid,))
+    if not s: raise HTTPException(404)
 
     # Base Query: Questions in this subject
     query = '''
@@ -609,58 +2353,308 @@ async def study(request: Request, sid: int, mode: str = "normal", qtype: str = "
 
     # 'all' -> no filter
 
+    # V3.2: Resume the stored deal unless asked to re-deal or it is used up
+    key = (user['id'], sid, mode, qtype, active_grade)
+    session = await run_db(db_fetchone, "SELECT id, deck, total, cursor FROM study_sessions WHERE user_id = ? AND subject_id = ? AND mode = ? AND qtype = ? AND grade = ?", key)
+    if session and not redeal and session['cursor'] < session['total']:
+        session_id, cursor = session['id'], session['cursor']
+        ids = unpack_deck(session['deck'])
+    else:
+        seed = random.getrandbits(32)
+        ids = deal_deck([r['id'] for r in await run_db(db_fetchall, query + " ORDER BY q.id", params)], seed)
+        cursor = 0
+
+        def _store(conn):
+            conn.execute('''INSERT INTO study_sessions (user_id, subject_id, mode, qtype, grade, seed, deck, total, cursor)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+                            ON CONFLICT (user_id, subject_id, mode, qtype, grade) DO UPDATE SET
+                                seed = excluded.seed, deck = excluded.deck, total = excluded.total, cursor = 0,
+                                created_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP''',
+                         key + (seed, pack_deck(ids), len(ids)))
+            return conn.execute("SELECT id FROM study_sessions WHERE user_id = ? AND subject_id = ? AND mode = ? AND qtype = ? AND grade = ?", key).fetchone()[0]
+
+        session_id = await submit_write(_store)
+
+    def _load():
+        conn = get_db()
+        try:
+            return {**deck_context(conn, ids, user['id'], cursor), "app_name": get_app_name()}
+        finally:
+            conn.close()
+
     try:
-        ids = [r['id'] for r in conn.execute(query + " ORDER BY RANDOM()", params).fetchall()]
-        questions = [get_question_data(conn, qid, user['id']) for qid in ids]
-        # Filter None
-        questions = [q for q in questions if q]
-        
-        conn.close()
-        return templates.TemplateResponse(request, "study.html", {"app_name": get_app_name(), "user": user, "subject": dict(s), "questions": questions, "mode": mode, "qtype": qtype, "is_paper": False})
+        deck = await run_db(_load)
+        return templates.TemplateResponse(request, "study.html", {"user": user, "subject": dict(s), **deck, "session_id": session_id, "mode": mode, "qtype": qtype, "is_paper": False})
     except Exception as e:
-        conn.close()
         return HTMLResponse(content=f"<h1>Error in Study Page</h1><pre>{e}</pre><p>Query: {query}</p><p>Params: {params}</p>", status_code=500)
 
 @app.get("/question/{qid}", response_class=HTMLResponse)
 async def single_question(request: Request, qid: int):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db(); d = get_question_data(conn, qid, user['id'])
-    if not d: conn.close(); raise HTTPException(404)
-    s = conn.execute("SELECT * FROM subjects WHERE id = ?", (d['subject_id'],)).fetchone()
-    conn.close()
-    return templates.TemplateResponse(request, "study.html", {"app_name": get_app_name(), "user": user, "subject": dict(s), "questions": [d], "single": True})
+
+    def _load():
+        conn = get_db(); d = get_question_data(conn, qid, user['id'])
+        if not d: conn.close(); raise HTTPException(404)
+        s = conn.execute("SELECT * FROM subjects WHERE id = ?", (d['subject_id'],)).fetchone()
+        conn.close()
+        return {"app_name": get_app_name(), "user": user, "subject": dict(s), "questions": [d], "deck_ids": [d['id']], "deck_window": DECK_WINDOW, "deck_start": 0, "single": True}
+
+    return templates.TemplateResponse(request, "study.html", await run_db(_load))
 
 @app.get("/paper-entry", response_class=HTMLResponse)
 async def paper_entry_home(request: Request):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    return templates.TemplateResponse(request, "paper_entry_home.html", {"app_name": get_app_name(), "user": user})
+    return templates.TemplateResponse(request, "paper_entry_home.html", {"app_name": await run_db(get_app_name), "user": user})
+
+# ==============================================================================
+# V3.2: Slicer page raster cache
+# ==============================================================================
+# Pages are rendered once per PDF content to PAGE_CACHE_DIR/<sha1>/<dpi>/<page>.png;
+# page flips and crops reuse the raster. An upload pre-renders every page in the
+# background on at most MEDIA_PROCESSES - 1 workers (across all uploads), so one
+# worker stays free for interactive flips, crops and image uploads. Rasters are evicted least recently used first (mtime, bumped on
+# every hit) once the cache exceeds PAGE_CACHE_MAX_MB.
+# The browser fetches pages as plain JPEGs from GET /api/slicer/<sha1>/pages/<n>:
+# a low-DPI preview first, then the full page, plus one thumbnail strip for
+# navigation. URLs are content-addressed, so responses are immutable with ETags.
+PAGE_CACHE_DIR = os.environ.get('PAGE_CACHE_DIR', os.path.join(os.path.dirname(DB_PATH), 'cache', 'pages'))
+PAGE_RENDER_DPI = int(os.environ.get('PAGE_RENDER_DPI', 200))
+PAGE_CACHE_MAX_MB = float(os.environ.get('PAGE_CACHE_MAX_MB', 1024))
+PAGE_PRERENDER_MAX_PAGES = int(os.environ.get('PAGE_PRERENDER_MAX_PAGES', 200))
+PAGE_PREVIEW_DPI = int(os.environ.get('PAGE_PREVIEW_DPI', 50))
+PAGE_JPEG_QUALITY = int(os.environ.get('PAGE_JPEG_QUALITY', 85))
+PAGE_THUMB_W, PAGE_THUMB_H = 90, 120
+PAGE_EVICT_MIN_AGE_S = 120  # a crop may still be reading a raster touched this recently
+os.makedirs(PAGE_CACHE_DIR, exist_ok=True)
+
+class PageCache:
+    """Disk LRU of rendered PDF pages keyed by (content hash, page, dpi)."""
+    def __init__(self, root: str, dpi: int, max_bytes: int):
+        self.root = root
+        self.dpi = dpi
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._digests = {}    # (path, mtime_ns, size) -> sha1
+        self._pages = {}      # sha1 -> page count, for digests still in _digests
+        self._prerender = {}  # user_id -> asyncio.Task
+        self._slots = None    # (loop, semaphore) shared by all pre-renders
+        self._added = 0       # bytes rendered since the last eviction pass
+        self.stats = {"hits": 0, "misses": 0, "renders": 0, "render_ms": 0.0, "prerendered": 0, "prerender_failed": 0,
+                      "evicted": 0, "evicted_bytes": 0}
+
+    def _count(self, **kw):
+        with self._lock:
+            for k, v in kw.items(): self.stats[k] += v
+
+    def raster_path(self, digest: str, page: int, dpi: int, ext: str = 'png') -> str:
+        return os.path.join(self.root, digest, str(dpi), f"{page}.{ext}")
+
+    def source(self, pdf_path: str):
+        """(sha1, content-addressed copy) of an uploaded PDF.
+
+        Renders read the copy, so a user re-uploading over pdf_path can never
+        race a render still queued for the previous file.
+        """
+        st = os.stat(pdf_path)
+        key = (pdf_path, st.st_mtime_ns, st.st_size)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = file_sha1(pdf_path)
+            with self._lock:
+                self._digests = {k: v for k, v in self._digests.items() if k[0] != pdf_path}
+                self._digests[key] = digest
+                live = set(self._digests.values())
+                self._pages = {d: n for d, n in self._pages.items() if d in live}
+        src = os.path.join(self.root, digest, 'source.pdf')
+        try:
+            os.utime(src)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(src), exist_ok=True)
+            tmp = os.path.join(os.path.dirname(src), f".tmp-{uuid.uuid4().hex}")
+            shutil.copyfile(pdf_path, tmp)
+            os.replace(tmp, src)
+        return digest, src
+
+    async def page_count(self, src: str, digest: str) -> int:
+        n = self._pages.get(digest)
+        if n is None:
+            n = self._pages[digest] = await run_cpu(media_worker.pdf_page_count, src)
+        return n
+
+    async def _ensure(self, dst: str, fn, *args) -> str:
+        """Return cached `dst`, rendering it with `fn(*args)` on the media pool on a miss."""
+        try:
+            os.utime(dst)
+            self._count(hits=1)
+            return dst
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        t0 = time.perf_counter()
+        if not await render_once(dst, fn, *args):
+            self._count(misses=1)
+            return dst
+        self._count(misses=1, renders=1, render_ms=(time.perf_counter() - t0) * 1000)
+        with self._lock:
+            self._added += os.path.getsize(dst)
+            evict = self._added > self.max_bytes // 20
+            if evict: self._added = 0
+        if evict:
+            asyncio.ensure_future(run_db(self.evict))
+        return dst
+
+    async def raster(self, src: str, digest: str, page: int, dpi: Optional[int] = None) -> str:
+        """Lossless full-resolution PNG, the source for crops."""
+        dpi = dpi or self.dpi
+        dst = self.raster_path(digest, page, dpi)
+        return await self._ensure(dst, media_worker.render_page_raster, src, page, dpi, dst)
+
+    async def display(self, src: str, digest: str, page: int) -> str:
+        """Progressive JPEG of the full-resolution raster, for the browser."""
+        png = await self.raster(src, digest, page)
+        dst = self.raster_path(digest, page, self.dpi, 'jpg')
+        return await self._ensure(dst, media_worker.raster_to_jpeg, png, dst, PAGE_JPEG_QUALITY)
+
+    async def preview(self, src: str, digest: str, page: int) -> str:
+        """Low-DPI JPEG rendered directly by pdftoppm; shown while the full page loads."""
+        dst = self.raster_path(digest, page, PAGE_PREVIEW_DPI, 'jpg')
+        return await self._ensure(dst, media_worker.render_page_raster, src, page, PAGE_PREVIEW_DPI, dst, 'jpeg', PAGE_JPEG_QUALITY)
+
+    async def thumbs(self, src: str, digest: str, total: int) -> str:
+        dst = os.path.join(self.root, digest, f"thumbs-{PAGE_THUMB_W}x{PAGE_THUMB_H}.jpg")
+        return await self._ensure(dst, media_worker.render_thumb_strip, src, dst, PAGE_THUMB_W, PAGE_THUMB_H,
+                                  min(total, PAGE_PRERENDER_MAX_PAGES))
+
+    def prerender(self, user_id: int, src: str, digest: str, total: int):
+        """Render all pages in the background, replacing the user's previous pre-render."""
+        old = self._prerender.pop(user_id, None)
+        if old: old.cancel()
+        task = asyncio.ensure_future(self._prerender_all(src, digest, min(total, PAGE_PRERENDER_MAX_PAGES)))
+        self._prerender[user_id] = task
+        task.add_done_callback(lambda t: self._prerender.pop(user_id, None) if self._prerender.get(user_id) is t else None)
+
+    def _prerender_slots(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots[0] is not loop:
+            self._slots = (loop, asyncio.Semaphore(max(1, MEDIA_PROCESSES - 1)))
+        return self._slots[1]
+
+    async def _prerender_all(self, src: str, digest: str, total: int):
+        sem = self._prerender_slots()
+
+        async def one(render, page):
+            async with sem:
+                await render(src, digest, page)
+
+        # cheap previews of every page first, then the full-resolution rasters
+        results = await asyncio.gather(*(one(self.preview, p) for p in range(1, total + 1)), return_exceptions=True)
+        results = await asyncio.gather(*(one(self.display, p) for p in range(1, total + 1)), return_exceptions=True)
+        failed = sum(isinstance(r, Exception) for r in results)
+        self._count(prerendered=len(results) - failed, prerender_failed=failed)
+
+    def evict(self):
+        """Drop least recently used rasters until the cache fits PAGE_CACHE_MAX_MB."""
+        if not self._evict_lock.acquire(blocking=False): return
+        try:
+            files, total, now = [], 0, time.time()
+            for dirpath, _, names in os.walk(self.root):
+                for n in names:
+                    full = os.path.join(dirpath, n)
+                    try: st = os.stat(full)
+                    except FileNotFoundError: continue
+                    if n.startswith('.tmp-'):
+                        # leftovers of a render that died mid-write
+                        if now - st.st_mtime > 3600: os.remove(full)
+                        continue
+                    files.append((st.st_mtime, st.st_size, full)); total += st.st_size
+            files.sort()
+            evicted = freed = 0
+            for mtime, size, full in files:
+                if total <= self.max_bytes or now - mtime < PAGE_EVICT_MIN_AGE_S: break
+                try: os.remove(full)
+                except FileNotFoundError: pass
+                total -= size; evicted += 1; freed += size
+            for dirpath, _, _ in os.walk(self.root, topdown=False):
+                if dirpath != self.root:
+                    try: os.rmdir(dirpath)  # only succeeds once empty
+                    except OSError: pass
+            self._count(evicted=evicted, evicted_bytes=freed)
+        finally:
+            self._evict_lock.release()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            st = dict(self.stats)
+        return {**st, "render_ms": round(st["render_ms"], 1), "dpi": self.dpi, "max_mb": self.max_bytes / (1 << 20),
+                "prerendering": len(self._prerender)}
+
+page_cache = PageCache(PAGE_CACHE_DIR, PAGE_RENDER_DPI, int(PAGE_CACHE_MAX_MB * (1 << 20)))
 
 @app.get("/slicer", response_class=HTMLResponse)
 async def slicer_page(request: Request):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db(); subs = conn.execute("SELECT * FROM subjects WHERE user_id = ? ORDER BY name", (user['id'],)).fetchall()
-    papers = conn.execute("SELECT * FROM papers WHERE user_id = ? ORDER BY created_at DESC", (user['id'],)).fetchall()
-    conn.close()
-    return templates.TemplateResponse(request, "slicer.html", {"app_name": get_app_name(), "user": user, "subjects": [dict(s) for s in subs], "papers": [dict(p) for p in papers]})
+
+    def _load():
+        return {"app_name": get_app_name(), "user": user, "subjects": get_user_subjects(user['id']), "papers": get_user_papers(user['id'])}
+
+    return templates.TemplateResponse(request, "slicer.html", await run_db(_load))
 
 @app.post("/api/slice-upload")
 async def slice_upload(request: Request, file: Optional[UploadFile] = File(None), page: int = Form(1)):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
     user_pdf = os.path.join(TEMP_DIR, f"pdf_{user['id']}.pdf")
-    if file and file.filename:
-        with open(user_pdf, "wb") as f: shutil.copyfileobj(file.file, f)
+    uploaded = bool(file and file.filename)
+    if uploaded:
+        await run_db(spool_upload, file, user_pdf)
     if not os.path.exists(user_pdf): return JSONResponse({"error": "No file"}, status_code=400)
-    info = pdfinfo_from_path(user_pdf)
-    total = int(info.get('Pages', 1))
-    imgs = convert_from_path(user_pdf, first_page=page, last_page=page)
-    tmp_img = os.path.join(TEMP_DIR, f"p_{user['id']}_{page}.jpg")
-    imgs[0].save(tmp_img, "JPEG")
-    with open(tmp_img, "rb") as f: enc = base64.b64encode(f.read()).decode()
-    os.remove(tmp_img); return {"img": f"data:image/jpeg;base64,{enc}", "total": total}
+    digest, src = await run_db(page_cache.source, user_pdf)
+    try:
+        total = await page_cache.page_count(src, digest)
+    except Exception:
+        return JSONResponse({"error": "Unreadable PDF"}, status_code=400)
+    if uploaded:
+        page_cache.prerender(user['id'], src, digest, total)
+    base = f"/api/slicer/{digest}"
+    return {"doc": digest, "total": total, "page": max(1, min(page, total)), "pages_url": f"{base}/pages",
+            "thumbs": {"url": f"{base}/thumbs", "w": PAGE_THUMB_W, "h": PAGE_THUMB_H, "pages": min(total, PAGE_PRERENDER_MAX_PAGES)},
+            "preview_scale": PAGE_RENDER_DPI / PAGE_PREVIEW_DPI}
+
+async def slicer_source(request: Request, doc: str) -> str:
+    """Cached copy of the user's current slicer PDF, provided `doc` is its digest."""
+    user = await get_current_user(request)
+    if not user: raise HTTPException(status_code=401)
+    user_pdf = os.path.join(TEMP_DIR, f"pdf_{user['id']}.pdf")
+    if not re.fullmatch(r'[0-9a-f]{40}', doc) or not os.path.exists(user_pdf): raise HTTPException(status_code=404)
+    digest, src = await run_db(page_cache.source, user_pdf)
+    if digest != doc: raise HTTPException(status_code=404)
+    return src
+
+async def immutable_file(request: Request, etag: str, make_path, media_type: str):
+    """Serve a content-addressed file; a matching If-None-Match skips rendering entirely."""
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(await make_path(), media_type=media_type, headers=headers)
+
+@app.get("/api/slicer/{doc}/pages/{page}")
+async def slicer_page_image(request: Request, doc: str, page: int, preview: bool = False):
+    src = await slicer_source(request, doc)
+    if not 1 <= page <= await page_cache.page_count(src, doc): raise HTTPException(status_code=404)
+    render = page_cache.preview if preview else page_cache.display
+    etag = f'"{doc}-{page}-{PAGE_PREVIEW_DPI if preview else PAGE_RENDER_DPI}"'
+    return await immutable_file(request, etag, lambda: render(src, doc, page), "image/jpeg")
+
+@app.get("/api/slicer/{doc}/thumbs")
+async def slicer_thumbs(request: Request, doc: str):
+    src = await slicer_source(request, doc)
+    total = await page_cache.page_count(src, doc)
+    return await immutable_file(request, f'"{doc}-thumbs-{PAGE_THUMB_W}x{PAGE_THUMB_H}"',
+                                lambda: page_cache.thumbs(src, doc, total), "image/jpeg")
 
 class BatchDistributeRequest(BaseModel):
     question_ids: List[int]
@@ -701,61 +2695,167 @@ async def slice_save(
     user_pdf = os.path.join(TEMP_DIR, f"pdf_{user['id']}.pdf")
     if not os.path.exists(user_pdf): return JSONResponse({"error": "No PDF"}, status_code=400)
     
-    # Process Question Image (Slice)
-    imgs = convert_from_path(user_pdf, first_page=page, last_page=page)
-    img = imgs[0]
-    rx = img.width / canvas_w; ry = img.height / canvas_h
-    crop_rect = (rect_dict['left']*rx, rect_dict['top']*ry, (rect_dict['left']+rect_dict['width'])*rx, (rect_dict['top']+rect_dict['height'])*ry)
-    cropped = img.crop(crop_rect)
-    
-    uid = uuid.uuid4().hex; q_img_name = f"{uid}.webp"
-    cropped.convert('RGB').save(os.path.join(UPLOAD_DIR, q_img_name), "WEBP", quality=80)
-    
     # Handle Video
     final_v = v_url
     if v_file and v_file.filename:
         final_v = await save_video(v_file)
 
-    conn = get_db(); cur = conn.cursor()
-    cur.execute('INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, correct_answer, option_a, option_b, option_c, option_d, source, answer_video, grade, analysis) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', 
-                (sid, pid, user['id'], text, type, ans, a, b, c, d, source, final_v, grade, analysis))
+    # Slice crop (from the cached page raster) and answer image are encoded side by side
+    digest, src = await run_db(page_cache.source, user_pdf)
+    if not 1 <= page <= await page_cache.page_count(src, digest):
+        return JSONResponse({"error": "Page out of range"}, status_code=400)
+    raster = await page_cache.raster(src, digest, page)
+    q_img_name, *rest = await save_imgs([answer_image], leading=[slice_job(raster, rect_dict, canvas_w, canvas_h)])
+    a_p = rest[0] if rest else None
+
+    def _insert():
+        conn = get_db()
+        _, near = insert_slice(conn, user['id'], sid, pid, dict(text=text, type=type, ans=ans, a=a, b=b, c=c, d=d, source=source, grade=grade, analysis=analysis),
+                               q_img_name, a_p, final_v)
+        conn.commit(); conn.close()
+        return near
+
+    near = await run_db(_insert)
+    return {"status": "ok", "near_duplicates": [{"id": i, "similarity": sim} for i, sim in near]}
+
+def insert_slice(conn, user_id: int, sid: int, pid: Optional[int], f: dict, q_img: str, a_img: Optional[str], video: Optional[str]):
+    """Insert one sliced question with its images (caller commits); returns (qid, near duplicates)."""
+    cur = conn.cursor()
+    cur.execute('INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, correct_answer, option_a, option_b, option_c, option_d, source, answer_video, grade, analysis) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                (sid, pid, user_id, f['text'], f['type'], f['ans'], f['a'], f['b'], f['c'], f['d'], f['source'], video, f['grade'], f['analysis']))
     qid = cur.lastrowid
-    cur.execute('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', (qid, q_img_name, 'question'))
-    
-    # Process Answer Image (Upload)
-    if answer_image and answer_image.filename:
-        a_p = await save_img(answer_image)
-        cur.execute('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', (qid, a_p, 'answer'))
+    cur.execute('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', (qid, q_img, 'question'))
+    if a_img:
+        cur.execute('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', (qid, a_img, 'answer'))
+    refresh_question_fingerprint(conn, qid)
+    near = find_near_duplicates(conn, user_id, sid, f['text'], exclude_id=qid) if NEAR_DUP_WARN else []
+    return qid, near
+
+# V3.2: Batch slicing. One request carries every rectangle of a page: the page raster
+# is fetched once, all crops (and attached answer images) are encoded in parallel on
+# the media pool and the questions are inserted in a single transaction.
+SLICE_BATCH_MAX = int(os.environ.get('SLICE_BATCH_MAX', 50))
+
+class SliceRect(BaseModel):
+    left: float
+    top: float
+    width: float
+    height: float
+
+class SliceBatchItem(BaseModel):
+    rect: SliceRect
+    text: str = ""
+    type: str
+    ans: str = ""
+    a: Optional[str] = None
+    b: Optional[str] = None
+    c: Optional[str] = None
+    d: Optional[str] = None
+    source: Optional[str] = None
+    grade: Optional[str] = None
+    analysis: Optional[str] = None
+    v_url: Optional[str] = None
+    answer_image: Optional[int] = None  # index into the request's answer_images
+    video: Optional[int] = None         # index into the request's videos
+
+@app.post("/api/slice-save-batch")
+async def slice_save_batch(
+    request: Request,
+    sid: int = Form(...),
+    pid: Optional[int] = Form(None),
+    page: int = Form(...),
+    canvas_w: int = Form(...),
+    canvas_h: int = Form(...),
+    items: str = Form(...),
+    answer_images: List[UploadFile] = File([]),
+    videos: List[UploadFile] = File([])
+):
+    user = await get_current_user(request)
+    if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    try:
+        batch = [SliceBatchItem(**it) for it in json.loads(items)]
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"error": f"Invalid items: {e}"}, status_code=400)
+    answer_images = [f for f in answer_images if f.filename]
+    videos = [f for f in videos if f.filename]
+    if not 1 <= len(batch) <= SLICE_BATCH_MAX:
+        return JSONResponse({"error": f"A batch holds 1 to {SLICE_BATCH_MAX} slices"}, status_code=400)
+    for it in batch:
+        if it.rect.width <= 0 or it.rect.height <= 0:
+            return JSONResponse({"error": "Empty rectangle"}, status_code=400)
+        if (it.answer_image is not None and not 0 <= it.answer_image < len(answer_images)) or (it.video is not None and not 0 <= it.video < len(videos)):
+            return JSONResponse({"error": "Attachment index out of range"}, status_code=400)
+
+    user_pdf = os.path.join(TEMP_DIR, f"pdf_{user['id']}.pdf")
+    if not os.path.exists(user_pdf): return JSONResponse({"error": "No PDF"}, status_code=400)
+    digest, src = await run_db(page_cache.source, user_pdf)
+    if not 1 <= page <= await page_cache.page_count(src, digest):
+        return JSONResponse({"error": "Page out of range"}, status_code=400)
+    raster = await page_cache.raster(src, digest, page)
+
+    names = await save_imgs(answer_images, leading=[slice_job(raster, it.rect.model_dump(), canvas_w, canvas_h) for it in batch])
+    crops, a_names = names[:len(batch)], names[len(batch):]
+    # Videos are saved only once the crops succeeded, and removed again if the insert fails
+    video_names = []
+
+    def _insert():
+        conn = get_db()
+        try:
+            out = []
+            for it, crop in zip(batch, crops):
+                qid, near = insert_slice(conn, user['id'], sid, pid, it.model_dump(), crop,
+                                         a_names[it.answer_image] if it.answer_image is not None else None,
+                                         video_names[it.video] if it.video is not None else it.v_url)
+                out.append({"id": qid, "near_duplicates": [{"id": i, "similarity": sim} for i, sim in near]})
+            conn.commit()
+            return out
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
 
-    conn.commit(); conn.close(); return {"status": "ok"}
+    try:
+        for f in videos:
+            video_names.append(await save_video(f))
+        return {"status": "ok", "questions": await run_db(_insert)}
+    except BaseException:
+        for v in video_names:
+            path = os.path.join(VIDEO_UPLOAD_DIR, v)
+            if os.path.exists(path): os.remove(path)
+        raise
 
 @app.get("/question/{qid}/edit", response_class=HTMLResponse)
 async def edit_question_page(request: Request, qid: int):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db()
-    
-    # Check if user owns the question or its subject
-    q_row = conn.execute("SELECT * FROM questions WHERE id = ? AND user_id = ?", (qid, user['id'])).fetchone()
-    if not q_row:
-        conn.close()
+
+    def _load():
+        conn = get_db()
+        try:
+            # Check if user owns the question or its subject
+            q_row = conn.execute("SELECT * FROM questions WHERE id = ? AND user_id = ?", (qid, user['id'])).fetchone()
+            if not q_row: return None, None, None
+            q_data = dict(q_row)
+            s = conn.execute("SELECT * FROM subjects WHERE id = ?", (q_data['subject_id'],)).fetchone()
+
+            # Fetch images
+            q_imgs = conn.execute("SELECT * FROM question_images WHERE question_id = ? AND image_type = 'question'", (qid,)).fetchall()
+            a_imgs = conn.execute("SELECT * FROM question_images WHERE question_id = ? AND image_type = 'answer'", (qid,)).fetchall()
+            q_data['q_images'] = [dict(i) for i in q_imgs]
+            q_data['a_images'] = [dict(i) for i in a_imgs]
+
+            # Fetch tags
+            q_tags = conn.execute("SELECT t.name FROM question_tags qt JOIN tags t ON qt.tag_id = t.id WHERE qt.question_id = ?", (qid,)).fetchall()
+            q_data['tags'] = [t['name'] for t in q_tags]
+            return q_data, s, get_app_name()
+        finally:
+            conn.close()
+
+    q_data, s, app_name = await run_db(_load)
+    if not q_data:
         raise HTTPException(status_code=404, detail="Question not found or access denied.")
-    
-    q_data = dict(q_row)
-    s = conn.execute("SELECT * FROM subjects WHERE id = ?", (q_data['subject_id'],)).fetchone()
-    
-    # Fetch images
-    q_imgs = conn.execute("SELECT * FROM question_images WHERE question_id = ? AND image_type = 'question'", (qid,)).fetchall()
-    a_imgs = conn.execute("SELECT * FROM question_images WHERE question_id = ? AND image_type = 'answer'", (qid,)).fetchall()
-    q_data['q_images'] = [dict(i) for i in q_imgs]
-    q_data['a_images'] = [dict(i) for i in a_imgs]
-    
-    # Fetch tags
-    q_tags = conn.execute("SELECT t.name FROM question_tags qt JOIN tags t ON qt.tag_id = t.id WHERE qt.question_id = ?", (qid,)).fetchall()
-    q_data['tags'] = [t['name'] for t in q_tags]
-    
-    conn.close()
-    return templates.TemplateResponse(request, "edit_question.html", {"app_name": get_app_name(), "user": user, "subject": dict(s), "q": q_data})
+    return templates.TemplateResponse(request, "edit_question.html", {"app_name": app_name, "user": user, "subject": dict(s), "q": q_data})
 
 @app.post("/question/{qid}/edit")
 async def edit_question_post(
@@ -780,55 +2880,51 @@ async def edit_question_post(
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
     
-    conn = get_db()
     # Check permission
-    q_row = conn.execute("SELECT id, subject_id, answer_video FROM questions WHERE id = ? AND user_id = ?", (qid, user['id'])).fetchone()
+    q_row = await run_db(db_fetchone, "SELECT id, subject_id, answer_video FROM questions WHERE id = ? AND user_id = ?", (qid, user['id']))
     if not q_row:
-        conn.close()
         return HTMLResponse("Access denied.", status_code=403)
         
     diff_val = 1 if is_difficult else 0
+
+    # Encode new media first; the DB transaction below only does the writes
+    q_files = [f for f in q_files if f.filename]
+    paths = await save_imgs(q_files + [f for f in a_files if f.filename])
+    q_paths, a_paths = paths[:len(q_files)], paths[len(q_files):]
+    v_path = await save_video(v_file) if v_file and v_file.filename else None
+
+    def _update():
+        conn = get_db()
+        conn.execute('''
+            UPDATE questions SET 
+                question_text = ?, 
+                question_type = ?,
+                correct_answer = ?, 
+                option_a = ?, option_b = ?, option_c = ?, option_d = ?, 
+                source = ?, grade = ?, 
+                analysis = ?,
+                is_difficult = ?
+            WHERE id = ? AND user_id = ?
+        ''', (q_text, q_type, ans, a, b, c, d, source, grade, analysis, diff_val, qid, user['id']))
         
-    conn.execute('''
-        UPDATE questions SET 
-            question_text = ?, 
-            question_type = ?,
-            correct_answer = ?, 
-            option_a = ?, option_b = ?, option_c = ?, option_d = ?, 
-            source = ?, grade = ?, 
-            analysis = ?,
-            is_difficult = ?
-        WHERE id = ? AND user_id = ?
-    ''', (q_text, q_type, ans, a, b, c, d, source, grade, analysis, diff_val, qid, user['id']))
-    
-    process_question_tags(conn, qid, q_row['subject_id'], tags)
-    
-    # Process new question images
-    if q_files:
-        for f in q_files:
-            if f.filename:
-                path = await save_img(f)
-                if path:
-                    conn.execute("INSERT INTO question_images (question_id, path, image_type) VALUES (?, ?, 'question')", (qid, path))
-                    
-    # Process new answer images
-    if a_files:
-        for f in a_files:
-            if f.filename:
-                path = await save_img(f)
-                if path:
-                    conn.execute("INSERT INTO question_images (question_id, path, image_type) VALUES (?, ?, 'answer')", (qid, path))
-                    
-    # Process new video
-    if v_file and v_file.filename:
-        v_path = await save_video(v_file)
+        process_question_tags(conn, qid, q_row['subject_id'], tags)
+        
+        # Process new question / answer images
+        for path in q_paths:
+            conn.execute("INSERT INTO question_images (question_id, path, image_type) VALUES (?, ?, 'question')", (qid, path))
+        for path in a_paths:
+            conn.execute("INSERT INTO question_images (question_id, path, image_type) VALUES (?, ?, 'answer')", (qid, path))
+                        
+        # Process new video
         if v_path:
             # optionally delete old video file from disk here if needed, but not required
             conn.execute("UPDATE questions SET answer_video = ? WHERE id = ?", (v_path, qid))
 
-    conn.commit()
-    conn.close()
-    
+        refresh_question_fingerprint(conn, qid)
+        conn.commit()
+        conn.close()
+
+    await run_db(_update)
     return RedirectResponse("/manage", status_code=303)
 
 @app.post("/api/delete-media/{media_id}")
@@ -836,100 +2932,103 @@ async def delete_media(request: Request, media_id: int):
     user = await get_current_user(request)
     if not user: raise HTTPException(status_code=401)
     
-    conn = get_db()
-    # verify ownership
-    row = conn.execute('''
-        SELECT qi.path FROM question_images qi
-        JOIN questions q ON qi.question_id = q.id
-        WHERE qi.id = ? AND q.user_id = ?
-    ''', (media_id, user['id'])).fetchone()
-    
-    if row:
-        filename = row['path']
-        # path stored is just filename (e.g. "abc123.webp"), construct full disk path
-        full_path = os.path.join(UPLOAD_DIR, os.path.basename(filename))
-        if os.path.exists(full_path):
-            try:
-                os.remove(full_path)
-            except Exception as e:
-                print(f"Error removing file {full_path}: {e}")
-        
-        conn.execute("DELETE FROM question_images WHERE id = ?", (media_id,))
-        conn.commit()
-        res = {"success": True}
-    else:
-        res = {"error": "Media not found or permission denied"}
-        
-    conn.close()
-    return JSONResponse(content=res)
+    def _delete():
+        conn = get_db()
+        # verify ownership
+        row = conn.execute('''
+            SELECT qi.path, qi.question_id FROM question_images qi
+            JOIN questions q ON qi.question_id = q.id
+            WHERE qi.id = ? AND q.user_id = ?
+        ''', (media_id, user['id'])).fetchone()
 
-@app.post("/api/delete-video/{qid}")
-async def delete_video(request: Request, qid: int):
-    user = await get_current_user(request)
-    if not user: raise HTTPException(status_code=401)
-    
-    conn = get_db()
-    row = conn.execute("SELECT answer_video FROM questions WHERE id = ? AND user_id = ?", (qid, user['id'])).fetchone()
+        if row:
+            # The file is shared by content hash; gc_media() unlinks it once unreferenced
+            conn.execute("DELETE FROM question_images WHERE id = ?", (media_id,))
+            refresh_question_fingerprint(conn, row['question_id'])
+            conn.commit()
+            res = {"success": True}
+        else:
+            res = {"error": "Media not found or permission denied"}
+
+        conn.close()
+        return JSONResponse(content=res)
+
+    return await run_db(_delete)
+
+@app.post("/api/delete-video/{qid}")
+async def delete_video(request: Request, qid: int):
+    user = await get_current_user(request)
+    if not user: raise HTTPException(status_code=401)
     
-    if row and row['answer_video']:
-        vid_filename = row['answer_video']
-        # answer_video stores just the filename; build full disk path
-        if vid_filename.startswith('/'):
-            full_path = vid_filename
+    def _delete():
+        conn = get_db()
+        row = conn.execute("SELECT answer_video FROM questions WHERE id = ? AND user_id = ?", (qid, user['id'])).fetchone()
+
+        if row and row['answer_video']:
+            vid_filename = row['answer_video']
+            # answer_video stores just the filename; build full disk path
+            if vid_filename.startswith('/'):
+                full_path = vid_filename
+            else:
+                full_path = os.path.join(VIDEO_UPLOAD_DIR, os.path.basename(vid_filename))
+            if os.path.exists(full_path):
+                try:
+                    os.remove(full_path)
+                except Exception:
+                    pass
+
+            conn.execute("UPDATE questions SET answer_video = NULL WHERE id = ?", (qid,))
+            conn.commit()
+            res = {"success": True}
         else:
-            full_path = os.path.join(VIDEO_UPLOAD_DIR, os.path.basename(vid_filename))
-        if os.path.exists(full_path):
-            try:
-                os.remove(full_path)
-            except Exception:
-                pass
-        
-        conn.execute("UPDATE questions SET answer_video = NULL WHERE id = ?", (qid,))
-        conn.commit()
-        res = {"success": True}
-    else:
-        res = {"error": "Question not found or video does not exist"}
-        
-    conn.close()
-    return JSONResponse(content=res)
+            res = {"error": "Question not found or video does not exist"}
+
+        conn.close()
+        return JSONResponse(content=res)
+
+    return await run_db(_delete)
 
 @app.get("/papers", response_class=HTMLResponse)
 async def papers_page(request: Request):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db()
+
+    def _load():
+        conn = get_db()
     
-    active_grade = unquote(request.cookies.get('active_grade', ''))
-    p_cond = " AND (p.grade = ? OR p.grade IS NULL)" if active_grade else ""
-    p_params = [active_grade] if active_grade else []
+        active_grade = unquote(request.cookies.get('active_grade', ''))
+        p_cond = " AND (p.grade = ? OR p.grade IS NULL)" if active_grade else ""
+        p_params = [active_grade] if active_grade else []
     
-    # Fetch papers and mark if assigned
-    ps = conn.execute(f'''
-        SELECT p.*, s.name as s_name, COUNT(q.id) as q_count,
-        CASE WHEN p.user_id != ? THEN 1 ELSE 0 END as is_assigned
-        FROM papers p 
-        JOIN subjects s ON p.subject_id = s.id 
-        LEFT JOIN questions q ON p.id = q.paper_id 
-        LEFT JOIN paper_assignments pa ON p.id = pa.paper_id
-        WHERE (p.user_id = ? OR pa.user_id = ?){p_cond}
-        GROUP BY p.id ORDER BY p.created_at DESC
-    ''', [user['id'], user['id'], user['id']] + p_params).fetchall()
+        # Fetch papers and mark if assigned
+        ps = conn.execute(f'''
+            SELECT p.*, s.name as s_name, COUNT(q.id) as q_count,
+            CASE WHEN p.user_id != ? THEN 1 ELSE 0 END as is_assigned
+            FROM papers p 
+            JOIN subjects s ON p.subject_id = s.id 
+            LEFT JOIN questions q ON p.id = q.paper_id 
+            LEFT JOIN paper_assignments pa ON p.id = pa.paper_id
+            WHERE (p.user_id = ? OR pa.user_id = ?){p_cond}
+            GROUP BY p.id ORDER BY p.created_at DESC
+        ''', [user['id'], user['id'], user['id']] + p_params).fetchall()
     
-    subs = conn.execute("SELECT * FROM subjects WHERE user_id = ? ORDER BY name", (user['id'],)).fetchall()
+        subs = get_user_subjects(user['id'])
     
-    # Fetch other users for distribution if admin
-    other_users = []
-    if user['role'] == 'admin':
-        other_users = [dict(u) for u in conn.execute("SELECT id, username FROM users WHERE id != ?", (user['id'],)).fetchall()]
+        # Fetch other users for distribution if admin
+        other_users = []
+        if user['role'] == 'admin':
+            other_users = [u for u in get_all_users() if u['id'] != user['id']]
         
-    conn.close()
-    return templates.TemplateResponse(request, "papers.html", {
-        "app_name": get_app_name(), 
-        "user": user, 
-        "papers": [dict(p) for p in ps], 
-        "subjects": [dict(s) for s in subs],
-        "all_users": other_users
-    })
+        conn.close()
+        return {
+            "app_name": get_app_name(), 
+            "user": user, 
+            "papers": [dict(p) for p in ps], 
+            "subjects": subs,
+            "all_users": other_users
+        }
+
+    return templates.TemplateResponse(request, "papers.html", await run_db(_load))
 
 @app.post("/paper/add")
 async def add_paper(request: Request, name: str = Form(...), sid: int = Form(...)):
@@ -939,206 +3038,225 @@ async def add_paper(request: Request, name: str = Form(...), sid: int = Form(...
     active_grade = unquote(request.cookies.get('active_grade', ''))
     grade_val = active_grade if active_grade else None
     
-    conn = get_db()
-    conn.execute("INSERT OR IGNORE INTO papers (name, subject_id, user_id, grade) VALUES (?,?,?,?)", (name.strip(), sid, user['id'], grade_val))
-    conn.commit(); conn.close(); return RedirectResponse("/papers", status_code=303)
+    await write_execute("INSERT OR IGNORE INTO papers (name, subject_id, user_id, grade) VALUES (?,?,?,?)", (name.strip(), sid, user['id'], grade_val))
+    invalidate_ref(('papers', user['id']))
+    return RedirectResponse("/papers", status_code=303)
 
 @app.get("/paper/{pid}", response_class=HTMLResponse)
 async def paper_detail(request: Request, pid: int):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db()
-    p = conn.execute('''
+    p = await run_db(db_fetchone, '''
         SELECT p.*, s.name as s_name FROM papers p 
         JOIN subjects s ON p.subject_id = s.id 
         LEFT JOIN paper_assignments pa ON p.id = pa.paper_id
         WHERE p.id = ? AND (p.user_id = ? OR pa.user_id = ?)
-    ''', (pid, user['id'], user['id'])).fetchone()
-    if not p: conn.close(); raise HTTPException(404)
+    ''', (pid, user['id'], user['id']))
+    if not p: raise HTTPException(404)
+
+    def _load():
+        conn = get_db()
+        try:
+            # V1.3.6: Update query to fetch User Status for Paper Questions
+            q_ids_rows = conn.execute("SELECT id FROM questions WHERE paper_id = ? ORDER BY id ASC", (pid,)).fetchall()
+            q_ids = [r['id'] for r in q_ids_rows]
+            return get_questions_data(conn, q_ids, user['id']), get_app_name()
+        finally:
+            conn.close()
+
     try:
-        # V1.3.6: Update query to fetch User Status for Paper Questions
-        q_ids_rows = conn.execute("SELECT id FROM questions WHERE paper_id = ? ORDER BY id ASC", (pid,)).fetchall()
-        q_ids = [r['id'] for r in q_ids_rows]
-        
-        questions = []
-        for qid in q_ids:
-            q = get_question_data(conn, qid, user['id'])
-            # Ensure status is present (get_question_data adds it, but let's verify)
-            if q: questions.append(q)
-        
+        questions, app_name = await run_db(_load)
         is_owner = p['user_id'] == user['id']
-        conn.close(); return templates.TemplateResponse(request, "paper_detail.html", {
-            "app_name": get_app_name(), 
+        return templates.TemplateResponse(request, "paper_detail.html", {
+            "app_name": app_name, 
             "user": user, 
             "paper": dict(p), 
             "questions": questions,
             "is_owner": is_owner
         })
     except Exception as e:
-        conn.close()
         return HTMLResponse(content=f"<h1>Error in Paper Detail</h1><pre>{e}</pre>", status_code=500)
 
 @app.post("/paper/delete/{pid}")
 async def delete_paper(request: Request, pid: int):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db()
-    # Check ownership
-    p = conn.execute("SELECT user_id FROM papers WHERE id = ?", (pid,)).fetchone()
-    if p and p['user_id'] == user['id']:
-        # V1.3.15: Cascade delete questions first
-        conn.execute("DELETE FROM questions WHERE paper_id = ?", (pid,))
-        conn.execute("DELETE FROM papers WHERE id = ?", (pid,))
-        conn.commit()
-    conn.close()
+
+    def _delete():
+        conn = get_db()
+        # Check ownership
+        p = conn.execute("SELECT user_id FROM papers WHERE id = ?", (pid,)).fetchone()
+        if p and p['user_id'] == user['id']:
+            # V1.3.15: Cascade delete questions first
+            conn.execute("DELETE FROM questions WHERE paper_id = ?", (pid,))
+            conn.execute("DELETE FROM papers WHERE id = ?", (pid,))
+            conn.commit()
+        conn.close()
+
+    await run_db(_delete)
+    invalidate_ref(('papers', user['id']))
     return RedirectResponse("/papers", status_code=303)
 
 @app.get("/paper/{pid}/test", response_class=HTMLResponse)
 async def paper_test(request: Request, pid: int):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db()
+
+    def _load():
+        conn = get_db()
+        try:
+            p = conn.execute('''
+                SELECT p.* FROM papers p 
+                LEFT JOIN paper_assignments pa ON p.id = pa.paper_id
+                WHERE p.id = ? AND (p.user_id = ? OR pa.user_id = ?)
+            ''', (pid, user['id'], user['id'])).fetchone()
+            if not p: return None, []
+
+            ids = [r['id'] for r in conn.execute("SELECT id FROM questions WHERE paper_id = ? ORDER BY id ASC", (pid,)).fetchall()]
+            return p, {**deck_context(conn, ids, user['id']), "app_name": get_app_name()}
+        finally:
+            conn.close()
+
     try:
-        p = conn.execute('''
-            SELECT p.* FROM papers p 
-            LEFT JOIN paper_assignments pa ON p.id = pa.paper_id
-            WHERE p.id = ? AND (p.user_id = ? OR pa.user_id = ?)
-        ''', (pid, user['id'], user['id'])).fetchone()
-        
+        p, deck = await run_db(_load)
         if not p: 
-            conn.close()
             return HTMLResponse("<h1>Access Denied or Not Found / 无权访问或试卷不存在</h1>", status_code=404)
 
-        ids = [r['id'] for r in conn.execute("SELECT id FROM questions WHERE paper_id = ? ORDER BY id ASC", (pid,)).fetchall()]
-        questions = [get_question_data(conn, qid, user['id']) for qid in ids]
-        questions = [q for q in questions if q]
-        
-        conn.close()
         # V1.3.9: Pass mode='paper_test' to distinguish in template if needed
-        return templates.TemplateResponse(request, "study.html", {"app_name": get_app_name(), "user": user, "subject": {"name": p['name'], "id": p['subject_id']}, "questions": questions, "mode": "paper_test", "is_paper": True})
+        return templates.TemplateResponse(request, "study.html", {"user": user, "subject": {"name": p['name'], "id": p['subject_id']}, **deck, "mode": "paper_test", "is_paper": True})
     except Exception as e:
-        conn.close()
         return HTMLResponse(content=f"<h1>Error in Paper Test</h1><pre>{e}</pre>", status_code=500)
 
 @app.get("/manage", response_class=HTMLResponse)
 async def manage(request: Request, sid: Optional[int] = None, sort: Optional[str] = None, tag_id: Optional[int] = None):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db(); subs = conn.execute("SELECT * FROM subjects WHERE user_id = ? ORDER BY name", (user['id'],)).fetchall()
+
+    def _load():
+        conn = get_db(); subs = get_user_subjects(user['id'])
     
-    # Fetch tags for sidebar if a subject is selected
-    tags = []
-    if sid:
-        # Only show tags that are actually used in the user's questions
-        tags = conn.execute('''
-            SELECT DISTINCT t.* FROM tags t
-            JOIN question_tags qt ON t.id = qt.tag_id
-            JOIN questions q ON qt.question_id = q.id
-            WHERE t.subject_id = ? AND q.user_id = ? AND q.paper_id IS NULL
-            ORDER BY t.name
-        ''', (sid, user['id'])).fetchall()
-
-    q_str = '''
-        SELECT q.*, s.name as s_name, 
-               uqs.is_difficult as user_is_difficult 
-        FROM questions q 
-        JOIN subjects s ON q.subject_id = s.id 
-        LEFT JOIN user_question_status uqs ON q.id = uqs.question_id AND uqs.user_id = ? 
-    '''
-    if tag_id:
-        q_str += " JOIN question_tags qt ON q.id = qt.question_id WHERE qt.tag_id = ? AND q.paper_id IS NULL AND q.user_id = ?"
-        params = [user['id'], tag_id, user['id']]
-    else:
-        q_str += " WHERE q.paper_id IS NULL AND q.user_id = ?"
-        params = [user['id'], user['id']]
+        # Fetch tags for sidebar if a subject is selected
+        tags = []
+        if sid:
+            # Only show tags that are actually used in the user's questions
+            tags = conn.execute('''
+                SELECT DISTINCT t.* FROM tags t
+                JOIN question_tags qt ON t.id = qt.tag_id
+                JOIN questions q ON qt.question_id = q.id
+                WHERE t.subject_id = ? AND q.user_id = ? AND q.paper_id IS NULL
+                ORDER BY t.name
+            ''', (sid, user['id'])).fetchall()
+
+        q_str = '''
+            SELECT q.*, s.name as s_name, 
+                   uqs.is_difficult as user_is_difficult 
+            FROM questions q 
+            JOIN subjects s ON q.subject_id = s.id 
+            LEFT JOIN user_question_status uqs ON q.id = uqs.question_id AND uqs.user_id = ? 
+        '''
+        if tag_id:
+            q_str += " JOIN question_tags qt ON q.id = qt.question_id WHERE qt.tag_id = ? AND q.paper_id IS NULL AND q.user_id = ?"
+            params = [user['id'], tag_id, user['id']]
+        else:
+            q_str += " WHERE q.paper_id IS NULL AND q.user_id = ?"
+            params = [user['id'], user['id']]
     
-    active_grade = unquote(request.cookies.get('active_grade', ''))
-    if active_grade:
-        q_str += " AND (q.grade = ? OR q.grade IS NULL)"
-        params.append(active_grade)
+        active_grade = unquote(request.cookies.get('active_grade', ''))
+        if active_grade:
+            q_str += " AND (q.grade = ? OR q.grade IS NULL)"
+            params.append(active_grade)
         
-    if sid: q_str += " AND q.subject_id = ?"; params.append(sid)
+        if sid: q_str += " AND q.subject_id = ?"; params.append(sid)
     
-    if sort == 'type':
-        q_str += " ORDER BY q.subject_id ASC, q.question_type ASC, q.created_at DESC"
-    else:
-        q_str += " ORDER BY q.created_at DESC"
+        if sort == 'type':
+            q_str += " ORDER BY q.subject_id ASC, q.question_type ASC, q.created_at DESC"
+        else:
+            q_str += " ORDER BY q.created_at DESC"
         
-    qs = conn.execute(q_str, params).fetchall()
+        qs = conn.execute(q_str, params).fetchall()
     
-    # Process to overwrite legacy is_difficult and fetch tags per question
-    questions = []
-    if qs:
-        # Batch fetch tags to avoid N+1 queries
-        q_ids = [r['id'] for r in qs]
-        placeholders = ','.join(['?'] * len(q_ids))
-        tags_query = f'''
-            SELECT qt.question_id, t.id, t.name 
-            FROM question_tags qt 
-            JOIN tags t ON qt.tag_id = t.id 
-            WHERE qt.question_id IN ({placeholders})
-        '''
-        tags_rows = conn.execute(tags_query, q_ids).fetchall()
-        tags_map = {}
-        for row in tags_rows:
-            tags_map.setdefault(row['question_id'], []).append({'id': row['id'], 'name': row['name']})
+        # Process to overwrite legacy is_difficult and fetch tags per question
+        questions = []
+        if qs:
+            # Batch fetch tags to avoid N+1 queries
+            q_ids = [r['id'] for r in qs]
+            placeholders = ','.join(['?'] * len(q_ids))
+            tags_query = f'''
+                SELECT qt.question_id, t.id, t.name 
+                FROM question_tags qt 
+                JOIN tags t ON qt.tag_id = t.id 
+                WHERE qt.question_id IN ({placeholders})
+            '''
+            tags_rows = conn.execute(tags_query, q_ids).fetchall()
+            tags_map = {}
+            for row in tags_rows:
+                tags_map.setdefault(row['question_id'], []).append({'id': row['id'], 'name': row['name']})
 
-        for r in qs:
-            d = dict(r)
-            if d['user_is_difficult'] is not None:
-                d['is_difficult'] = d['user_is_difficult']
-            d['tags'] = tags_map.get(d['id'], [])
-            questions.append(d)
+            for r in qs:
+                d = dict(r)
+                if d['user_is_difficult'] is not None:
+                    d['is_difficult'] = d['user_is_difficult']
+                d['tags'] = tags_map.get(d['id'], [])
+                questions.append(d)
         
-    all_users = conn.execute("SELECT id, username, role FROM users ORDER BY username").fetchall()
-    conn.close()
-    return templates.TemplateResponse(request, "manage.html", {
-        "app_name": get_app_name(), "user": user, 
-        "questions": questions, "subjects": [dict(s) for s in subs], 
-        "current_sid": sid, "all_users": [dict(u) for u in all_users],
-        "tags": [dict(t) for t in tags], "current_tag_id": tag_id
-    })
+        all_users = sorted(get_all_users(), key=lambda u: u['username'])
+        conn.close()
+        return {
+            "app_name": get_app_name(), "user": user, 
+            "questions": questions, "subjects": subs, 
+            "current_sid": sid, "all_users": all_users,
+            "tags": [dict(t) for t in tags], "current_tag_id": tag_id
+        }
+
+    return templates.TemplateResponse(request, "manage.html", await run_db(_load))
 
 @app.get("/settings", response_class=HTMLResponse)
 async def settings_page(request: Request):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db(); subs = conn.execute("SELECT * FROM subjects WHERE user_id = ? ORDER BY name", (user['id'],)).fetchall(); conn.close()
-    return templates.TemplateResponse(request, "settings.html", {"app_name": get_app_name(), "user": user, "subjects": [dict(s) for s in subs]})
+
+    def _load():
+        return {"app_name": get_app_name(), "user": user, "subjects": get_user_subjects(user['id'])}
+
+    return templates.TemplateResponse(request, "settings.html", await run_db(_load))
 
 # Admin Routes
 @app.get("/admin/users", response_class=HTMLResponse)
 async def admin_users(request: Request):
     user = await get_current_user(request)
     if not user or user['role'] != 'admin': return RedirectResponse("/", status_code=303)
-    conn = get_db(); users = conn.execute("SELECT * FROM users ORDER BY created_at DESC").fetchall(); conn.close()
-    return templates.TemplateResponse(request, "admin_users.html", {"app_name": get_app_name(), "user": user, "users": [dict(u) for u in users]})
+    def _load():
+        return {"app_name": get_app_name(), "user": user, "users": get_all_users()}
+
+    return templates.TemplateResponse(request, "admin_users.html", await run_db(_load))
 
 @app.post("/admin/user/add")
 async def admin_add_user(request: Request, username: str = Form(...), password: str = Form(...), role: str = Form("user"), display_name: str = Form("")):
     user = await get_current_user(request)
     if not user or user['role'] != 'admin': return RedirectResponse("/", status_code=303)
-    conn = get_db(); cur = conn.cursor()
+    password_hash = await run_db(pwd_context.hash, password)
     try:
-        cur.execute("INSERT INTO users (username, password_hash, role, display_name) VALUES (?, ?, ?, ?)", (username.strip(), pwd_context.hash(password), role, display_name.strip()))
-        conn.commit()
+        await write_execute("INSERT INTO users (username, password_hash, role, display_name) VALUES (?, ?, ?, ?)", (username.strip(), password_hash, role, display_name.strip()))
     except: pass
-    conn.close(); return RedirectResponse("/admin/users", status_code=303)
+    invalidate_ref(('users',))
+    return RedirectResponse("/admin/users", status_code=303)
 
 @app.post("/admin/user/delete/{uid}")
 async def admin_delete_user(request: Request, uid: int):
     user = await get_current_user(request)
     if not user or user['role'] != 'admin' or user['id'] == uid: return RedirectResponse("/", status_code=303)
-    conn = get_db(); conn.execute("DELETE FROM users WHERE id = ?", (uid,)); conn.commit(); conn.close()
+    await write_execute("DELETE FROM users WHERE id = ?", (uid,))
+    invalidate_user(uid=uid)
+    invalidate_ref(('users',), ('subjects', uid), ('papers', uid))
     return RedirectResponse("/admin/users", status_code=303)
 
 @app.post("/admin/user/update-name")
 async def admin_update_name(request: Request, uid: int = Form(...), display_name: str = Form("")):
     user = await get_current_user(request)
     if not user or user['role'] != 'admin': return RedirectResponse("/", status_code=303)
-    conn = get_db()
-    conn.execute("UPDATE users SET display_name = ? WHERE id = ?", (display_name.strip(), uid))
-    conn.commit(); conn.close()
+    await write_execute("UPDATE users SET display_name = ? WHERE id = ?", (display_name.strip(), uid))
+    invalidate_user(uid=uid)
+    invalidate_ref(('users',))
     return RedirectResponse("/admin/users", status_code=303)
 
 @app.post("/admin/distribute")
@@ -1146,190 +3264,302 @@ async def admin_distribute(request: Request):
     user = await get_current_user(request)
     if not user or user['role'] != 'admin': return JSONResponse({"error": "Unauthorized"}, status_code=401)
     data = await request.json()
-    pid, target_uids = data['pid'], data['uids']; conn = get_db()
-    for uid in target_uids:
-        conn.execute("INSERT OR IGNORE INTO paper_assignments (paper_id, user_id, assigned_by) VALUES (?, ?, ?)", (pid, uid, user['id']))
-    conn.commit(); conn.close(); return {"status": "ok"}
+    pid, target_uids = data['pid'], data['uids']
+
+    def _assign():
+        conn = get_db()
+        try:
+            for uid in target_uids:
+                conn.execute("INSERT OR IGNORE INTO paper_assignments (paper_id, user_id, assigned_by) VALUES (?, ?, ?)", (pid, uid, user['id']))
+            conn.commit()
+        finally:
+            conn.close()
+
+    await run_db(_assign)
+    return {"status": "ok"}
 
 @app.post("/admin/revoke/{pid}")
 async def admin_revoke(request: Request, pid: int):
     user = await get_current_user(request)
     if not user or user['role'] != 'admin': return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    conn = get_db(); conn.execute("DELETE FROM paper_assignments WHERE paper_id = ? AND assigned_by = ?", (pid, user['id']))
-    conn.commit(); conn.close(); return {"status": "ok"}
+    await write_execute("DELETE FROM paper_assignments WHERE paper_id = ? AND assigned_by = ?", (pid, user['id']))
+    return {"status": "ok"}
+
+@app.post("/api/deck")
+async def deck_window(request: Request):
+    """Hydrate one window of a study deck; ids the user cannot see are dropped."""
+    user = await get_current_user(request)
+    if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    data = await request.json()
+    try:
+        ids = [int(i) for i in data.get('ids', [])][:DECK_MAX_WINDOW]
+    except (TypeError, ValueError):
+        return JSONResponse({"error": "Invalid ids"}, status_code=400)
+
+    def _load():
+        conn = get_db()
+        try:
+            return get_questions_data(conn, ids, user['id'])
+        finally:
+            conn.close()
+
+    return {"questions": await run_db(_load)}
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+def _like_escape(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+@app.get("/api/search")
+async def search_questions(request: Request, q: str = "", sid: Optional[int] = None, page: int = 1, size: int = SEARCH_PAGE_SIZE):
+    """Ranked search over owned + assigned questions.
+
+    Terms of 3+ characters go through the trigram FTS index (bm25 ranked);
+    shorter terms, or a build without trigram support, use LIKE filters.
+    """
+    user = await get_current_user(request)
+    if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    terms = q.split()
+    if not terms: return {"results": [], "page": 1, "has_more": False}
+    page = max(1, page); size = max(1, min(size, SEARCH_MAX_PAGE_SIZE))
+
+    fts_terms = [t for t in terms if len(t) >= 3] if FTS_ENABLED else []
+    like_terms = [t for t in terms if t not in fts_terms]
+
+    sql = "SELECT q.id, q.subject_id, q.paper_id, q.question_type, q.grade, q.question_text, q.source"
+    params = []
+    if fts_terms:
+        sql += f", bm25(questions_fts, {', '.join(map(str, FTS_WEIGHTS))}) as score FROM questions_fts JOIN questions q ON q.id = questions_fts.rowid"
+    else:
+        sql += ", 0 as score FROM questions q"
+    # EXISTS rather than a join: repeated assignments must not duplicate hits (and bm25 forbids GROUP BY)
+    sql += " WHERE (q.user_id = ? OR EXISTS (SELECT 1 FROM paper_assignments pa WHERE pa.paper_id = q.paper_id AND pa.user_id = ?))"
+    params += [user['id'], user['id']]
+    if fts_terms:
+        sql += " AND questions_fts MATCH ?"
+        params.append(' AND '.join('"' + t.replace('"', '""') + '"' for t in fts_terms))
+    for t in like_terms:
+        sql += " AND (" + " OR ".join(f"q.{col} LIKE ? ESCAPE '\\'" for col in FTS_COLUMNS) + ")"
+        params += [f"%{_like_escape(t)}%"] * len(FTS_COLUMNS)
+    if sid is not None:
+        sql += " AND q.subject_id = ?"
+        params.append(sid)
+    sql += " ORDER BY score, q.id DESC LIMIT ? OFFSET ?"
+    params += [size + 1, (page - 1) * size]
+
+    rows = await run_db(db_fetchall, sql, params)
+    return {"results": [dict(r) for r in rows[:size]], "page": page, "has_more": len(rows) > size}
+
+def advance_session(conn, user_id, session_id, cursor):
+    conn.execute("UPDATE study_sessions SET cursor = MIN(?, total), updated_at = CURRENT_TIMESTAMP WHERE id = ? AND user_id = ?",
+                 (max(0, cursor), session_id, user_id))
+
+@app.post("/api/study-session/{session_id}/cursor")
+async def study_session_cursor(request: Request, session_id: int):
+    user = await get_current_user(request)
+    if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    data = await request.json()
+    try:
+        pos = int(data['pos'])
+    except (KeyError, TypeError, ValueError):
+        return JSONResponse({"error": "Invalid pos"}, status_code=400)
+    await submit_write(advance_session, user['id'], session_id, pos)
+    return {"status": "ok"}
 
 # Refactored API
 @app.post("/api/record")
 async def record(request: Request):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    data = await request.json(); qid, ok = data['qid'], data['ok']; conn = get_db(); cur = conn.cursor()
+    data = await request.json(); qid, ok = data['qid'], data['ok']
+    session_id, pos = data.get('session_id'), data.get('pos')
+
+    # V3.2: Goes through the single writer so a classroom of answers shares one commit
+    def _apply(conn):
+        cur = conn.cursor()
     
-    # Check permission (simple existence check)
-    allowed = cur.execute("SELECT 1 FROM questions WHERE id = ?", (qid,)).fetchone()
-    if not allowed: conn.close(); return JSONResponse({"error": "Question not found"}, status_code=404)
+        # Check permission (simple existence check)
+        allowed = cur.execute("SELECT 1 FROM questions WHERE id = ?", (qid,)).fetchone()
+        if not allowed: return JSONResponse({"error": "Question not found"}, status_code=404)
     
-    # Check if status record exists
-    status_row = cur.execute("SELECT wrong_count, is_difficult FROM user_question_status WHERE user_id = ? AND question_id = ?", (user['id'], qid)).fetchone()
+        # Check if status record exists
+        status_row = cur.execute("SELECT wrong_count, is_difficult FROM user_question_status WHERE user_id = ? AND question_id = ?", (user['id'], qid)).fetchone()
     
-    if not status_row:
-        # Create new record
-        wc = 0 if ok else 1
-        hw = 0 if ok else 1
-        is_diff = 0
-        cur.execute("INSERT INTO user_question_status (user_id, question_id, wrong_count, history_wrong, is_difficult) VALUES (?, ?, ?, ?, ?)", (user['id'], qid, wc, hw, is_diff))
-    else:
-        # Update existing
-        if ok:
-            # CORRECT: Clear active wrong_count, keep history and difficulty (manual clear only for difficult)
-            cur.execute("UPDATE user_question_status SET wrong_count = 0 WHERE user_id = ? AND question_id = ?", (user['id'], qid))
+        if not status_row:
+            # Create new record
+            wc = 0 if ok else 1
+            hw = 0 if ok else 1
+            is_diff = 0
+            cur.execute("INSERT INTO user_question_status (user_id, question_id, wrong_count, history_wrong, is_difficult) VALUES (?, ?, ?, ?, ?)", (user['id'], qid, wc, hw, is_diff))
         else:
-            # WRONG: Increment wrong_count, set history_wrong
-            new_wc = status_row['wrong_count'] + 1
-            # Auto-mark difficult if wrong >= 2 times (Active count)
-            new_diff = 1 if new_wc >= 2 else status_row['is_difficult']
-            cur.execute("UPDATE user_question_status SET wrong_count = ?, history_wrong = 1, is_difficult = ? WHERE user_id = ? AND question_id = ?", (new_wc, new_diff, user['id'], qid))
+            # Update existing
+            if ok:
+                # CORRECT: Clear active wrong_count, keep history and difficulty (manual clear only for difficult)
+                cur.execute("UPDATE user_question_status SET wrong_count = 0 WHERE user_id = ? AND question_id = ?", (user['id'], qid))
+            else:
+                # WRONG: Increment wrong_count, set history_wrong
+                new_wc = status_row['wrong_count'] + 1
+                # Auto-mark difficult if wrong >= 2 times (Active count)
+                new_diff = 1 if new_wc >= 2 else status_row['is_difficult']
+                cur.execute("UPDATE user_question_status SET wrong_count = ?, history_wrong = 1, is_difficult = ? WHERE user_id = ? AND question_id = ?", (new_wc, new_diff, user['id'], qid))
     
-    # Record study log with LOCAL TIME
-    try:
+        # Record study log with LOCAL TIME
         cur.execute("INSERT INTO study_records (user_id, question_id, is_correct, studied_at) VALUES (?,?,?, datetime('now', 'localtime'))", (user['id'], qid, ok))
-        conn.commit()
+        cur.execute('''INSERT INTO study_daily_stats (user_id, day, subject_id, attempts, correct)
+                       VALUES (?, date('now', 'localtime'), IFNULL((SELECT subject_id FROM questions WHERE id = ?), 0), 1, ?)
+                       ON CONFLICT (user_id, day, subject_id) DO UPDATE SET attempts = attempts + 1, correct = correct + excluded.correct''',
+                    (user['id'], qid, 1 if ok else 0))
+        if session_id is not None and pos is not None:
+            advance_session(conn, user['id'], session_id, int(pos) + 1)
+        return {"status": "ok"}
+
+    try:
+        return await submit_write(_apply)
     except Exception as e:
+        # The writer rolled back this answer's savepoint; the rest of the batch still commits
         print(f"Record API Error: {e}")
-        conn.rollback() # Ensure rollback on error to release locks
         return JSONResponse({"error": f"Database Error: {str(e)}"}, status_code=500)
-    finally:
-        conn.close()
-    
-    return {"status": "ok"}
 
 @app.post("/api/delete/{qid}")
 async def delete_q(request: Request, qid: int):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    conn = get_db(); conn.execute("DELETE FROM questions WHERE id = ? AND user_id = ?", (qid, user['id'])); conn.commit(); conn.close()
+    await write_execute("DELETE FROM questions WHERE id = ? AND user_id = ?", (qid, user['id']))
     return {"status": "ok"}
 
 @app.post("/api/clear-status/{qid}")
 async def clear_status(request: Request, qid: int):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    conn = get_db(); conn.execute("UPDATE user_question_status SET wrong_count = 0, is_difficult = 0 WHERE user_id = ? AND question_id = ?", (user['id'], qid)); conn.commit(); conn.close()
+    await write_execute("UPDATE user_question_status SET wrong_count = 0, is_difficult = 0 WHERE user_id = ? AND question_id = ?", (user['id'], qid))
     return {"status": "ok"}
 
 @app.post("/api/unmark-difficult/{qid}")
 async def unmark_difficult(request: Request, qid: int):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    conn = get_db(); conn.execute("UPDATE user_question_status SET is_difficult = 0, wrong_count = 0 WHERE question_id = ? AND user_id = ?", (qid, user['id'])); conn.commit(); conn.close()
+    await write_execute("UPDATE user_question_status SET is_difficult = 0, wrong_count = 0 WHERE question_id = ? AND user_id = ?", (qid, user['id']))
     return {"status": "ok"}
 
 @app.post("/api/clone-to-bank/{qid}")
 async def clone_to_bank(request: Request, qid: int):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    conn = get_db(); cur = conn.cursor()
-    # Updated check: allow if owned OR assigned
-    q = cur.execute('''
-        SELECT q.*, s.name as s_name FROM questions q 
-        JOIN subjects s ON q.subject_id = s.id
-        LEFT JOIN paper_assignments pa ON q.paper_id = pa.paper_id
-        WHERE q.id = ? AND (q.user_id = ? OR pa.user_id = ?)
-    ''', (qid, user['id'], user['id'])).fetchone()
+
+    def _clone():
+        conn = get_db(); cur = conn.cursor()
+        # Updated check: allow if owned OR assigned
+        q = cur.execute('''
+            SELECT q.*, s.name as s_name FROM questions q 
+            JOIN subjects s ON q.subject_id = s.id
+            LEFT JOIN paper_assignments pa ON q.paper_id = pa.paper_id
+            WHERE q.id = ? AND (q.user_id = ? OR pa.user_id = ?)
+        ''', (qid, user['id'], user['id'])).fetchone()
     
-    if not q: conn.close(); return JSONResponse({"error": "Not found or No permission"}, status_code=404)
-    q = dict(q)  # Convert Row to dict for .get() support
+        if not q: conn.close(); return JSONResponse({"error": "Not found or No permission"}, status_code=404)
+        q = dict(q)  # Convert Row to dict for .get() support
     
-    try:
-        # Map subject: find or create same-named subject for current user
-        target_sub = cur.execute("SELECT id FROM subjects WHERE name = ? AND user_id = ?", (q['s_name'], user['id'])).fetchone()
-        if target_sub:
-            target_sid = target_sub['id']
-        else:
-            cur.execute("INSERT INTO subjects (name, user_id) VALUES (?, ?)", (q['s_name'], user['id']))
-            target_sid = cur.lastrowid
+        try:
+            # Map subject: find or create same-named subject for current user
+            target_sub = cur.execute("SELECT id FROM subjects WHERE name = ? AND user_id = ?", (q['s_name'], user['id'])).fetchone()
+            if target_sub:
+                target_sid = target_sub['id']
+            else:
+                cur.execute("INSERT INTO subjects (name, user_id) VALUES (?, ?)", (q['s_name'], user['id']))
+                target_sid = cur.lastrowid
             
-        src = q.get('source')
-        if q.get('paper_id') and not src:
-            p = cur.execute("SELECT name FROM papers WHERE id = ?", (q['paper_id'],)).fetchone()
-            if p: src = p['name']
+            src = q.get('source')
+            if q.get('paper_id') and not src:
+                p = cur.execute("SELECT name FROM papers WHERE id = ?", (q['paper_id'],)).fetchone()
+                if p: src = p['name']
             
-        cur.execute('INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, correct_answer, option_a, option_b, option_c, option_d, source, is_difficult, answer_video, grade, analysis) VALUES (?, NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', 
-                    (target_sid, user['id'], q['question_text'], q['question_type'], q['correct_answer'], q.get('option_a'), q.get('option_b'), q.get('option_c'), q.get('option_d'), src, q.get('is_difficult', 0), q.get('answer_video'), q.get('grade'), q.get('analysis')))
-        new_qid = cur.lastrowid
+            cur.execute('INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, correct_answer, option_a, option_b, option_c, option_d, source, is_difficult, answer_video, grade, analysis) VALUES (?, NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', 
+                        (target_sid, user['id'], q['question_text'], q['question_type'], q['correct_answer'], q.get('option_a'), q.get('option_b'), q.get('option_c'), q.get('option_d'), src, q.get('is_difficult', 0), q.get('answer_video'), q.get('grade'), q.get('analysis')))
+            new_qid = cur.lastrowid
         
-        # Clone Tags
-        old_tags = conn.execute('''
-            SELECT t.name FROM question_tags qt
-            JOIN tags t ON qt.tag_id = t.id
-            WHERE qt.question_id = ?
-        ''', (qid,)).fetchall()
-        for t_row in old_tags:
-            t_name = t_row['name']
-            check_tag = cur.execute("SELECT id FROM tags WHERE name = ? AND subject_id = ?", (t_name, target_sid)).fetchone()
-            if check_tag:
-                new_tid = check_tag['id']
-            else:
-                cur.execute("INSERT INTO tags (name, subject_id) VALUES (?, ?)", (t_name, target_sid))
-                new_tid = cur.lastrowid
-            cur.execute("INSERT INTO question_tags (question_id, tag_id) VALUES (?, ?)", (new_qid, new_tid))
+            # Clone Tags
+            old_tags = conn.execute('''
+                SELECT t.name FROM question_tags qt
+                JOIN tags t ON qt.tag_id = t.id
+                WHERE qt.question_id = ?
+            ''', (qid,)).fetchall()
+            for t_row in old_tags:
+                t_name = t_row['name']
+                check_tag = cur.execute("SELECT id FROM tags WHERE name = ? AND subject_id = ?", (t_name, target_sid)).fetchone()
+                if check_tag:
+                    new_tid = check_tag['id']
+                else:
+                    cur.execute("INSERT INTO tags (name, subject_id) VALUES (?, ?)", (t_name, target_sid))
+                    new_tid = cur.lastrowid
+                cur.execute("INSERT INTO question_tags (question_id, tag_id) VALUES (?, ?)", (new_qid, new_tid))
             
-        # Copy images physically
-        imgs = cur.execute("SELECT * FROM question_images WHERE question_id = ?", (qid,)).fetchall()
-        for img in imgs:
-            old_path = os.path.join(UPLOAD_DIR, img['path'])
-            if os.path.exists(old_path):
-                new_name = f"{uuid.uuid4().hex}.webp"
-                shutil.copy2(old_path, os.path.join(UPLOAD_DIR, new_name))
-                cur.execute("INSERT INTO question_images (question_id, path, image_type) VALUES (?, ?, ?)", (new_qid, new_name, img['image_type']))
+            # Share the stored images; the media refcount triggers track the new rows
+            cur.execute("INSERT INTO question_images (question_id, path, image_type) SELECT ?, path, image_type FROM question_images WHERE question_id = ? ORDER BY id", (new_qid, qid))
+            refresh_question_fingerprint(conn, new_qid)
                 
-        conn.commit(); conn.close(); return {"status": "ok"}
-    except Exception as e:
-        print(f"Clone-to-bank error for qid={qid}: {e}")
-        conn.close(); return JSONResponse({"error": str(e)}, status_code=500)
+            conn.commit(); conn.close(); return {"status": "ok"}
+        except Exception as e:
+            print(f"Clone-to-bank error for qid={qid}: {e}")
+            conn.close(); return JSONResponse({"error": str(e)}, status_code=500)
+
+    res = await run_db(_clone)
+    invalidate_ref(('subjects', user['id']))
+    return res
 
 @app.post("/api/reset-stats")
 async def reset_stats(request: Request):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    conn = get_db(); conn.execute("DELETE FROM study_records WHERE user_id = ?", (user['id'],)); conn.execute("UPDATE questions SET wrong_count = 0, is_difficult = 0 WHERE user_id = ?", (user['id'],)); conn.commit(); conn.close()
+    def _reset(conn):
+        conn.execute("DELETE FROM study_records WHERE user_id = ?", (user['id'],))
+        conn.execute("DELETE FROM study_daily_stats WHERE user_id = ?", (user['id'],))
+        conn.execute("UPDATE questions SET wrong_count = 0, is_difficult = 0 WHERE user_id = ?", (user['id'],))
+    await submit_write(_reset)
     return {"status": "ok"}
 
 @app.post("/api/nuclear-reset")
 async def nuclear_reset(request: Request):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    conn = get_db(); c = conn.cursor()
-    c.execute("DELETE FROM study_records WHERE user_id = ?", (user['id'],))
-    c.execute("DELETE FROM question_images WHERE question_id IN (SELECT id FROM questions WHERE user_id = ?)", (user['id'],))
-    c.execute("DELETE FROM questions WHERE user_id = ?", (user['id'],))
-    c.execute("DELETE FROM papers WHERE user_id = ?", (user['id'],))
-    c.execute("DELETE FROM subjects WHERE user_id = ?", (user['id'],))
-    conn.commit(); conn.close(); return {"status": "ok"}
+
+    def _reset():
+        conn = get_db(); c = conn.cursor()
+        c.execute("DELETE FROM study_records WHERE user_id = ?", (user['id'],))
+        c.execute("DELETE FROM study_daily_stats WHERE user_id = ?", (user['id'],))
+        c.execute("DELETE FROM question_images WHERE question_id IN (SELECT id FROM questions WHERE user_id = ?)", (user['id'],))
+        c.execute("DELETE FROM questions WHERE user_id = ?", (user['id'],))
+        c.execute("DELETE FROM papers WHERE user_id = ?", (user['id'],))
+        c.execute("DELETE FROM subjects WHERE user_id = ?", (user['id'],))
+        conn.commit(); conn.close(); return {"status": "ok"}
+
+    res = await run_db(_reset)
+    invalidate_ref(('subjects', user['id']), ('papers', user['id']))
+    return res
 
 @app.get("/api/export/paper/{pid}")
 async def export_paper(request: Request, pid: int):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    conn = get_db()
-    p_row = conn.execute('''SELECT p.*, s.name as s_name FROM papers p JOIN subjects s ON p.subject_id = s.id LEFT JOIN paper_assignments pa ON p.id = pa.paper_id WHERE p.id = ? AND (p.user_id = ? OR pa.user_id = ?)''', (pid, user['id'], user['id'])).fetchone()
-    if not p_row: conn.close(); return JSONResponse({"error": "Not found"}, status_code=404)
-    data = {"paper": dict(p_row), "questions": []}
-    qs = conn.execute("SELECT * FROM questions WHERE paper_id = ?", (pid,)).fetchall()
-    for q in qs:
-        qd = dict(q); qd['images'] = [dict(r) for r in conn.execute("SELECT * FROM question_images WHERE question_id = ?", (q['id'],)).fetchall()]
-        tags = conn.execute("SELECT t.name FROM question_tags qt JOIN tags t ON qt.tag_id = t.id WHERE qt.question_id = ?", (q['id'],)).fetchall()
-        qd['tags'] = [t['name'] for t in tags]
-        data['questions'].append(qd)
-    conn.close()
-    fn = f"{data['paper']['name']}.zip"; fp = f"/tmp/{fn}"
-    with zipfile.ZipFile(fp, 'w') as zf:
-        zf.writestr('data.json', json.dumps(data, ensure_ascii=False))
-        for q in data['questions']:
-            for img in q['images']:
-                ip = os.path.join(UPLOAD_DIR, img['path'])
-                if os.path.exists(ip): zf.write(ip, f"uploads/{img['path']}")
-    return FileResponse(fp, filename=fn)
+
+    def _build():
+        conn = get_db()
+        p_row = conn.execute('''SELECT p.*, s.name as s_name FROM papers p JOIN subjects s ON p.subject_id = s.id LEFT JOIN paper_assignments pa ON p.id = pa.paper_id WHERE p.id = ? AND (p.user_id = ? OR pa.user_id = ?)''', (pid, user['id'], user['id'])).fetchone()
+        if not p_row: conn.close(); return JSONResponse({"error": "Not found"}, status_code=404)
+        data = {"paper": dict(p_row), "questions": []}
+        qs = conn.execute("SELECT * FROM questions WHERE paper_id = ?", (pid,)).fetchall()
+        for q in qs:
+            qd = dict(q); qd['images'] = [dict(r) for r in conn.execute("SELECT * FROM question_images WHERE question_id = ?", (q['id'],)).fetchall()]
+            tags = conn.execute("SELECT t.name FROM question_tags qt JOIN tags t ON qt.tag_id = t.id WHERE qt.question_id = ?", (q['id'],)).fetchall()
+            qd['tags'] = [t['name'] for t in tags]
+            data['questions'].append(qd)
+        conn.close()
+        return data
+
+    data = await run_db(_build)
+    if isinstance(data, JSONResponse): return data
+    entries = itertools.chain([('data.json', json_chunks(data))], image_entries(data['questions']))
+    return zip_response(entries, f"{data['paper']['name']}.zip")
 
 class ExportQuestionsRequest(BaseModel):
     question_ids: List[int]
@@ -1339,253 +3569,358 @@ async def export_questions(request: ExportQuestionsRequest, req: Request):
     user = await get_current_user(req)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
     if not request.question_ids: return JSONResponse({"error": "No questions selected"}, status_code=400)
+
+    def _build(job):
+        conn = get_db()
+        data = {"type": "questions_batch", "questions": []}
     
-    conn = get_db()
-    data = {"type": "questions_batch", "questions": []}
-    
-    placeholders = ','.join('?' * len(request.question_ids))
-    # Verify ownership
-    qs = conn.execute(f"SELECT * FROM questions WHERE id IN ({placeholders}) AND user_id = ?", request.question_ids + [user['id']]).fetchall()
+        placeholders = ','.join('?' * len(request.question_ids))
+        # Verify ownership
+        qs = conn.execute(f"SELECT * FROM questions WHERE id IN ({placeholders}) AND user_id = ?", request.question_ids + [user['id']]).fetchall()
     
-    for q in qs:
-        qd = dict(q)
-        qd['images'] = [dict(r) for r in conn.execute("SELECT * FROM question_images WHERE question_id = ?", (q['id'],)).fetchall()]
-        tags = conn.execute("SELECT t.name FROM question_tags qt JOIN tags t ON qt.tag_id = t.id WHERE qt.question_id = ?", (q['id'],)).fetchall()
-        qd['tags'] = [t['name'] for t in tags]
-        data['questions'].append(qd)
-    conn.close()
+        job.progress(0, len(qs), force=True)
+        for q in qs:
+            qd = dict(q)
+            qd['images'] = [dict(r) for r in conn.execute("SELECT * FROM question_images WHERE question_id = ?", (q['id'],)).fetchall()]
+            tags = conn.execute("SELECT t.name FROM question_tags qt JOIN tags t ON qt.tag_id = t.id WHERE qt.question_id = ?", (q['id'],)).fetchall()
+            qd['tags'] = [t['name'] for t in tags]
+            data['questions'].append(qd)
+            job.progress(len(data['questions']))
+        conn.close()
     
-    if not data['questions']:
-        return JSONResponse({"error": "No valid questions found"}, status_code=404)
+        if not data['questions']:
+            raise JobError("No valid questions found")
         
-    fn = f"study_export_{int(datetime.now().timestamp())}.zip"
-    fp = f"/tmp/{fn}"
-    with zipfile.ZipFile(fp, 'w') as zf:
-        zf.writestr('data.json', json.dumps(data, ensure_ascii=False))
-        for q in data['questions']:
-            for img in q['images']:
-                ip = os.path.join(UPLOAD_DIR, img['path'])
-                if os.path.exists(ip): zf.write(ip, f"uploads/{img['path']}")
-                
-    return FileResponse(fp, filename=fn, media_type="application/zip")
+        fn = f"study_export_{int(datetime.now().timestamp())}.zip"
+        write_zip(job.artifact_path(fn), itertools.chain([('data.json', json_chunks(data))], image_entries(data['questions'])))
+        return {"questions": len(data['questions']), "file": fn}
+
+    return await submit_job(user, 'export-questions', _build)
 
 @app.post("/api/import-questions")
 async def import_questions(request: Request, sid: int = Form(...), file: UploadFile = File(...)):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    
-    conn = get_db()
+
     # verify subject belongs to user
-    sub = conn.execute("SELECT id FROM subjects WHERE id = ? AND user_id = ?", (sid, user['id'])).fetchone()
-    if not sub:
-        conn.close()
+    if not await run_db(db_fetchone, "SELECT id FROM subjects WHERE id = ? AND user_id = ?", (sid, user['id'])):
         return JSONResponse({"error": "Subject not found or access denied"}, status_code=404)
-        
-    tmp = f"/tmp/import_qs_{user['id']}_{file.filename}"
-    with open(tmp, "wb") as f: shutil.copyfileobj(file.file, f)
-    
-    stats = {"total": 0, "success": 0, "duplicate": 0, "failed": 0}
-    try:
-        with zipfile.ZipFile(tmp, 'r') as zf:
-            import_json = json.loads(zf.read('data.json'))
-            if import_json.get('type') != 'questions_batch':
-                return JSONResponse({"error": "Invalid file format. Select a valid question bundle."}, status_code=400)
-            
-            cur = conn.cursor()
-            
-            for q in import_json.get('questions', []):
-                stats["total"] += 1
-                try:
-                    # Duplicate check: same question_text in the same subject
-                    # For images only questions, text might be empty. Check exact dupes.
-                    q_text = q.get('question_text', '').strip()
-                    if q_text:
-                        dup = cur.execute("SELECT id FROM questions WHERE subject_id = ? AND user_id = ? AND TRIM(question_text) = ?", (sid, user['id'], q_text)).fetchone()
-                        if dup:
-                            stats["duplicate"] += 1
-                            continue
-                    
-                    cur.execute(
-                        '''INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, 
-                           correct_answer, option_a, option_b, option_c, option_d, source, grade, analysis) 
-                           VALUES (?,NULL,?,?,?,?,?,?,?,?,?,?,?)''', 
-                        (sid, user['id'], q['question_text'], q['question_type'], q['correct_answer'], 
-                         q.get('option_a'), q.get('option_b'), q.get('option_c'), q.get('option_d'), 
-                         q.get('source'), q.get('grade'), q.get('analysis'))
-                    )
-                    qid = cur.lastrowid
-                    
-                    for t_name in q.get('tags', []):
-                        check_tag = cur.execute("SELECT id FROM tags WHERE name = ? AND subject_id = ?", (t_name, sid)).fetchone()
-                        if check_tag:
-                            new_tid = check_tag['id']
-                        else:
-                            cur.execute("INSERT INTO tags (name, subject_id) VALUES (?, ?)", (t_name, sid))
-                            new_tid = cur.lastrowid
-                        cur.execute("INSERT INTO question_tags (question_id, tag_id) VALUES (?, ?)", (qid, new_tid))
-                    
-                    for img in q.get('images', []):
-                        cur.execute('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', (qid, img['path'], img['image_type']))
-                        target_path = os.path.join(UPLOAD_DIR, img['path'])
-                        if not os.path.exists(target_path):
-                            try:
-                                with zf.open(f"uploads/{img['path']}") as zsrc:
-                                    with open(target_path, "wb") as zdst: shutil.copyfileobj(zsrc, zdst)
-                            except Exception as e: 
-                                pass
-                    stats["success"] += 1
-                except Exception as e:
-                    stats["failed"] += 1
-                    
-            conn.commit()
-    finally:
-        conn.close()
-        if os.path.exists(tmp): os.remove(tmp)
-        
-    return JSONResponse(stats)
+    # The upload only lives as long as the request; spool it for the job
+    tmp = os.path.join(TEMP_DIR, f"import_qs_{user['id']}_{uuid.uuid4().hex}.zip")
+    await run_db(spool_upload, file, tmp)
+
+    def _import(job):
+        conn = get_db()
+        try:
+            with zipfile.ZipFile(tmp, 'r') as zf:
+                import_json = json.loads(zf.read('data.json'))
+                if import_json.get('type') != 'questions_batch':
+                    raise JobError("Invalid file format. Select a valid question bundle.")
+                return bulk_import_questions(conn, zf, import_json.get('questions', []), user['id'], sid,
+                                             progress=lambda done, total: job.progress(done, total))
+        finally:
+            conn.close()
+            if os.path.exists(tmp): os.remove(tmp)
+
+    return await submit_job(user, 'import-questions', _import)
 
+@app.post("/api/import")
 async def import_data(request: Request, file: UploadFile = File(...)):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    tmp = f"/tmp/import_{user['id']}_{file.filename}"
-    with open(tmp, "wb") as f: shutil.copyfileobj(file.file, f)
-    try:
-        with zipfile.ZipFile(tmp, 'r') as zf:
-            import_json = json.loads(zf.read('data.json'))
-            conn = get_db(); cur = conn.cursor(); old_p = import_json['paper']; sn = old_p.get('s_name', '导入内容')
-            sr = cur.execute("SELECT id FROM subjects WHERE name = ? AND user_id = ?", (sn, user['id'])).fetchone()
-            if sr: sid = sr[0]
-            else: cur.execute("INSERT INTO subjects (name, user_id) VALUES (?, ?)", (sn, user['id'])); sid = cur.lastrowid
-            cur.execute("INSERT INTO papers (name, subject_id, user_id) VALUES (?, ?, ?)", (old_p['name'], sid, user['id'])); pid = cur.lastrowid
-            for q in import_json['questions']:
-                q_text = q.get('question_text', '').strip()
-                if q_text:
-                    dup = cur.execute('SELECT id FROM questions WHERE subject_id = ? AND user_id = ? AND TRIM(question_text) = ?', (sid, user['id'], q_text)).fetchone()
-                    if dup: continue
-                cur.execute('INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, correct_answer, option_a, option_b, option_c, option_d, source, answer_video, grade, analysis) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', (sid, pid, user['id'], q['question_text'], q['question_type'], q['correct_answer'], q.get('option_a'), q.get('option_b'), q.get('option_c'), q.get('option_d'), q.get('source'), q.get('answer_video'), q.get('grade'), q.get('analysis')))
-                qid = cur.lastrowid
-                for t_name in q.get('tags', []):
-                    check_tag = cur.execute("SELECT id FROM tags WHERE name = ? AND subject_id = ?", (t_name, sid)).fetchone()
-                    if check_tag:
-                        new_tid = check_tag['id']
-                    else:
-                        cur.execute("INSERT INTO tags (name, subject_id) VALUES (?, ?)", (t_name, sid))
-                        new_tid = cur.lastrowid
-                    cur.execute("INSERT INTO question_tags (question_id, tag_id) VALUES (?, ?)", (qid, new_tid))
-                
-                for img in q.get('images', []):
-                    cur.execute('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', (qid, img['path'], img['image_type']))
-                    target_path = os.path.join(UPLOAD_DIR, img['path'])
-                    if not os.path.exists(target_path):
-                        try:
-                            with zf.open(f"uploads/{img['path']}") as zsrc:
-                                with open(target_path, "wb") as zdst: shutil.copyfileobj(zsrc, zdst)
-                        except: pass
-            conn.commit(); conn.close()
-    finally:
-        if os.path.exists(tmp): os.remove(tmp)
-    return RedirectResponse("/papers?msg=import_ok", status_code=303)
 
-@app.get("/api/backup")
-async def full_backup(request: Request):
+    def _import():
+        tmp = os.path.join(TEMP_DIR, f"import_{user['id']}_{uuid.uuid4().hex}.zip")
+        spool_upload(file, tmp)
+        try:
+            with zipfile.ZipFile(tmp, 'r') as zf:
+                import_json = json.loads(zf.read('data.json'))
+                conn = get_db(); cur = conn.cursor(); old_p = import_json['paper']; sn = old_p.get('s_name', '导入内容')
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    sr = cur.execute("SELECT id FROM subjects WHERE name = ? AND user_id = ?", (sn, user['id'])).fetchone()
+                    if sr: sid = sr[0]
+                    else: cur.execute("INSERT INTO subjects (name, user_id) VALUES (?, ?)", (sn, user['id'])); sid = cur.lastrowid
+                    cur.execute("INSERT INTO papers (name, subject_id, user_id) VALUES (?, ?, ?)", (old_p['name'], sid, user['id'])); pid = cur.lastrowid
+                    conn.commit()
+                    stats = bulk_import_questions(conn, zf, import_json['questions'], user['id'], sid, paper_id=pid, keep_video=True)
+                finally:
+                    conn.close()
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+        near_dups = stats["near_duplicate"]
+        return RedirectResponse(f"/papers?msg=import_ok&near_dup={near_dups}" if near_dups else "/papers?msg=import_ok", status_code=303)
+
+    res = await run_db(_import)
+    invalidate_ref(('subjects', user['id']), ('papers', user['id']))
+    return res
+
+@app.get("/api/jobs")
+async def list_jobs(request: Request, limit: int = 20):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    conn = get_db(); subs = conn.execute("SELECT * FROM subjects WHERE user_id = ?", (user['id'],)).fetchall(); data = {"subjects": []}
-    for s in subs:
-        sd = dict(s); sd['papers'] = []
-        papers = conn.execute("SELECT * FROM papers WHERE subject_id = ? AND user_id = ?", (s['id'], user['id'])).fetchall()
-        for p in papers:
-            pd = dict(p); pd['questions'] = []
-            qs = conn.execute("SELECT * FROM questions WHERE paper_id = ?", (p['id'],)).fetchall()
-            for q in qs:
+    rows = await run_db(db_fetchall, "SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?", (user['id'], max(1, min(limit, 100))))
+    return {"jobs": [job_view(r) for r in rows]}
+
+async def _owned_job(request: Request, job_id: str):
+    user = await get_current_user(request)
+    if not user: return None
+    return await run_db(db_fetchone, "SELECT * FROM jobs WHERE id = ? AND user_id = ?", (job_id, user['id']))
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(request: Request, job_id: str):
+    row = await _owned_job(request, job_id)
+    if not row: return JSONResponse({"error": "Job not found"}, status_code=404)
+    return job_view(row)
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(request: Request, job_id: str):
+    """Server-sent events: one `data:` line per change until the job finishes."""
+    row = await _owned_job(request, job_id)
+    if not row: return JSONResponse({"error": "Job not found"}, status_code=404)
+
+    async def _stream():
+        last = None
+        while True:
+            r = await run_db(db_fetchone, "SELECT * FROM jobs WHERE id = ?", (job_id,))
+            if not r: return
+            view = job_view(r)
+            payload = json.dumps(view, ensure_ascii=False, default=str)
+            if payload != last:
+                last = payload
+                yield f"data: {payload}\n\n"
+            if view['status'] in ('done', 'failed'): return
+            if await request.is_disconnected(): return
+            await asyncio.sleep(JobContext.PROGRESS_INTERVAL)
+
+    return StreamingResponse(_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/api/jobs/{job_id}/download")
+async def job_download(request: Request, job_id: str):
+    row = await _owned_job(request, job_id)
+    if not row or row['status'] != 'done' or not row['artifact']:
+        return JSONResponse({"error": "No artifact for this job"}, status_code=404)
+    path = os.path.join(JOB_DIR, job_id, row['artifact'])
+    if not os.path.exists(path): return JSONResponse({"error": "Artifact expired"}, status_code=410)
+    return FileResponse(path, filename=row['artifact'], media_type="application/zip")
+
+# V3.2: Backup manifests. A manifest maps every question id to its content
+# fingerprint plus a hash over the remaining exported fields, and every image path
+# to the sha1 of its bytes. An incremental backup carries only the questions and
+# images that differ from a base manifest; restore upserts by fingerprint.
+BACKUP_META_FIELDS = ['question_type', 'source', 'answer_video', 'grade', 'analysis']
+BACKUP_MANIFEST_KEEP = int(os.environ.get('BACKUP_MANIFEST_KEEP', 30))
+
+def backup_record_hash(q, subject_name, paper_name) -> str:
+    parts = [q['content_hash'] or ''] + [normalize_text(q[f]) for f in BACKUP_META_FIELDS] + [subject_name, paper_name or '']
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+def load_backup_manifest(conn, user_id, since) -> Optional[dict]:
+    """`since` is a manifest id or 'latest'."""
+    if since == 'latest':
+        row = conn.execute("SELECT data FROM backup_manifests WHERE user_id = ? ORDER BY created_at DESC, rowid DESC LIMIT 1", (user_id,)).fetchone()
+    else:
+        row = conn.execute("SELECT data FROM backup_manifests WHERE id = ? AND user_id = ?", (since, user_id)).fetchone()
+    return json.loads(row['data']) if row else None
+
+@app.get("/api/backup/manifests")
+async def list_backup_manifests(request: Request):
+    user = await get_current_user(request)
+    if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    rows = await run_db(db_fetchall, "SELECT id, base_id, created_at, questions, images FROM backup_manifests WHERE user_id = ? ORDER BY created_at DESC, rowid DESC LIMIT 50", (user['id'],))
+    return {"manifests": [dict(r) for r in rows]}
+
+@app.post("/api/backup")
+async def full_backup(request: Request, since: Optional[str] = Form(None), manifest: Optional[UploadFile] = File(None)):
+    """Full backup, or incremental against `since` (manifest id / 'latest') or an uploaded manifest.json."""
+    user = await get_current_user(request)
+    if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    base_upload = None
+    if manifest is not None and manifest.filename:
+        try: base_upload = json.loads(await manifest.read())
+        except ValueError: return JSONResponse({"error": "Invalid manifest"}, status_code=400)
+
+    def _build(job):
+        conn = get_db()
+        try:
+            base = base_upload or (load_backup_manifest(conn, user['id'], since) if since else None)
+            if since and since != 'latest' and base is None: raise JobError("Base manifest not found")
+            base_q = (base or {}).get('questions', {}); base_img = (base or {}).get('images', {})
+            subs = conn.execute("SELECT * FROM subjects WHERE user_id = ?", (user['id'],)).fetchall()
+            new_manifest = {"version": 2, "id": job.id, "base": (base or {}).get('id'), "created_at": _now_str(), "questions": {}, "images": {}}
+            data = {"version": 2, "manifest_id": job.id, "incremental": base is not None, "base": new_manifest['base'], "subjects": []}
+            media = []
+
+            def collect(q, subject_name, paper_name):
                 qd = dict(q); qd['images'] = [dict(r) for r in conn.execute("SELECT * FROM question_images WHERE question_id = ?", (q['id'],)).fetchall()]
-                pd['questions'].append(qd)
-            sd['papers'].append(pd)
-        sd['standalone_questions'] = []
-        qs = conn.execute("SELECT * FROM questions WHERE subject_id = ? AND paper_id IS NULL AND user_id = ?", (s['id'], user['id'])).fetchall()
-        for q in qs:
-            qd = dict(q); qd['images'] = [dict(r) for r in conn.execute("SELECT * FROM question_images WHERE question_id = ?", (q['id'],)).fetchall()]
-            sd['standalone_questions'].append(qd)
-        data['subjects'].append(sd)
-    conn.close()
-    fn = f"backup_{user['username']}_{date.today()}.zip"; fp = f"/tmp/{fn}"
-    with zipfile.ZipFile(fp, 'w') as zf:
-        zf.writestr('backup.json', json.dumps(data, ensure_ascii=False))
-        for s in data['subjects']:
-            for p in s['papers']:
-                for q in p['questions']:
-                    for img in q['images']:
-                        ip = os.path.join(UPLOAD_DIR, img['path'])
-                        if os.path.exists(ip): zf.write(ip, f"uploads/{img['path']}")
-            for q in s['standalone_questions']:
-                for img in q['images']:
-                    ip = os.path.join(UPLOAD_DIR, img['path'])
-                    if os.path.exists(ip): zf.write(ip, f"uploads/{img['path']}")
-    return FileResponse(fp, filename=fn)
+                for img in qd['images']:
+                    digest = base_img.get(img['path']) or image_digest(img['path'])
+                    new_manifest['images'][img['path']] = digest
+                rec = backup_record_hash(q, subject_name, paper_name)
+                new_manifest['questions'][str(q['id'])] = [q['content_hash'], rec]
+                prev = base_q.get(str(q['id']))
+                if prev and prev[1] == rec: return None
+                if prev and prev[0] != q['content_hash']: qd['replaces'] = prev[0]
+                media.extend(img for img in qd['images'] if img['path'] not in base_img)
+                return qd
+
+            job.progress(0, len(subs) + 1, "collect", force=True)
+            for s in subs:
+                job.progress(len(data['subjects']))
+                sd = dict(s); sd['papers'] = []
+                papers = conn.execute("SELECT * FROM papers WHERE subject_id = ? AND user_id = ?", (s['id'], user['id'])).fetchall()
+                for p in papers:
+                    pd = dict(p)
+                    qs = conn.execute("SELECT * FROM questions WHERE paper_id = ?", (p['id'],)).fetchall()
+                    pd['questions'] = [qd for qd in (collect(q, s['name'], p['name']) for q in qs) if qd]
+                    sd['papers'].append(pd)
+                qs = conn.execute("SELECT * FROM questions WHERE subject_id = ? AND paper_id IS NULL AND user_id = ?", (s['id'], user['id'])).fetchall()
+                sd['standalone_questions'] = [qd for qd in (collect(q, s['name'], None) for q in qs) if qd]
+                data['subjects'].append(sd)
+        finally:
+            conn.close()
+
+        job.progress(len(subs), message="package", force=True)
+        kind = 'incremental' if base else 'backup'
+        fn = f"{kind}_{user['username']}_{date.today()}.zip"
+        questions = sum(len(s['standalone_questions']) + sum(len(p['questions']) for p in s['papers']) for s in data['subjects'])
+        write_zip(job.artifact_path(fn), itertools.chain([('manifest.json', json_chunks(new_manifest)), ('backup.json', json_chunks(data))], image_entries([{'images': media}])))
+
+        conn = get_db()
+        try:
+            conn.execute("INSERT INTO backup_manifests (id, user_id, base_id, questions, images, data) VALUES (?, ?, ?, ?, ?, ?)",
+                         (job.id, user['id'], new_manifest['base'], len(new_manifest['questions']), len(new_manifest['images']), json.dumps(new_manifest)))
+            conn.execute("""DELETE FROM backup_manifests WHERE user_id = ? AND id NOT IN
+                            (SELECT id FROM backup_manifests WHERE user_id = ? ORDER BY created_at DESC, rowid DESC LIMIT ?)""", (user['id'], user['id'], BACKUP_MANIFEST_KEEP))
+            conn.commit()
+        finally:
+            conn.close()
+        return {"subjects": len(data['subjects']), "questions": questions, "images": len({m['path'] for m in media}),
+                "incremental": base is not None, "manifest_id": job.id, "file": fn}
+
+    return await submit_job(user, 'backup', _build)
+
+def restore_question(conn, q, user_id, sid, pid, stored, stats):
+    """Upsert one backed-up question into subject `sid` by content fingerprint.
+
+    Same fingerprint: only placement and metadata are refreshed. A question that
+    `replaces` an older fingerprint present in the subject is updated in place.
+    Anything else is inserted. `stored` maps bundle image paths to stored names
+    (see extract_bundle_images()).
+    """
+    images = [(stored.get(img['path']) or os.path.basename(img['path']), img['image_type']) for img in q.get('images', [])]
+    meta = [pid] + [q.get(f) for f in BACKUP_META_FIELDS]
+    fp = question_fingerprint(q, [(t, image_digest(name)) for name, t in images])
+
+    existing = find_duplicate(conn, user_id, sid, fp)
+    if existing:
+        cur = conn.execute(f"""UPDATE questions SET paper_id = ?, {', '.join(f'{f} = ?' for f in BACKUP_META_FIELDS)} WHERE id = ?
+                               AND NOT (paper_id IS ? AND {' AND '.join(f'{f} IS ?' for f in BACKUP_META_FIELDS)})""", meta + [existing] + meta)
+        stats['updated' if cur.rowcount else 'unchanged'] += 1
+        return
+    old = find_duplicate(conn, user_id, sid, q['replaces']) if q.get('replaces') else None
+    if old:
+        conn.execute(f"""UPDATE questions SET paper_id = ?, {', '.join(f'{f} = ?' for f in BACKUP_META_FIELDS)},
+                         {', '.join(f'{f} = ?' for f in FINGERPRINT_FIELDS)} WHERE id = ?""", meta + [q.get(f) for f in FINGERPRINT_FIELDS] + [old])
+        conn.execute("DELETE FROM question_images WHERE question_id = ?", (old,))
+        qid = old; stats['updated'] += 1
+    else:
+        qid = conn.execute('INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, correct_answer, option_a, option_b, option_c, option_d, source, answer_video, grade, analysis) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                           (sid, pid, user_id, q['question_text'], q['question_type'], q['correct_answer'], q.get('option_a'), q.get('option_b'), q.get('option_c'), q.get('option_d'), q.get('source'), q.get('answer_video'), q.get('grade'), q.get('analysis'))).lastrowid
+        stats['inserted'] += 1
+    conn.executemany('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', [(qid, name, t) for name, t in images])
+    refresh_question_fingerprint(conn, qid)
 
 @app.post("/api/restore")
 async def restore_backup(request: Request, file: UploadFile = File(...)):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, status_code=401)
-    tmp = f"/tmp/restore_{user['id']}_{file.filename}"
-    with open(tmp, "wb") as f: shutil.copyfileobj(file.file, f)
-    try:
-        with zipfile.ZipFile(tmp, 'r') as zf:
-            backup_json = json.loads(zf.read('backup.json'))
-            conn = get_db(); cur = conn.cursor()
-            for s in backup_json.get('subjects', []):
-                cur.execute("INSERT OR IGNORE INTO subjects (name, user_id) VALUES (?, ?)", (s['name'], user['id']))
-                sr = cur.execute("SELECT id FROM subjects WHERE name = ? AND user_id = ?", (s['name'], user['id'])).fetchone()
-                sid = sr[0]
-                for p in s.get('papers', []):
-                    cur.execute("INSERT INTO papers (name, subject_id, user_id) VALUES (?, ?, ?)", (p['name'], sid, user['id']))
-                    pid = cur.lastrowid
-                    for q in p.get('questions', []):
-                        cur.execute('INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, correct_answer, option_a, option_b, option_c, option_d, source, answer_video, grade, analysis) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', (sid, pid, user['id'], q['question_text'], q['question_type'], q['correct_answer'], q.get('option_a'), q.get('option_b'), q.get('option_c'), q.get('option_d'), q.get('source'), q.get('answer_video'), q.get('grade'), q.get('analysis')))
-                        qid = cur.lastrowid
-                        for img in q.get('images', []):
-                            cur.execute('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', (qid, img['path'], img['image_type']))
-                            target_path = os.path.join(UPLOAD_DIR, img['path'])
-                            if not os.path.exists(target_path):
-                                try:
-                                    with zf.open(f"uploads/{img['path']}") as zsrc:
-                                        with open(target_path, "wb") as zdst: shutil.copyfileobj(zsrc, zdst)
-                                except: pass
-                for q in s.get('standalone_questions', []):
-                    cur.execute('INSERT INTO questions (subject_id, paper_id, user_id, question_text, question_type, correct_answer, option_a, option_b, option_c, option_d, source, answer_video, grade, analysis) VALUES (?,NULL,?,?,?,?,?,?,?,?,?,?,?,?)', (sid, user['id'], q['question_text'], q['question_type'], q['correct_answer'], q.get('option_a'), q.get('option_b'), q.get('option_c'), q.get('option_d'), q.get('source'), q.get('answer_video'), q.get('grade'), q.get('analysis')))
-                    qid = cur.lastrowid
-                    for img in q.get('images', []):
-                        cur.execute('INSERT INTO question_images (question_id, path, image_type) VALUES (?,?,?)', (qid, img['path'], img['image_type']))
-                        target_path = os.path.join(UPLOAD_DIR, img['path'])
-                        if not os.path.exists(target_path):
+
+    tmp = os.path.join(TEMP_DIR, f"restore_{user['id']}_{uuid.uuid4().hex}.zip")
+    await run_db(spool_upload, file, tmp)
+
+    def _restore(job):
+        stats = {"inserted": 0, "updated": 0, "unchanged": 0, "images_written": 0, "images_skipped": 0}
+        try:
+            with zipfile.ZipFile(tmp, 'r') as zf:
+                backup_json = json.loads(zf.read('backup.json'))
+                subjects = backup_json.get('subjects', [])
+                job.progress(0, len(subjects), force=True)
+                # Images go into the store before any write lock is taken
+                stored = extract_bundle_images(zf, list(dict.fromkeys(
+                    img['path'] for s in subjects for q in s.get('standalone_questions', []) + [q for p in s.get('papers', []) for q in p['questions']]
+                    for img in q.get('images', []))), stats)
+                conn = get_db()
+                try:
+                    if conn.in_transaction: conn.commit()
+                    # One short BEGIN IMMEDIATE per subject header and per IMPORT_CHUNK_SIZE questions,
+                    # as in bulk_import_questions(). Re-running a partially applied restore is safe:
+                    # questions already present are matched by fingerprint.
+                    first = True
+                    for s_index, s in enumerate(subjects):
+                        job.progress(s_index)
+                        conn.execute("BEGIN IMMEDIATE")
+                        try:
+                            conn.execute("INSERT OR IGNORE INTO subjects (name, user_id) VALUES (?, ?)", (s['name'], user['id']))
+                            sid = conn.execute("SELECT id FROM subjects WHERE name = ? AND user_id = ?", (s['name'], user['id'])).fetchone()[0]
+                            placed = []
+                            for p in s.get('papers', []):
+                                pr = conn.execute("SELECT id FROM papers WHERE name = ? AND subject_id = ? AND user_id = ?", (p['name'], sid, user['id'])).fetchone()
+                                pid = pr[0] if pr else conn.execute("INSERT INTO papers (name, subject_id, user_id) VALUES (?, ?, ?)", (p['name'], sid, user['id'])).lastrowid
+                                placed += [(pid, q) for q in p.get('questions', [])]
+                            placed += [(None, q) for q in s.get('standalone_questions', [])]
+                            conn.commit()
+                        except Exception:
+                            conn.rollback()
+                            raise
+                        for chunk in chunked(placed, IMPORT_CHUNK_SIZE):
+                            if not first: time.sleep(IMPORT_CHUNK_PAUSE_MS / 1000)
+                            first = False
+                            conn.execute("BEGIN IMMEDIATE")
                             try:
-                                with zf.open(f"uploads/{img['path']}") as zsrc:
-                                    with open(target_path, "wb") as zdst: shutil.copyfileobj(zsrc, zdst)
-                            except: pass
-            conn.commit(); conn.close()
-    finally:
-        if os.path.exists(tmp): os.remove(tmp)
-    return RedirectResponse("/settings?msg=restore_ok", status_code=303)
+                                for pid, q in chunk:
+                                    restore_question(conn, q, user['id'], sid, pid, stored, stats)
+                                conn.commit()
+                            except Exception:
+                                conn.rollback()
+                                raise
+                finally:
+                    conn.close()
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+            invalidate_ref(('subjects', user['id']), ('papers', user['id']))
+        return {"subjects": len(subjects), "questions": stats['inserted'], **stats}
+
+    return await submit_job(user, 'restore', _restore)
 
 @app.post("/settings/update")
 async def update_settings(request: Request, app_name: str = Form(...)):
     user = await get_current_user(request)
     if not user or user['role'] != 'admin': return RedirectResponse("/", status_code=303)
-    conn = get_db(); conn.execute("UPDATE config SET value = ? WHERE key = 'app_name'", (app_name.strip(),)); conn.commit(); conn.close()
+    await write_execute("UPDATE config SET value = ? WHERE key = 'app_name'", (app_name.strip(),))
+    invalidate_ref(('app_name',))
     return RedirectResponse("/settings", status_code=303)
 
 @app.post("/api/change-password")
 async def change_password(request: Request, old_pwd: str = Form(...), new_pwd: str = Form(...)):
     user = await get_current_user(request)
     if not user: return RedirectResponse("/login", status_code=303)
-    conn = get_db()
-    db_user = conn.execute("SELECT * FROM users WHERE id = ?", (user['id'],)).fetchone()
-    if not db_user or not pwd_context.verify(old_pwd, db_user['password_hash']):
-        conn.close(); return RedirectResponse("/settings?msg=pwd_err", status_code=303)
-    
-    new_hash = pwd_context.hash(new_pwd)
-    conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, user['id']))
-    conn.commit(); conn.close()
+
+    def _change():
+        conn = get_db()
+        db_user = conn.execute("SELECT * FROM users WHERE id = ?", (user['id'],)).fetchone()
+        if not db_user or not pwd_context.verify(old_pwd, db_user['password_hash']):
+            conn.close(); return False
+        
+        new_hash = pwd_context.hash(new_pwd)
+        conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, user['id']))
+        conn.commit(); conn.close()
+        return True
+
+    if not await run_db(_change):
+        return RedirectResponse("/settings?msg=pwd_err", status_code=303)
+    invalidate_user(uid=user['id'], username=user['username'])
     return RedirectResponse("/settings?msg=pwd_ok", status_code=303)
 
 @app.post("/admin/user/reset-password")
@@ -1593,11 +3928,9 @@ async def admin_reset_password(request: Request, uid: int = Form(...), new_passw
     user = await get_current_user(request)
     if not user or user['role'] != 'admin': return RedirectResponse("/", status_code=303)
     
-    conn = get_db()
-    new_hash = pwd_context.hash(new_password)
-    conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, uid))
-    conn.commit()
-    conn.close()
+    new_hash = await run_db(pwd_context.hash, new_password)
+    await write_execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, uid))
+    invalidate_user(uid=uid)
     
     return RedirectResponse("/admin/users?msg=reset_pwd_ok", status_code=303)
 
@@ -1610,25 +3943,155 @@ async def diagnose_db(request: Request):
     if not user or user['role'] != 'admin':
         return JSONResponse({"error": "Unauthorized"}, status_code=403)
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Check Schema
+    def _diagnose():
+        conn = get_db()
+        c = conn.cursor()
+
+        # Check Schema
+        try:
+            info = c.execute("PRAGMA table_info(user_question_status)").fetchall()
+            cols = [col[1] for col in info]
+            missing = []
+            if 'history_wrong' not in cols: missing.append('history_wrong')
+
+            return {
+                "status": "error" if missing else "ok",
+                "missing_columns": missing,
+                "db_path": DB_PATH
+            }
+        except Exception as e:
+            return JSONResponse({"error": str(e)}, status_code=500)
+        finally:
+            conn.close()
+
+    return await run_db(_diagnose)
+
+@app.get("/api/admin/db-stats")
+async def db_stats(request: Request):
+    user = await get_current_user(request)
+    if not user or user['role'] != 'admin':
+        return JSONResponse({"error": "Unauthorized"}, status_code=403)
+    mode = (await run_db(db_fetchone, "PRAGMA journal_mode"))[0]
+    return {"journal_mode": mode, "pool": db_pool.metrics(), "user_cache": user_cache.metrics(), "ref_cache": ref_cache.metrics(), "write_queue": write_queue.metrics(), "images": image_metrics.metrics(), "pages": page_cache.metrics()}
+
+@app.post("/api/admin/rebuild-counters")
+async def rebuild_counters(request: Request):
+    user = await get_current_user(request)
+    if not user or user['role'] != 'admin':
+        return JSONResponse({"error": "Unauthorized"}, status_code=403)
+
+    def _rebuild():
+        conn = get_db()
+        try:
+            rebuild_subject_counters(conn)
+            rebuild_daily_stats(conn)
+            rebuild_media_refs(conn)
+            if FTS_ENABLED:
+                conn.execute("INSERT INTO questions_fts (questions_fts) VALUES ('rebuild')")
+            conn.commit()
+            return {"subject_counters": conn.execute("SELECT COUNT(*) FROM subject_counters").fetchone()[0],
+                    "study_daily_stats": conn.execute("SELECT COUNT(*) FROM study_daily_stats").fetchone()[0],
+                    "media": conn.execute("SELECT COUNT(*) FROM media").fetchone()[0]}
+        finally:
+            conn.close()
+
+    return {"status": "ok", "rows": await run_db(_rebuild)}
+
+@app.post("/api/admin/media-gc")
+async def admin_media_gc(request: Request):
+    """Collect unreferenced media now (the grace period still applies)."""
+    user = await get_current_user(request)
+    if not user or user['role'] != 'admin':
+        return JSONResponse({"error": "Unauthorized"}, status_code=403)
+    result = await run_db(gc_media)
+    row = await run_db(db_fetchone, "SELECT COUNT(*) AS files, SUM(refcount) AS refs, SUM(refcount <= 0) AS unreferenced FROM media")
+    return {"status": "ok", **result, "files": row['files'], "refs": row['refs'] or 0, "unreferenced": row['unreferenced'] or 0}
+
+@app.get("/api/admin/snapshots")
+async def admin_snapshots(request: Request):
+    user = await get_current_user(request)
+    if not user or user['role'] != 'admin':
+        return JSONResponse({"error": "Unauthorized"}, status_code=403)
+    return {"snapshots": await run_db(list_snapshots), "keep": SNAPSHOT_KEEP, "interval_hours": SNAPSHOT_INTERVAL_HOURS}
+
+@app.post("/api/admin/snapshots")
+async def create_snapshot(request: Request):
+    user = await get_current_user(request)
+    if not user or user['role'] != 'admin':
+        return JSONResponse({"error": "Unauthorized"}, status_code=403)
+    return await submit_job(user, 'snapshot', lambda job: take_snapshot(job.progress))
+
+@app.get("/api/admin/near-duplicates")
+async def near_duplicate_clusters(request: Request, sid: Optional[int] = None, limit: int = 50):
+    """Review queue: clusters of likely duplicate questions per (owner, subject)."""
+    user = await get_current_user(request)
+    if not user or user['role'] != 'admin':
+        return JSONResponse({"error": "Unauthorized"}, status_code=403)
+
+    def _load():
+        conn = get_db()
+        try:
+            cond, params = (" AND qa.subject_id = ?", [sid]) if sid is not None else ("", [])
+            pairs = conn.execute(f'''
+                SELECT DISTINCT la.question_id as a, lb.question_id as b
+                FROM question_lsh la
+                JOIN question_lsh lb ON lb.band = la.band AND lb.bucket = la.bucket AND lb.question_id > la.question_id
+                JOIN questions qa ON qa.id = la.question_id
+                JOIN questions qb ON qb.id = lb.question_id
+                WHERE qa.user_id IS qb.user_id AND qa.subject_id IS qb.subject_id{cond}
+                  AND NOT EXISTS (SELECT 1 FROM near_duplicate_dismissals d WHERE d.question_id_a = la.question_id AND d.question_id_b = lb.question_id)
+            ''', params).fetchall()
+            ids = {i for p in pairs for i in (p['a'], p['b'])}
+            rows = {}
+            for chunk in chunked(list(ids)):
+                for r in conn.execute(f"SELECT id, user_id, subject_id, paper_id, question_text, created_at FROM questions WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+                    rows[r['id']] = dict(r)
+        finally:
+            conn.close()
+
+        # Verify candidates with exact Jaccard, then union-find into clusters
+        shingles = {i: text_shingles(r['question_text']) for i, r in rows.items()}
+        parent = {}
+        def find(x):
+            while parent.get(x, x) != x:
+                x = parent[x]
+            return x
+        sims = {}
+        for p in pairs:
+            sim = jaccard(shingles[p['a']], shingles[p['b']])
+            if sim < NEAR_DUP_THRESHOLD: continue
+            sims[(p['a'], p['b'])] = round(sim, 3)
+            ra, rb = find(p['a']), find(p['b'])
+            if ra != rb: parent[max(ra, rb)] = min(ra, rb)
+        groups = {}
+        for a, b in sims:
+            for i in (a, b):
+                groups.setdefault(find(i), set()).add(i)
+        clusters = []
+        for root, members in sorted(groups.items(), key=lambda g: -len(g[1])):
+            qs = [rows[i] for i in sorted(members)]
+            clusters.append({
+                "user_id": qs[0]['user_id'], "subject_id": qs[0]['subject_id'],
+                "questions": qs,
+                "pairs": [{"a": a, "b": b, "similarity": v} for (a, b), v in sims.items() if a in members]
+            })
+        return {"threshold": NEAR_DUP_THRESHOLD, "clusters": clusters[:max(1, limit)], "total_clusters": len(clusters)}
+
+    return await run_db(_load)
+
+@app.post("/api/admin/near-duplicates/dismiss")
+async def dismiss_near_duplicate(request: Request):
+    """Mark a candidate pair as "not a duplicate" so it leaves the review queue."""
+    user = await get_current_user(request)
+    if not user or user['role'] != 'admin':
+        return JSONResponse({"error": "Unauthorized"}, status_code=403)
+    data = await request.json()
     try:
-        info = c.execute("PRAGMA table_info(user_question_status)").fetchall()
-        cols = [col[1] for col in info]
-        missing = []
-        if 'history_wrong' not in cols: missing.append('history_wrong')
-        
-        return {
-            "status": "error" if missing else "ok",
-            "missing_columns": missing,
-            "db_path": DB_PATH
-        }
-    except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
-    finally:
-        conn.close()
+        a, b = sorted((int(data['a']), int(data['b'])))
+    except (KeyError, TypeError, ValueError):
+        return JSONResponse({"error": "Invalid pair"}, status_code=400)
+    await write_execute("INSERT OR IGNORE INTO near_duplicate_dismissals (question_id_a, question_id_b, dismissed_by) VALUES (?, ?, ?)", (a, b, user['id']))
+    return {"status": "ok"}
 
 @app.post("/api/admin/fix_db")
 async def fix_db(request: Request):
@@ -1636,34 +4099,37 @@ async def fix_db(request: Request):
     if not user or user['role'] != 'admin':
         return JSONResponse({"error": "Unauthorized"}, status_code=403)
         
-    conn = get_db()
-    c = conn.cursor()
-    logs = []
-    
-    try:
-        # Check again to be safe
-        info = c.execute("PRAGMA table_info(user_question_status)").fetchall()
-        cols = [col[1] for col in info]
-        
-        if 'history_wrong' not in cols:
-            logs.append("Missing 'history_wrong'. Adding column...")
-            c.execute("ALTER TABLE user_question_status ADD COLUMN history_wrong INTEGER DEFAULT 0")
-            logs.append("Column added.")
-            
-            # Backfill
-            logs.append("Backfilling data (wrong_count > 0 -> history_wrong = 1)...")
-            c.execute("UPDATE user_question_status SET history_wrong = 1 WHERE wrong_count > 0")
-            logs.append("Backfill complete.")
-            conn.commit()
-        else:
-            logs.append("'history_wrong' already exists. Performing sanity check...")
-        return {"status": "success", "logs": logs}
-    except Exception as e:
-        print(f"Fix DB Error: {e}", flush=True)
-        conn.rollback()
-        return JSONResponse({"status": "error", "logs": logs, "error_msg": str(e)}, status_code=500)
-    finally:
-        conn.close()
+    def _fix():
+        conn = get_db()
+        c = conn.cursor()
+        logs = []
+
+        try:
+            # Check again to be safe
+            info = c.execute("PRAGMA table_info(user_question_status)").fetchall()
+            cols = [col[1] for col in info]
+
+            if 'history_wrong' not in cols:
+                logs.append("Missing 'history_wrong'. Adding column...")
+                c.execute("ALTER TABLE user_question_status ADD COLUMN history_wrong INTEGER DEFAULT 0")
+                logs.append("Column added.")
+
+                # Backfill
+                logs.append("Backfilling data (wrong_count > 0 -> history_wrong = 1)...")
+                c.execute("UPDATE user_question_status SET history_wrong = 1 WHERE wrong_count > 0")
+                logs.append("Backfill complete.")
+                conn.commit()
+            else:
+                logs.append("'history_wrong' already exists. Performing sanity check...")
+            return {"status": "success", "logs": logs}
+        except Exception as e:
+            print(f"Fix DB Error: {e}", flush=True)
+            conn.rollback()
+            return JSONResponse({"status": "error", "logs": logs, "error_msg": str(e)}, status_code=500)
+        finally:
+            conn.close()
+
+    return await run_db(_fix)
 
 @app.post("/api/admin/test_record")
 async def test_record_db(request: Request):
@@ -1672,62 +4138,65 @@ async def test_record_db(request: Request):
     if not user or user['role'] != 'admin':
         return JSONResponse({"error": "Unauthorized"}, status_code=403)
     
-    conn = get_db()
-    c = conn.cursor()
-    logs = []
-    
-    try:
-        # 1. Setup Dummy Data
-        test_uid = user['id']
-        test_qid = -999 # Non-existent question ID for testing
-        
-        logs.append(f"Test Start: User={test_uid}, QID={test_qid}")
-        
-        # 2. Clean up previous test mess if any
-        c.execute("DELETE FROM user_question_status WHERE user_id=? AND question_id=?", (test_uid, test_qid))
-        conn.commit()
-        
-        # 3. Test INSERT (Wrong)
-        logs.append("Testing INSERT (Wrong)...")
-        c.execute("INSERT INTO user_question_status (user_id, question_id, wrong_count, history_wrong, is_difficult) VALUES (?, ?, ?, ?, ?)", 
-                  (test_uid, test_qid, 1, 1, 0))
-        conn.commit()
-        logs.append("INSERT OK.")
-        
-        # 4. Verify INSERT
-        row = c.execute("SELECT * FROM user_question_status WHERE user_id=? AND question_id=?", (test_uid, test_qid)).fetchone()
-        if not row: raise Exception("Insert failed silently (Select returned None)")
-        if row['history_wrong'] != 1: raise Exception(f"Detailed integrity check failed: history_wrong={row['history_wrong']} (Expected 1)")
-        logs.append(f"Verification OK: {dict(row)}")
-        
-        # 5. Test UPDATE (Correct)
-        logs.append("Testing UPDATE (Correct -> wrong_count=0)...")
-        c.execute("UPDATE user_question_status SET wrong_count = 0 WHERE user_id = ? AND question_id = ?", (test_uid, test_qid))
-        conn.commit()
-        row = c.execute("SELECT * FROM user_question_status WHERE user_id=? AND question_id=?", (test_uid, test_qid)).fetchone()
-        if row['wrong_count'] != 0: raise Exception(f"Update failed: wrong_count={row['wrong_count']} (Expected 0)")
-        logs.append("UPDATE OK.")
-        
-        # 6. Test UPDATE (Mark Difficult)
-        logs.append("Testing UPDATE (Difficult)...")
-        c.execute("UPDATE user_question_status SET is_difficult = 1 WHERE user_id = ? AND question_id = ?", (test_uid, test_qid))
-        conn.commit()
-        row = c.execute("SELECT * FROM user_question_status WHERE user_id=? AND question_id=?", (test_uid, test_qid)).fetchone()
-        if row['is_difficult'] != 1: raise Exception(f"Update Difficult failed: is_difficult={row['is_difficult']}")
-        logs.append("Difficult OK.")
-        
-        # 7. Cleanup
-        c.execute("DELETE FROM user_question_status WHERE user_id=? AND question_id=?", (test_uid, test_qid))
-        conn.commit()
-        logs.append("Cleanup OK. Test Passed!")
-        
-        return {"status": "success", "logs": logs}
+    def _test():
+        conn = get_db()
+        c = conn.cursor()
+        logs = []
 
-    except Exception as e:
-        print(f"Deep Diag Error: {e}", flush=True)
-        return {"status": "error", "logs": logs, "error_msg": str(e)}
-    finally:
-        conn.close()
+        try:
+            # 1. Setup Dummy Data
+            test_uid = user['id']
+            test_qid = -999 # Non-existent question ID for testing
+
+            logs.append(f"Test Start: User={test_uid}, QID={test_qid}")
+
+            # 2. Clean up previous test mess if any
+            c.execute("DELETE FROM user_question_status WHERE user_id=? AND question_id=?", (test_uid, test_qid))
+            conn.commit()
+
+            # 3. Test INSERT (Wrong)
+            logs.append("Testing INSERT (Wrong)...")
+            c.execute("INSERT INTO user_question_status (user_id, question_id, wrong_count, history_wrong, is_difficult) VALUES (?, ?, ?, ?, ?)", 
+                      (test_uid, test_qid, 1, 1, 0))
+            conn.commit()
+            logs.append("INSERT OK.")
+
+            # 4. Verify INSERT
+            row = c.execute("SELECT * FROM user_question_status WHERE user_id=? AND question_id=?", (test_uid, test_qid)).fetchone()
+            if not row: raise Exception("Insert failed silently (Select returned None)")
+            if row['history_wrong'] != 1: raise Exception(f"Detailed integrity check failed: history_wrong={row['history_wrong']} (Expected 1)")
+            logs.append(f"Verification OK: {dict(row)}")
+
+            # 5. Test UPDATE (Correct)
+            logs.append("Testing UPDATE (Correct -> wrong_count=0)...")
+            c.execute("UPDATE user_question_status SET wrong_count = 0 WHERE user_id = ? AND question_id = ?", (test_uid, test_qid))
+            conn.commit()
+            row = c.execute("SELECT * FROM user_question_status WHERE user_id=? AND question_id=?", (test_uid, test_qid)).fetchone()
+            if row['wrong_count'] != 0: raise Exception(f"Update failed: wrong_count={row['wrong_count']} (Expected 0)")
+            logs.append("UPDATE OK.")
+
+            # 6. Test UPDATE (Mark Difficult)
+            logs.append("Testing UPDATE (Difficult)...")
+            c.execute("UPDATE user_question_status SET is_difficult = 1 WHERE user_id = ? AND question_id = ?", (test_uid, test_qid))
+            conn.commit()
+            row = c.execute("SELECT * FROM user_question_status WHERE user_id=? AND question_id=?", (test_uid, test_qid)).fetchone()
+            if row['is_difficult'] != 1: raise Exception(f"Update Difficult failed: is_difficult={row['is_difficult']}")
+            logs.append("Difficult OK.")
+
+            # 7. Cleanup
+            c.execute("DELETE FROM user_question_status WHERE user_id=? AND question_id=?", (test_uid, test_qid))
+            conn.commit()
+            logs.append("Cleanup OK. Test Passed!")
+
+            return {"status": "success", "logs": logs}
+
+        except Exception as e:
+            print(f"Deep Diag Error: {e}", flush=True)
+            return {"status": "error", "logs": logs, "error_msg": str(e)}
+        finally:
+            conn.close()
+
+    return await run_db(_test)
 
 
 class BatchDistributeRequest(BaseModel):
@@ -1741,144 +4210,154 @@ class BatchDeleteRequest(BaseModel):
 async def batch_distribute(req: BatchDistributeRequest, request: Request):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, 401)
-    
-    conn = get_db()
-    try:
-        # Check target user
-        target_user = conn.execute("SELECT * FROM users WHERE id = ?", (req.target_user_id,)).fetchone()
-        if not target_user:
-            return JSONResponse({"error": "Target user not found"}, 404)
 
-        stats = {
-            "total": len(req.question_ids),
-            "success": 0,
-            "failed": 0,
-            "duplicate": 0
-        }
+    # Check target user
+    if not await run_db(db_fetchone, "SELECT id FROM users WHERE id = ?", (req.target_user_id,)):
+        return JSONResponse({"error": "Target user not found"}, 404)
+
+    def _run(job):
+        conn = get_db()
+        try:
+
+            stats = {
+                "total": len(req.question_ids),
+                "success": 0,
+                "failed": 0,
+                "duplicate": 0
+            }
         
-        for qid in req.question_ids:
-            try:
-                # Get Source Q
-                q_row = conn.execute("SELECT * FROM questions WHERE id = ?", (qid,)).fetchone()
-                if not q_row: 
-                    stats["failed"] += 1
-                    continue
-                q = dict(q_row)
+            job.progress(0, len(req.question_ids), force=True)
+            for q_index, qid in enumerate(req.question_ids):
+                job.progress(q_index)
+                try:
+                    # Get Source Q
+                    q_row = conn.execute("SELECT * FROM questions WHERE id = ?", (qid,)).fetchone()
+                    if not q_row: 
+                        stats["failed"] += 1
+                        continue
+                    q = dict(q_row)
                 
-                # Get Source Subject Name
-                src_sub = conn.execute("SELECT name FROM subjects WHERE id = ?", (q['subject_id'],)).fetchone()
-                if not src_sub: 
-                    stats["failed"] += 1
-                    continue
-                sub_name = src_sub['name']
+                    # Get Source Subject Name
+                    src_sub = conn.execute("SELECT name FROM subjects WHERE id = ?", (q['subject_id'],)).fetchone()
+                    if not src_sub: 
+                        stats["failed"] += 1
+                        continue
+                    sub_name = src_sub['name']
                 
-                # Find/Create Target Subject
-                # Check if target user has this subject
-                tgt_sub = conn.execute("SELECT id FROM subjects WHERE user_id = ? AND name = ?", (req.target_user_id, sub_name)).fetchone()
-                if tgt_sub:
-                    new_sub_id = tgt_sub['id']
-                else:
-                    # Create subject
-                    cur = conn.cursor()
-                    cur.execute("INSERT INTO subjects (name, user_id) VALUES (?, ?)", (sub_name, req.target_user_id))
-                    new_sub_id = cur.lastrowid
+                    # Find/Create Target Subject
+                    # Check if target user has this subject
+                    tgt_sub = conn.execute("SELECT id FROM subjects WHERE user_id = ? AND name = ?", (req.target_user_id, sub_name)).fetchone()
+                    if tgt_sub:
+                        new_sub_id = tgt_sub['id']
+                    else:
+                        # Create subject
+                        cur = conn.cursor()
+                        cur.execute("INSERT INTO subjects (name, user_id) VALUES (?, ?)", (sub_name, req.target_user_id))
+                        new_sub_id = cur.lastrowid
                 
-                # V1.3.26: Check for Duplicate (Same Text + Same Subject + Same Target User)
-                # We use strict text matching to prevent clutter
-                duplicate_check = conn.execute(
-                    "SELECT id FROM questions WHERE user_id = ? AND subject_id = ? AND question_text = ?",
-                    (req.target_user_id, new_sub_id, q['question_text'])
-                ).fetchone()
+                    # V3.2: Duplicate check by content fingerprint; the clone shares text, options and images
+                    if not q.get('content_hash'):
+                        refresh_question_fingerprint(conn, qid)
+                        q['content_hash'] = conn.execute("SELECT content_hash FROM questions WHERE id = ?", (qid,)).fetchone()[0]
+                    duplicate_check = find_duplicate(conn, req.target_user_id, new_sub_id, q['content_hash'])
                 
-                if duplicate_check:
-                    stats["duplicate"] += 1
-                    continue
+                    if duplicate_check:
+                        stats["duplicate"] += 1
+                        continue
                 
-                # Clone Question
-                cur = conn.cursor()
-                cur.execute('''
-                    INSERT INTO questions (subject_id, question_text, question_type, option_a, option_b, option_c, option_d, correct_answer, difficulty, source, user_id, paper_id, grade, answer_video, analysis)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?, ?)
-                ''', (
-                    new_sub_id, 
-                    q['question_text'], 
-                    q['question_type'], 
-                    q.get('option_a'), 
-                    q.get('option_b'), 
-                    q.get('option_c'), 
-                    q.get('option_d'), 
-                    q['correct_answer'], 
-                    q.get('difficulty', 0), 
-                    q.get('source'), 
-                    req.target_user_id,
-                    q.get('grade'),
-                    q.get('answer_video'),
-                    q.get('analysis')
-                ))
-                new_qid = cur.lastrowid
+                    # Clone Question
+                    cur = conn.cursor()
+                    cur.execute('''
+                        INSERT INTO questions (subject_id, question_text, question_type, option_a, option_b, option_c, option_d, correct_answer, difficulty, source, user_id, paper_id, grade, answer_video, analysis, content_hash)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?, ?, ?)
+                    ''', (
+                        new_sub_id, 
+                        q['question_text'], 
+                        q['question_type'], 
+                        q.get('option_a'), 
+                        q.get('option_b'), 
+                        q.get('option_c'), 
+                        q.get('option_d'), 
+                        q['correct_answer'], 
+                        q.get('difficulty', 0), 
+                        q.get('source'), 
+                        req.target_user_id,
+                        q.get('grade'),
+                        q.get('answer_video'),
+                        q.get('analysis'),
+                        q['content_hash']
+                    ))
+                    new_qid = cur.lastrowid
+                    update_question_lsh(conn, [(new_qid, q['question_text'])])
                 
-                # Clone Images
-                imgs = conn.execute("SELECT * FROM question_images WHERE question_id = ?", (qid,)).fetchall()
-                for img in imgs:
-                    # We can reuse the same image path since it's just a file reference. 
-                    cur.execute("INSERT INTO question_images (question_id, image_type, path) VALUES (?, ?, ?)", (new_qid, img['image_type'], img['path']))
+                    # Clone Images
+                    imgs = conn.execute("SELECT * FROM question_images WHERE question_id = ?", (qid,)).fetchall()
+                    for img in imgs:
+                        # We can reuse the same image path since it's just a file reference. 
+                        cur.execute("INSERT INTO question_images (question_id, image_type, path) VALUES (?, ?, ?)", (new_qid, img['image_type'], img['path']))
                 
-                # Clone Tags
-                old_tags = conn.execute('''
-                    SELECT t.name FROM question_tags qt
-                    JOIN tags t ON qt.tag_id = t.id
-                    WHERE qt.question_id = ?
-                ''', (qid,)).fetchall()
-                for t_row in old_tags:
-                    t_name = t_row['name']
-                    check_tag = cur.execute("SELECT id FROM tags WHERE name = ? AND subject_id = ?", (t_name, new_sub_id)).fetchone()
-                    if check_tag:
-                        new_tid = check_tag['id']
-                    else:
-                        cur.execute("INSERT INTO tags (name, subject_id) VALUES (?, ?)", (t_name, new_sub_id))
-                        new_tid = cur.lastrowid
-                    cur.execute("INSERT INTO question_tags (question_id, tag_id) VALUES (?, ?)", (new_qid, new_tid))
+                    # Clone Tags
+                    old_tags = conn.execute('''
+                        SELECT t.name FROM question_tags qt
+                        JOIN tags t ON qt.tag_id = t.id
+                        WHERE qt.question_id = ?
+                    ''', (qid,)).fetchall()
+                    for t_row in old_tags:
+                        t_name = t_row['name']
+                        check_tag = cur.execute("SELECT id FROM tags WHERE name = ? AND subject_id = ?", (t_name, new_sub_id)).fetchone()
+                        if check_tag:
+                            new_tid = check_tag['id']
+                        else:
+                            cur.execute("INSERT INTO tags (name, subject_id) VALUES (?, ?)", (t_name, new_sub_id))
+                            new_tid = cur.lastrowid
+                        cur.execute("INSERT INTO question_tags (question_id, tag_id) VALUES (?, ?)", (new_qid, new_tid))
                     
-                stats["success"] += 1
-            except Exception as e:
-                print(f"Distribute Error (QID {qid}): {e}")
-                stats["failed"] += 1
+                    stats["success"] += 1
+                except Exception as e:
+                    print(f"Distribute Error (QID {qid}): {e}")
+                    stats["failed"] += 1
             
-        conn.commit()
-        return JSONResponse({"status": "success", "stats": stats})
-    except Exception as e:
-        conn.rollback()
-        print(f"Batch Distribute Error: {e}")
-        return JSONResponse({"error": str(e)}, 500)
-    finally:
-        conn.close()
+            conn.commit()
+            return {"status": "success", "stats": stats}
+        except Exception as e:
+            conn.rollback()
+            print(f"Batch Distribute Error: {e}")
+            raise
+        finally:
+            conn.close()
+            invalidate_ref(('subjects', req.target_user_id))
+
+    return await submit_job(user, 'batch-distribute', _run)
 
 @app.post("/api/batch-delete")
 async def batch_delete(req: BatchDeleteRequest, request: Request):
     user = await get_current_user(request)
     if not user: return JSONResponse({"error": "Unauthorized"}, 401)
-    
-    conn = get_db()
-    try:
-        count = 0
-        for qid in req.question_ids:
-            # Verify ownership (or admin)
-            q = conn.execute("SELECT user_id FROM questions WHERE id = ?", (qid,)).fetchone()
-            if not q: continue
-            if q['user_id'] != user['id'] and user['role'] != 'admin': continue # Skip if not owner/admin
+
+    def _run():
+        conn = get_db()
+        try:
+            count = 0
+            for qid in req.question_ids:
+                # Verify ownership (or admin)
+                q = conn.execute("SELECT user_id FROM questions WHERE id = ?", (qid,)).fetchone()
+                if not q: continue
+                if q['user_id'] != user['id'] and user['role'] != 'admin': continue # Skip if not owner/admin
             
-            conn.execute("DELETE FROM questions WHERE id = ?", (qid,))
-            conn.execute("DELETE FROM question_images WHERE question_id = ?", (qid,))
-            conn.execute("DELETE FROM user_question_status WHERE question_id = ?", (qid,))
-            count += 1
+                conn.execute("DELETE FROM questions WHERE id = ?", (qid,))
+                conn.execute("DELETE FROM question_images WHERE question_id = ?", (qid,))
+                conn.execute("DELETE FROM user_question_status WHERE question_id = ?", (qid,))
+                count += 1
         
-        conn.commit()
-        return JSONResponse({"status": "success", "count": count})
-    except Exception as e:
-        conn.rollback()
-        return JSONResponse({"error": str(e)}, 500)
-    finally:
-        conn.close()
+            conn.commit()
+            return JSONResponse({"status": "success", "count": count})
+        except Exception as e:
+            conn.rollback()
+            return JSONResponse({"error": str(e)}, 500)
+        finally:
+            conn.close()
+
+    return await run_db(_run)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,206 @@
+"""CPU-heavy image / PDF work executed in the media process pool.
+
+Everything here must stay importable without FastAPI or the database so that
+spawned worker processes only pay for PIL and pdf2image.
+"""
+import contextlib
+import hashlib
+import io
+import os
+import time
+from PIL import Image, ImageOps
+import pillow_heif
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+pillow_heif.register_heif_opener()
+# Explicit limits are enforced in _open_reduced; this only keeps Pillow's own bomb check out of the way
+Image.MAX_IMAGE_PIXELS = None
+
+def _save_webp(img, dst_path: str, quality: int, method: int) -> dict:
+    """Encode to WebP, write it and hash the bytes here so the caller never re-reads the file."""
+    buf = io.BytesIO()
+    img.save(buf, "WEBP", quality=quality, method=method)
+    data = buf.getvalue()
+    with open(dst_path, 'wb') as f:
+        f.write(data)
+    return {"path": dst_path, "sha1": hashlib.sha1(data).hexdigest(), "bytes": len(data)}
+
+class ImageRejected(ValueError):
+    """Refused from the header alone, before any pixel data is decoded."""
+
+# (condition, bytes in use, limit) shared by every worker of the pool; None in-process
+_decode_budget = None
+
+def init_worker(cond, in_use, limit: int):
+    """ProcessPoolExecutor initializer: share one decode-memory budget across the pool."""
+    global _decode_budget
+    _decode_budget = (cond, in_use, limit)
+
+@contextlib.contextmanager
+def _decode_reservation(nbytes: int):
+    """Hold `nbytes` of the shared budget; waits while other workers' decodes would exceed it.
+
+    A decode larger than the whole budget still runs, but only once nothing else
+    holds any. Yields the time spent waiting in ms.
+    """
+    if _decode_budget is None:
+        yield 0.0
+        return
+    cond, in_use, limit = _decode_budget
+    t0 = time.perf_counter()
+    with cond:
+        while in_use.value and in_use.value + nbytes > limit:
+            cond.wait()
+        in_use.value += nbytes
+    try:
+        yield (time.perf_counter() - t0) * 1000
+    finally:
+        with cond:
+            in_use.value -= nbytes
+            cond.notify_all()
+
+def _status_kb(key: str) -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1])
+    raise OSError(f"{key} not in /proc/self/status")
+
+def _rss_mark():
+    """Reset this process's RSS high-water mark and return the current RSS in kB.
+
+    Uses /proc/self/clear_refs (Linux); None where that is unavailable.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return _status_kb('VmRSS')
+    except OSError:
+        return None
+
+def _rss_growth_kb(mark):
+    """How far RSS peaked above `mark` since _rss_mark(); the memory this call needed."""
+    if mark is None: return None
+    try:
+        return max(0, _status_kb('VmHWM') - mark)
+    except OSError:
+        return None
+
+def _open_reduced(src_path: str, max_side: int, max_pixels: int):
+    """Open an image and decode it as small as the codec allows while staying >= max_side.
+
+    JPEG: draft mode (DCT scaling to 1/2..1/8). HEIF has no scaled decode: the
+    smallest embedded thumbnail that still covers max_side is used if the file
+    carries one (phones usually embed only 320-512px ones), otherwise the full
+    image is decoded. Anything else decodes at native size, which max_pixels bounds.
+    """
+    img = Image.open(src_path)  # reads the header only
+    w, h = img.size
+    if w * h > max_pixels:
+        raise ImageRejected(f"Image is {w}x{h} ({w * h / 1e6:.0f} MP); the limit is {max_pixels / 1e6:.0f} MP")
+    if max(w, h) <= max_side:
+        return img
+    ratio = max_side / float(max(w, h))
+    if img.format == 'HEIF':
+        thumbs = [t for t in img.info.get('thumbnails', []) if t >= max_side]
+        if thumbs:
+            heif = pillow_heif.open_heif(src_path)
+            return heif[heif.primary_index].get_thumbnail(heif.info['thumbnails'].index(min(thumbs))).to_pillow()
+    img.draft('RGB', (int(w * ratio), int(h * ratio)))
+    return img
+
+def encode_webp(src_path: str, dst_path: str, max_side: int = 1800, quality: int = 80, method: int = 4,
+                max_pixels: int = 64_000_000) -> dict:
+    """Decode (reduced where possible), orient, downscale and WebP-encode one image.
+
+    Returns digest, size, stage timings and memory figures: `decoded_bytes` is the
+    largest raster held, `peak_rss_delta_kb` how far this call pushed the worker's
+    RSS above where it started (None off Linux), `decode_wait_ms` the time spent
+    queued for the shared decode budget.
+    """
+    t0 = time.perf_counter()
+    img = _open_reduced(src_path, max_side, max_pixels)
+    # Budget the raster before decoding it; a full HEIF decode also needs libheif's own planes
+    with _decode_reservation(img.width * img.height * 4 * (2 if img.format == 'HEIF' else 1)) as wait_ms:
+        return _encode_opened(img, t0 + wait_ms / 1000, dst_path, max_side, quality, method, wait_ms)
+
+def _encode_opened(img, t0: float, dst_path: str, max_side: int, quality: int, method: int, wait_ms: float) -> dict:
+    mark = _rss_mark()
+    img.load()
+    decoded_bytes = img.width * img.height * len(img.getbands())
+    t1 = time.perf_counter()
+    if max(img.size) > max_side:
+        # reducing_gap: box-reduce by an integer factor first, LANCZOS only for the last step
+        img.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=3.0)
+    try:
+        img = ImageOps.exif_transpose(img)
+    except Exception:
+        pass
+    img = img.convert('RGB')
+    t2 = time.perf_counter()
+    out = _save_webp(img, dst_path, quality, method)
+    t3 = time.perf_counter()
+    out.update(decoded_bytes=decoded_bytes, peak_rss_delta_kb=_rss_growth_kb(mark), decode_wait_ms=wait_ms,
+               decode_ms=(t1 - t0) * 1000, resize_ms=(t2 - t1) * 1000, encode_ms=(t3 - t2) * 1000)
+    return out
+
+def pdf_page_count(pdf_path: str) -> int:
+    return int(pdfinfo_from_path(pdf_path).get('Pages', 1))
+
+def render_page_raster(pdf_path: str, page: int, dpi: int, dst_path: str, fmt: str = 'png', quality: int = 85) -> dict:
+    """Render one page straight to PNG or JPEG with pdftoppm (no PIL round trip), atomically at dst_path."""
+    t0 = time.perf_counter()
+    folder = os.path.dirname(dst_path)
+    tmp = f".tmp-{os.getpid()}-{time.time_ns()}"
+    jpegopt = {"quality": quality, "progressive": True, "optimize": True} if fmt == 'jpeg' else None
+    out = convert_from_path(pdf_path, dpi=dpi, first_page=page, last_page=page, fmt=fmt, jpegopt=jpegopt,
+                            output_folder=folder, output_file=tmp, single_file=True, paths_only=True)
+    os.replace(out[0], dst_path)
+    return {"path": dst_path, "bytes": os.path.getsize(dst_path), "render_ms": (time.perf_counter() - t0) * 1000}
+
+def _save_jpeg(img, dst_path: str, quality: int) -> dict:
+    tmp = os.path.join(os.path.dirname(dst_path), f".tmp-{os.getpid()}-{time.time_ns()}")
+    img.convert('RGB').save(tmp, "JPEG", quality=quality, progressive=True, optimize=True)
+    os.replace(tmp, dst_path)
+    return {"path": dst_path, "bytes": os.path.getsize(dst_path)}
+
+def raster_to_jpeg(raster_path: str, dst_path: str, quality: int = 85) -> dict:
+    """Progressive JPEG copy of a page raster for display."""
+    return _save_jpeg(Image.open(raster_path), dst_path, quality)
+
+def render_thumb_strip(pdf_path: str, dst_path: str, cell_w: int, cell_h: int, max_pages: int, quality: int = 70) -> dict:
+    """All page thumbnails side by side in one JPEG, each centred in a cell_w x cell_h cell.
+
+    One pdftoppm call renders every page scaled to cell_h, so page i sits at x = i * cell_w.
+    """
+    pages = convert_from_path(pdf_path, first_page=1, last_page=max_pages, size=(None, cell_h))
+    strip = Image.new('RGB', (cell_w * max(1, len(pages)), cell_h), 'white')
+    for i, img in enumerate(pages):
+        img.thumbnail((cell_w, cell_h))
+        strip.paste(img.convert('RGB'), (i * cell_w + (cell_w - img.width) // 2, (cell_h - img.height) // 2))
+    out = _save_jpeg(strip, dst_path, quality)
+    out["pages"] = len(pages)
+    return out
+
+def crop_raster(raster_path: str, rect: dict, canvas_w: int, canvas_h: int, dst_path: str, quality: int = 80, method: int = 4) -> dict:
+    """Crop the canvas-space rect out of a cached page raster and save it as WebP."""
+    t0 = time.perf_counter(); mark = _rss_mark()
+    img = Image.open(raster_path)
+    rx = img.width / canvas_w; ry = img.height / canvas_h
+    crop_rect = (rect['left']*rx, rect['top']*ry, (rect['left']+rect['width'])*rx, (rect['top']+rect['height'])*ry)
+    img = img.crop(crop_rect).convert('RGB')
+    t1 = time.perf_counter()
+    out = _save_webp(img, dst_path, quality, method)
+    out.update(decoded_bytes=img.width * img.height * 3, peak_rss_delta_kb=_rss_growth_kb(mark),
+               decode_ms=(t1 - t0) * 1000, resize_ms=0.0, encode_ms=(time.perf_counter() - t1) * 1000)
+    return out
+
+def make_variant(src_path: str, dst_path: str, width: int, quality: int = 80, method: int = 4) -> str:
+    """Write a copy of a stored image at most `width` px wide (atomically, via a temp file)."""
+    img = Image.open(src_path)
+    if img.width > width:
+        img.thumbnail((width, img.height), Image.LANCZOS, reducing_gap=3.0)
+    tmp = f"{dst_path}.{os.getpid()}.tmp"
+    img.convert('RGB').save(tmp, "WEBP", quality=quality, method=method)
+    os.replace(tmp, dst_path)
+    return dst_path